@@ -7,26 +7,53 @@ Created on Wed Aug 31 10:45:06 2022
 import numpy as np 
 import pandas as pd 
 from pathlib import Path
-import _pickle as cp
 import multiprocessing as mp
 
 import akshare as ak 
-from AuxFunc import formal_day
+from functools import partial
+from AuxFunc import t_now, formal_day, formal_day_vec, read_csv_typed, read_csv_multi
+from LoadCache import cache_key, cached_read
+from PklStore import PklStore, pkl_fn, load_legacy_pkl
+from Metrics import timer, inc
+from Pipeline import DirCache, run_pipeline
+from TradeCalendar import TradingCalendar
+from Catalog import Catalog
+from MinuteCache import MinuteCache
+from Checkpoint import Checkpoint, run_resumable
 
 #%% akshare class
 '''可转债的数据接口，但是同时也支持对于可转债对应正股的数据获取
 即stk_str可以为sz128106, sh600036, 代码前缀交给外部代码处理'''
 
+#存储csv的列类型，读取时显式指定以减少类型推断
+MINUTE_DTYPE = {'timeindex':str, 'preclose':np.float64, 'open':np.float64, 'close':np.float64, 
+                'high':np.float64, 'low':np.float64, 'volume':np.int64, 'amount':np.float64, 
+                'avg_price':np.float64}
+DAILY_DTYPE = {'date':str, 'open':np.float64, 'high':np.float64, 'low':np.float64, 
+               'close':np.float64, 'volume':np.int64}
+
 class AKminute:
     
-    def __init__(self, db_dir, mp_mng=False):
+    def __init__(self, db_dir, mp_mng=False, cache=None):
+        '''cache为LoadCache实例时load_minute使用读取缓存'''
         self.db_dir = Path(db_dir)
         self.mp_mng = mp_mng
-        self.cached = mp.Manager().dict() if mp_mng else {}
+        self.cached = mp.Manager().dict() if mp_mng else MinuteCache() #紧凑存储，取值时生成DataFrame
+        self.cache = cache
+        self.pkl_stores = {} #pickle_cache的增量存储，key=文件路径
+        self.dirs = DirCache()
+        self.catalog = Catalog(self.db_dir) #写入时记录每个(day, stk_str)的行数、时间范围以及crc
+        self.checkpoint = Checkpoint(self.db_dir.joinpath('checkpoint.db'))
     
-    def get_minute(self, stk_str):
-        '''获取当天的可转债min数据（实时close数据，3S频率），使用ak.bond_zh_hs_cov_min接口'''
-        df = ak.bond_zh_hs_cov_min(stk_str, period='1')
+    def get_minute(self, stk_str, ndays=None):
+        '''
+        获取当天的可转债min数据（实时close数据，3S频率），使用ak.bond_zh_hs_cov_min接口
+        ndays不为None时获取最近ndays(<=5)个交易日的数据(需要修改后的bond_zh_cov_sina.py)
+        '''
+        if ndays is None:
+            df = ak.bond_zh_hs_cov_min(stk_str, period='1')
+        else:
+            df = ak.bond_zh_hs_cov_min(stk_str, period='1', ndays=str(ndays))
         col_dict = {'时间':'timeindex', '昨收':'preclose', '开盘':'open', '收盘':'close', '最高':'high',
                     '最低':'low', '成交量':'volume', '成交额':'amount', '最新价':'avg_price'} #最新价为累计成交均价
         df = df.rename(columns=col_dict)
@@ -47,13 +74,31 @@ class AKminute:
             self.cached[stk_str[2:]] = df
             
         dt = df['timeindex'].iat[-1]
-        day = dt[:10]
-        day_path = self.db_dir.joinpath(day)
-        if not day_path.exists():
-            day_path.mkdir(parents=True)
+        day_path = self.dirs.ensure(self.db_dir.joinpath(dt[:10]))
         fn = day_path.joinpath(f'{stk_str}.csv')
-        df.to_csv(fn)
+        with timer('persist', self.db_dir.name):
+            self.catalog.write_csv(fn, df, dt[:10], stk_str)
         return dt
+    
+    def save_minute_pipe(self, stk_iter, N_fetch=16, cached=False, N_parse=1, N_write=1):
+        '''fetch/parse/persist分为三个stage的流水线，stage之间为有界队列，writer按日期目录分批写入'''
+        def parse(stk_str, df):
+            if len(df) == 0:
+                raise Exception(f'Empty df for {stk_str}')
+            if cached:
+                self.cached[stk_str[2:]] = df
+            return df
+
+        def write(batch):
+            with timer('persist', self.db_dir.name):
+                for stk_str,df in sorted(batch, key=lambda x: x[1]['timeindex'].iat[-1][:10]):
+                    day_str = df['timeindex'].iat[-1][:10]
+                    day_path = self.dirs.ensure(self.db_dir.joinpath(day_str))
+                    self.catalog.write_csv(day_path.joinpath(f'{stk_str}.csv'), df, day_str, stk_str)
+            return
+
+        return run_pipeline(stk_iter, self.get_minute, parse, write, N_fetch, N_parse, N_write,
+                            name=self.db_dir.name)
 
     def cache_minute_multi(self, stk_iter):
         '''存储含有多个stk_str的iteration'''
@@ -62,6 +107,7 @@ class AKminute:
                 dt = self.cache_minute(stk_str)
                 print(f'\rNo.{i:3d} {stk_str} {dt} minute data cached.', end='')
             except Exception as e:
+                inc('task_errors', self.db_dir.name)
                 print(repr(e))
                 print(f'\tError of No.{i} {stk_str}.')
         print()
@@ -74,48 +120,163 @@ class AKminute:
                 dt = self.save_minute(stk_str, cached)
                 print(f'\rNo.{i:3d} {stk_str} {dt} minute data saved.', end='')
             except Exception as e:
+                inc('task_errors', self.db_dir.name)
                 print(repr(e))
                 print(f'\tError of No.{i} {stk_str}.')
         print()
         return
     
-    def load_minute(self, day_str, stk_str):
-        '''读取day_str, stk_str返回df'''
+    def load_minute(self, day_str, stk_str, columns=None, dtype=MINUTE_DTYPE):
+        '''读取day_str, stk_str返回df, columns为需要读取的列'''
         day_str = formal_day(day_str)
         fn = self.db_dir.joinpath(day_str, f'{stk_str}.csv')
-        df = pd.read_csv(fn, index_col=0, engine='c')
+        key = cache_key(self.db_dir, stk_str, day_str, columns, dtype)
+        df = cached_read(self.cache, fn, key, partial(read_csv_typed, fn, columns, dtype, index_col=0))
         return df
     
-    def load_minute_multi(self, day_list, stk_str):
-        '''返回多天的day_str合并的df'''
-        day_list = [formal_day(day_str) for day_str in day_list]
+    def load_minute_multi(self, day_list, stk_str, columns=None, dtype=MINUTE_DTYPE,
+                          N_workers=8, process=False):
+        '''返回多天的day_str合并的df, 多个文件并发读取'''
+        day_list = formal_day_vec(day_list)
         fn_list = [self.db_dir.joinpath(day_str, f'{stk_str}.csv') for day_str in day_list]
-        df_list = [pd.read_csv(fn, index_col=0, engine='c') for fn in fn_list]
-        df = pd.concat(df_list, axis=0)
+        df = read_csv_multi(fn_list, columns, dtype, N_workers, process, index_col=0)
+        return df
+    
+    def load_minute_day(self, day_str, stk_iter, columns=None, dtype=MINUTE_DTYPE,
+                        N_workers=8, process=False):
+        '''返回一天内多个stk_str合并的df, 外层index为stk_str'''
+        day_str = formal_day(day_str)
+        stk_list = list(stk_iter)
+        fn_list = [self.db_dir.joinpath(day_str, f'{stk_str}.csv') for stk_str in stk_list]
+        df = read_csv_multi(fn_list, columns, dtype, N_workers, process, keys=stk_list, index_col=0)
         return df
     
     def pickle_cache(self, day_str, prefix='data'):
-        fn = self.db_dir.joinpath(f'{prefix}{day_str}.pkl')
-        with open(fn, 'wb') as f:
-            if self.mp_mng:
-                cp.dump(self.cached.copy(), f)
-            else:
-                cp.dump(self.cached, f)
+        '''增量存储day_str的cached数据，只写入上次存储后变化的stk_str'''
+        fn = pkl_fn(self.db_dir, day_str, prefix)
+        if fn not in self.pkl_stores:
+            self.pkl_stores[fn] = PklStore(fn)
+        store = self.pkl_stores[fn]
+        if self.mp_mng:
+            store.dump(self.cached.copy())
+        else: #stamps没有变化的stk_str不生成DataFrame
+            store.dump(self.cached, self.cached.stamps())
         return 
 
-    def load_pkl(self, day_str, prefix='data'):
-        fn = self.db_dir.joinpath(f'{prefix}{day_str}.pkl')
-        with open(fn, 'rb') as f:
-            rst = cp.load(f)
+    def load_pkl(self, day_str, prefix='data', keys=None):
+        '''读取pickle_cache存储的数据，keys为需要读取的stk_str，None为全部'''
+        fn = pkl_fn(self.db_dir, day_str, prefix)
+        store = PklStore(fn)
+        if not store.idx_fn.exists(): #兼容旧格式的pkl文件
+            return load_legacy_pkl(self.db_dir, day_str, prefix, keys)
+        rst = store.load(keys)
+        return rst
+    
+    def scan_missing(self, stk_iter, day_list):
+        '''
+        返回{stk_str: [缺失的day_str, ...]}，查询catalog
+        第一次查询时补充catalog建立之前已有的文件(只运行一次)，之后不扫描目录
+        '''
+        self.catalog.ensure_built(encoding='utf-8')
+        return self.catalog.missing(stk_iter, day_list)
+    
+    def backfill_minute(self, stk_str, day_list, ndays=5):
+        '''
+        一次请求最近ndays天的数据，拆分后写入day_list中的日期，返回写入的day_str
+        第一天的数据开盘价为0且没有preclose，只在必要时使用(见backfill)
+        已经存在的文件不覆盖
+        '''
+        days = split_days(self.get_minute(stk_str, ndays))
+        first = min(days) if len(days) > 0 else None
+        rst = []
+        for day_str in day_list:
+            if day_str not in days:
+                continue
+            day_path = self.dirs.ensure(self.db_dir.joinpath(day_str))
+            fn = day_path.joinpath(f'{stk_str}.csv')
+            if fn.exists(): #其他进程/save_minute已经写入
+                inc('backfill_exists', self.db_dir.name)
+                continue
+            if day_str == first:
+                inc('backfill_first_day', self.db_dir.name)
+            with timer('persist', self.db_dir.name):
+                self.catalog.write_csv(fn, days[day_str], day_str, stk_str)
+            rst.append(day_str)
         return rst
+    
+    def backfill(self, stk_iter, day_list=None, N_workers=16, calendar=None, throttle=None, 
+                 stop=None):
+        '''
+        补齐最近5个交易日内缺失的(day, stk_str)
+        day_list为None时使用交易日历的最近5个交易日，收盘前不补当天(由save_minute负责)
+        每个stk_str只请求一次，ndays覆盖最早的缺失日期并多请求一天，
+            使缺失日期不是返回数据的第一天(开盘价为0的问题)，缺失的是最早一天时才使用第一天的数据
+        请求过的(stk_str, 缺失日期)记录在checkpoint中，没有数据的(停牌等)重新运行时不再请求
+        throttle, stop见Checkpoint.run_resumable，用于与实时采集同时在后台运行
+        return: {stk_str: [写入的day_str, ...]}
+        '''
+        stk_list = list(stk_iter)
+        calendar = TradingCalendar() if calendar is None else calendar
+        if day_list is None:
+            day_list = calendar.last_days(5)
+            if t_now() < '15:00:00':
+                day_list = [d for d in day_list if d != t_now(1,0)[:10]]
+        day_list = sorted(formal_day_vec(day_list).tolist())
+        missing = self.scan_missing(stk_list, day_list)
+        print(f'{len(missing)} stk_str with {sum(map(len, missing.values()))} missing partitions.')
+        
+        today = t_now(1,0)[:10]
+        rst = {}
+        def task(unit):
+            stk_str, days = unit.split('|')[0], missing[unit.split('|')[0]]
+            #最早缺失日期到今天的交易日数，再多请求一天
+            ndays = min(5, len(calendar.trading_days(days[0], today)) + 1)
+            rst[stk_str] = self.backfill_minute(stk_str, days, ndays)
+            return ','.join(rst[stk_str])
         
+        units = [f'{stk_str}|{",".join(days)}' for stk_str,days in missing.items()]
+        run_resumable('minute', units, task, self.checkpoint, N_workers, throttle, 
+                      stop=stop, name=self.db_dir.name)
+        return rst
+
+
+def split_days(df):
+    '''
+    多天的分钟数据按日期拆分为{day_str: df}
+    preclose改为前一天最后的close，第一天没有前一天的数据为NaN
+    '''
+    if len(df) == 0:
+        return {}
+    day = df['timeindex'].str[:10].values
+    days, idx = np.unique(day, return_index=True)
+    bounds = list(idx) + [len(df)]
+    rst = {}
+    prev = np.nan
+    for i,day_str in enumerate(days):
+        sub = fix_zero_open(df.iloc[bounds[i]:bounds[i+1]].reset_index(drop=True))
+        sub['preclose'] = prev
+        prev = sub['close'].iat[-1]
+        rst[day_str] = sub
+    return rst
+
+def fix_zero_open(df):
+    '''ndays>1时第一天的开盘价为0(getter.get_latest_ndays_quote中的TODO)，用该分钟的close代替'''
+    mask = df['open'].values <= 0
+    if mask.any():
+        df = df.copy()
+        df.loc[mask, 'open'] = df.loc[mask, 'close']
+        df['high'] = np.maximum(df['high'].values, df['open'].values)
+        low = df['low'].values
+        df['low'] = np.where(low <= 0, np.minimum(df['open'].values, df['close'].values), low)
+    return df
 
 
 class AKdaily:
     
-    def __init__(self, db_dir):
-        '''数据库文件存储路径db_dir'''
+    def __init__(self, db_dir, cache=None):
+        '''数据库文件存储路径db_dir, cache为LoadCache实例时load_daily使用读取缓存'''
         self.db_dir = Path(db_dir)
+        self.cache = cache
         if not self.db_dir.exists():
             self.db_dir.mkdir(parents=True)
     
@@ -128,7 +289,8 @@ class AKdaily:
         '''存储获取的可转债数据'''
         df = self.get_daily(stk_str)
         fn = self.db_dir.joinpath(f'{stk_str}.csv')
-        df.to_csv(fn)
+        with timer('persist', self.db_dir.name):
+            df.to_csv(fn)
         return 
     
     def save_daily_multi(self, stk_iter):
@@ -138,15 +300,25 @@ class AKdaily:
                 self.save_daily(stk_str)
                 print(f'\rNo.{i} {stk_str} daily data saved.', end='') #\r在一行一直刷新
             except Exception as e:
+                inc('task_errors', self.db_dir.name)
                 print(repr(e))
                 print(f'\tError of No.{i} {stk_str}.')
         print()
         return 
         
-    def load_daily(self, stk_str):
+    def load_daily(self, stk_str, columns=None, dtype=DAILY_DTYPE):
         '''读取stk_str返回df'''
         fn = self.db_dir.joinpath(f'{stk_str}.csv')
-        df = pd.read_csv(fn, index_col=0, engine='c')
+        key = cache_key(self.db_dir, stk_str, None, columns, dtype)
+        df = cached_read(self.cache, fn, key, partial(read_csv_typed, fn, columns, dtype, index_col=0))
+        return df
+    
+    def load_daily_multi(self, stk_iter, columns=None, dtype=DAILY_DTYPE,
+                         N_workers=8, process=False):
+        '''并发读取多个stk_str的日线数据, 外层index为stk_str'''
+        stk_list = list(stk_iter)
+        fn_list = [self.db_dir.joinpath(f'{stk_str}.csv') for stk_str in stk_list]
+        df = read_csv_multi(fn_list, columns, dtype, N_workers, process, keys=stk_list, index_col=0)
         return df
     
 #%% main
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+可转债与正股分钟数据的对齐：整个配对的universe一次得到(pairs x minutes)的矩阵
+    时间轴为day_list的交易分钟，每天240个(09:31~11:30, 13:01~15:00)，集合竞价并入第1分钟
+    每个代码只读取一次(多个转债对应同一个正股时共用)，按(行, 分钟)的整数位置一次写入矩阵
+    as-of: 缺失的分钟使用之前最近的值(可以跨日)，成交量类的字段缺失时为0；
+    tolerance不为None时超过tolerance分钟的旧值记为NaN
+
+数据源为EFminute/AKminute的实例(使用load_minute_day读取)，文件不存在的(day, stk_str)视为缺失
+
+@author: yhzhang
+"""
+import numpy as np
+import pandas as pd
+
+from AuxFunc import formal_day_vec, session_minute, session_label
+
+
+#%% grid
+N_MINUTES = 240
+FLOW_FIELDS = ('volume', 'amount', 'turnover') #缺失的分钟没有成交，不使用as-of
+
+def minute_grid(day_list):
+    '''day_list的全部交易分钟的timeindex(YYYY-MM-DD HH:MM:SS)'''
+    day_list = formal_day_vec(day_list)
+    label = session_label(np.arange(1, N_MINUTES + 1)).to_numpy(dtype=object)
+    return (np.repeat(np.asarray(day_list, dtype=object), N_MINUTES) + ' ' +
+            np.tile(label, len(day_list))).astype(str)
+
+def grid_position(timeindex, day_list):
+    '''timeindex(Series)在minute_grid中的位置，不在day_list中或者不在交易时段内的为-1'''
+    days = np.asarray(formal_day_vec(day_list))
+    d = timeindex.str[:10].to_numpy(dtype=str)
+    i = np.searchsorted(days, d)
+    i_clip = np.minimum(i, len(days) - 1)
+    idx = session_minute(timeindex, strict=True)
+    ok = (days[i_clip] == d) & (idx > 0)
+    return np.where(ok, i_clip * N_MINUTES + idx - 1, -1)
+
+
+#%% load
+def load_long(src, stk_list, day_list, fields, N_workers=8):
+    '''读取stk_list在day_list的数据，返回(stk_str, timeindex, fields)的长表'''
+    df_list = []
+    for day_str in formal_day_vec(day_list):
+        have = [s for s in stk_list if src.db_dir.joinpath(day_str, f'{s}.csv').exists()]
+        if len(have) == 0:
+            continue
+        df = src.load_minute_day(stk_iter=have, day_str=day_str, columns=['timeindex'] + list(fields),
+                                 N_workers=N_workers)
+        df_list.append(df.reset_index(level=0).rename(columns={'level_0': 'stk'}))
+    if len(df_list) == 0:
+        return pd.DataFrame(columns=['stk', 'timeindex'] + list(fields))
+    return pd.concat(df_list, ignore_index=True)
+
+def scatter(df, stk_list, day_list, fields):
+    '''
+    长表 -> {field: (len(stk_list), n_minutes)}，缺失为NaN
+    同一分钟有多行时(集合竞价并入第1分钟等)，FLOW_FIELDS求和，其余的字段取长表中最后一行
+    '''
+    n_t = len(day_list) * N_MINUTES
+    row = pd.Index(stk_list).get_indexer(df['stk'])
+    col = grid_position(df['timeindex'], day_list) if len(df) > 0 else np.empty(0, int)
+    ok = (row >= 0) & (col >= 0)
+    pos = row[ok] * n_t + col[ok] #矩阵中的平坦位置
+    order = np.argsort(pos, kind='stable') #相同位置保持长表中的顺序
+    s = pos[order]
+    last = order[np.r_[s[1:] != s[:-1], True]] if len(s) > 0 else order
+    rst = {}
+    for k in fields:
+        mat = np.full((len(stk_list), n_t), np.nan)
+        val = df[k].to_numpy(dtype=np.float64)[ok]
+        if k in FLOW_FIELDS:
+            mat.flat[pos] = 0
+            np.add.at(mat.reshape(-1), pos, val)
+        else:
+            mat.flat[pos[last]] = val[last]
+        rst[k] = mat
+    return rst
+
+def asof_fill(mat, tolerance=None):
+    '''沿分钟方向用之前最近的有效值填充，返回(填充后的矩阵, 距离有效值的分钟数)'''
+    n_t = mat.shape[1]
+    valid = ~np.isnan(mat)
+    last = np.where(valid, np.arange(n_t), -1)
+    np.maximum.accumulate(last, axis=1, out=last)
+    rows = np.arange(mat.shape[0])[:, None]
+    out = mat[rows, np.maximum(last, 0)]
+    age = np.arange(n_t) - last
+    out[last < 0] = np.nan
+    if tolerance is not None:
+        out[age > tolerance] = np.nan
+    age = np.where(last < 0, -1, age)
+    return out, age
+
+
+#%% align
+def align_pairs(cb_src, ua_src, cb_list, ua_list, day_list, fields=('close',), ua_fields=None,
+                tolerance=None, N_workers=8):
+    '''
+    cb_list与ua_list按位置配对(例如load_universe_arrays的cbse与uase)，day_list为交易日
+    return: {'time': 分钟timeindex, 'cb': cb_list, 'ua': ua_list,
+             'cb_{field}'/'ua_{field}': (pairs x minutes)的矩阵, 'cb_age'/'ua_age': 距离有效值的分钟数}
+    '''
+    assert len(cb_list) == len(ua_list), 'cb_list and ua_list should be paired.'
+    day_list = sorted(formal_day_vec(day_list))
+    ua_fields = fields if ua_fields is None else ua_fields
+    rst = {'time': minute_grid(day_list), 'cb': np.asarray(cb_list), 'ua': np.asarray(ua_list)}
+    for side, src, codes, flds in (('cb', cb_src, cb_list, fields), ('ua', ua_src, ua_list, ua_fields)):
+        uniq, inv = np.unique(np.asarray(codes, dtype=str), return_inverse=True)
+        uniq = uniq.tolist()
+        long = load_long(src, uniq, day_list, flds, N_workers)
+        mats = scatter(long, uniq, day_list, flds)
+        age = None
+        for k in flds:
+            if k in FLOW_FIELDS:
+                mat = np.nan_to_num(mats[k], nan=0.0)
+            else:
+                mat, age_k = asof_fill(mats[k], tolerance)
+                age = age_k if age is None else age
+            rst[f'{side}_{k}'] = mat[inv]
+        if age is not None:
+            rst[f'{side}_age'] = age[inv]
+    return rst
+
+def to_frame(rst, key):
+    '''矩阵转为DataFrame(index为分钟，columns为cb代码)'''
+    return pd.DataFrame(rst[key].T, index=rst['time'], columns=rst['cb'])
@@ -5,6 +5,9 @@ Created on Wed Aug 31 10:47:40 2022
 @author: yhzhang
 """
 import datetime as dtm
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pandas as pd
 
 #%%
 def t_now(day=0, us=0):
@@ -61,3 +64,105 @@ def formal_day(day_str):
         return '-'.join([day_str[:4], day_str[4:6], day_str[6:8]])
     
 
+#%% 向量化版本，输入为array-like的代码或者日期，返回np.ndarray(str)
+SE_SECID = {'sh': '1', 'sz': '0'} #东方财富secid的市场编号
+
+def add_cbse_vec(cb_arr, prefix=True):
+    '''add_cbse的向量化版本，11开头为sh, 12开头为sz'''
+    arr = np.asarray(cb_arr, dtype=str)
+    head = arr.astype('U2')
+    se = np.where(head == '11', 'sh', np.where(head == '12', 'sz', ''))
+    if (se == '').any():
+        raise Exception(f'Can not figure out SE for {arr[se == ""][:5]}')
+    return se_join(arr, se, prefix)
+
+def add_uase_vec(ua_arr, prefix=True):
+    '''add_uase的向量化版本，6开头为sh, 其余为sz'''
+    arr = np.asarray(ua_arr, dtype=str)
+    se = np.where(arr.astype('U1') == '6', 'sh', 'sz')
+    return se_join(arr, se, prefix)
+
+def se_join(arr, se, prefix=True):
+    if prefix:
+        return np.char.add(se, arr)
+    return np.char.add(np.char.add(arr, '.'), np.char.upper(se))
+
+def secid_vec(stk_arr):
+    '''带前缀的代码(sh110038)转为东方财富的secid(1.110038)'''
+    arr = np.asarray(stk_arr, dtype=str)
+    mkt = np.where(arr.astype('U2') == 'sh', SE_SECID['sh'], SE_SECID['sz'])
+    return np.char.add(np.char.add(mkt, '.'), np.char.lstrip(arr, 'shz'))
+
+def bare_code_vec(stk_arr):
+    '''任意格式(110038, sh110038, 110038.SH, 1.110038)的代码转为不带交易所的代码'''
+    arr = np.asarray(stk_arr, dtype=str)
+    if arr.size == 0:
+        return arr
+    parts = np.char.partition(arr, '.')
+    head, tail = parts[..., 0], parts[..., 2]
+    code = np.where(np.char.str_len(tail) > np.char.str_len(head), tail, head) #secid的代码在.之后
+    return np.char.lstrip(code, 'shzSHZ')
+
+def formal_day_vec(day_arr):
+    '''formal_day的向量化版本，YYYYMMDD与YYYY-MM-DD可以混合'''
+    s = pd.Series(np.asarray(day_arr, dtype=str))
+    plain = ~s.str.contains('-', regex=False)
+    s[plain] = s[plain].str[:4] + '-' + s[plain].str[4:6] + '-' + s[plain].str[6:8]
+    return s.to_numpy(dtype=str)
+
+
+#%% 交易分钟
+def session_minute(timeindex, strict=False):
+    '''
+    timeindex(YYYY-MM-DD HH:MM:SS)转为当天的交易分钟序号
+    09:31->1 ... 11:30->120, 13:01->121 ... 15:00->240，集合竞价(<=09:30)并入第1分钟
+    strict为True时只有09:30~11:30, 13:01~15:00是交易分钟(09:30并入第1分钟)，其余的为0
+    '''
+    hh = timeindex.str[11:13].values.astype(int)
+    mm = timeindex.str[14:16].values.astype(int)
+    m = hh*60 + mm
+    idx = np.where(m <= 690, m - 570, m - 660) #570=09:30, 690=11:30, 780-120=660
+    if strict:
+        on = ((m >= 570) & (m <= 690)) | ((m >= 781) & (m <= 900))
+        return np.where(on, np.maximum(idx, 1), 0)
+    return np.clip(idx, 1, 240)
+
+def session_label(idx):
+    '''交易分钟序号转为HH:MM:00，与东方财富的K线一致以bar的结束时间标记'''
+    m = np.where(idx <= 120, idx + 570, idx + 660)
+    return pd.Series(m // 60).map('{:02d}'.format) + ':' + pd.Series(m % 60).map('{:02d}'.format) + ':00'
+
+
+#%% csv reader
+def usecols_filter(columns):
+    '''把columns转变为read_csv的usecols参数，to_csv写出的无名index列始终保留'''
+    if columns is None:
+        return None
+    col_set = set(columns)
+    return lambda c: c in col_set or c == '' or c.startswith('Unnamed')
+
+def read_csv_typed(fn, columns=None, dtype=None, **kwargs):
+    '''按列读取并指定dtype的read_csv，可作为进程池的func（模块级函数可以pickle）'''
+    kwargs.setdefault('engine', 'c')
+    return pd.read_csv(fn, usecols=usecols_filter(columns), dtype=dtype, **kwargs)
+
+def read_csv_multi(fn_list, columns=None, dtype=None, N_workers=8, 
+                   process=False, keys=None, **kwargs):
+    '''
+    并发读取多个csv文件，最后只concat一次
+    process=False为线程池（c引擎解析时会释放GIL），True为进程池
+    keys不为None时作为concat的外层index，例如一天所有stk_str的数据
+    '''
+    fn_list = list(fn_list)
+    if len(fn_list) == 0:
+        return pd.DataFrame(columns=columns)
+    N_workers = max(1, min(N_workers, len(fn_list)))
+    Executor = ProcessPoolExecutor if process else ThreadPoolExecutor
+    if N_workers == 1:
+        df_list = [read_csv_typed(fn, columns, dtype, **kwargs) for fn in fn_list]
+    else:
+        with Executor(max_workers=N_workers) as p:
+            futures = [p.submit(read_csv_typed, fn, columns, dtype, **kwargs) for fn in fn_list]
+            df_list = [future.result() for future in futures] #保持fn_list的顺序
+    df = pd.concat(df_list, axis=0, keys=keys)
+    return df
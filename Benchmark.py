@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+离线的吞吐量测试：本地的假行情服务器 + MultiTask中各个*_save任务
+
+假服务器代替push2/push2his/datacenter/sina等host，优先回放payload_dir中录制的响应，
+没有录制时对已知的接口生成模拟数据；可以设置延迟、抖动以及错误注入
+录制的响应按host + path + 标识代码/周期的参数(PAYLOAD_PARAMS)保存，不同代码的响应不互相覆盖
+使用方法: python Benchmark.py 或者调用run_bench(...)
+
+@author: yhzhang
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import threading
+import multiprocessing as mp
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import requests
+
+try:
+    import resource #只在unix下可用
+except ImportError:
+    resource = None
+
+
+#%% 需要重定向的host
+BENCH_HOSTS = ('push2.eastmoney.com', '80.push2.eastmoney.com', '16.push2.eastmoney.com',
+               'push2his.eastmoney.com', 'searchapi.eastmoney.com',
+               'datacenter-web.eastmoney.com', 'vip.stock.finance.sina.com.cn',
+               'money.finance.sina.com.cn', 'finance.sina.com.cn')
+
+#区分响应的参数：代码、周期、复权、天数等，时间戳等其他参数不参与文件名
+PAYLOAD_PARAMS = ('secid', 'symbol', 'code', 'input', 'klt', 'fqt', 'ndays', 'beg', 'end', 'lmt')
+
+def payload_name(host, path, query=''):
+    '''录制文件名: host + path + PAYLOAD_PARAMS中出现的参数, /替换为_'''
+    qs = parse_qs(query)
+    key = '&'.join(f'{k}={qs[k][0]}' for k in PAYLOAD_PARAMS if k in qs)
+    return f'{host}{path}'.replace('/', '_') + (f'@{key}' if key else '') + '.txt'
+
+def redirect_hosts(base_url, record_dir=None):
+    '''
+    把BENCH_HOSTS的请求重定向到base_url/host/path，对requests.get与session.get均有效
+    record_dir不为None时不重定向，而是把真实的响应保存下来作为之后回放的payload
+    重复调用时替换上一次的重定向
+    '''
+    orig_request = getattr(requests.Session, '_bench_orig', requests.Session.request)
+
+    def request(self, method, url, *args, **kwargs):
+        sp = urlsplit(url)
+        if sp.hostname not in BENCH_HOSTS:
+            return orig_request(self, method, url, *args, **kwargs)
+        if record_dir is not None:
+            resp = orig_request(self, method, url, *args, **kwargs)
+            name = payload_name(sp.hostname, sp.path, urlsplit(resp.request.url).query)
+            Path(record_dir).joinpath(name).write_text(resp.text, encoding='utf-8')
+            return resp
+        url = f'{base_url}/{sp.hostname}{sp.path}' + (f'?{sp.query}' if sp.query else '')
+        return orig_request(self, method, url, *args, **kwargs)
+
+    requests.Session._bench_orig = orig_request
+    requests.Session.request = request
+    return orig_request
+
+def record_payloads(record_dir):
+    '''交易时间内运行，保存真实的响应到record_dir，之后FakeQuoteServer(payload_dir=record_dir)回放'''
+    Path(record_dir).mkdir(parents=True, exist_ok=True)
+    return redirect_hosts(None, record_dir)
+
+
+#%% 模拟数据
+def _secid(query):
+    secid = query.get('secid', ['1.110001'])[0]
+    mkt, code = secid.split('.')
+    return mkt, code
+
+def _minute_times(day):
+    '''A股交易时段的1min时间戳'''
+    am = pd.date_range(f'{day} 09:31', f'{day} 11:30', freq='1min')
+    pm = pd.date_range(f'{day} 13:01', f'{day} 15:00', freq='1min')
+    return am.append(pm).strftime('%Y-%m-%d %H:%M')
+
+def _bars(code, n):
+    rng = np.random.default_rng(int(code))
+    close = 100 + np.cumsum(rng.normal(0, 0.1, n))
+    vol = rng.integers(10, 1000, n)
+    return close, vol
+
+def fake_snap(query):
+    '''push2 /api/qt/stock/get, dc_get_snap与get_base_info使用'''
+    mkt, code = _secid(query)
+    close, vol = _bars(code, 1)
+    p = round(float(close[0]), 3)
+    data = {'f57': code, 'f58': f'转债{code}', 'f86': int(time.time()), 'f60': p, 'f46': p,
+            'f44': p + 0.5, 'f45': p - 0.5, 'f43': p, 'f71': p, 'f47': int(vol[0]), 'f48': p * vol[0] * 10}
+    for i,f in enumerate(range(11, 41, 2)): #f11~f20为买五档，f31~f40为卖五档
+        data[f'f{f}'] = round(p + (i - 5) * 0.01, 3)
+        data[f'f{f+1}'] = int(vol[0]) + i
+    return {'rc': 0, 'data': data}
+
+def fake_trends(query):
+    '''push2/push2his /api/qt/stock/trends2/get'''
+    mkt, code = _secid(query)
+    ndays = int(query.get('ndays', ['1'])[0])
+    days = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=ndays).strftime('%Y-%m-%d')
+    times = np.concatenate([_minute_times(day) for day in days])
+    close, vol = _bars(code, len(times))
+    trends = [f'{t},{c:.3f},{c:.3f},{c+0.1:.3f},{c-0.1:.3f},{v},{c*v*10:.1f},{c:.3f}'
+              for t,c,v in zip(times, close, vol)]
+    return {'rc': 0, 'data': {'code': code, 'market': int(mkt), 'name': f'转债{code}',
+                              'preClose': round(float(close[0]), 3), 'prePrice': round(float(close[0]), 3),
+                              'trends': trends}}
+
+def fake_kline(query):
+    '''push2his /api/qt/stock/kline/get, klt=1为当天分钟数据，其他为日线'''
+    mkt, code = _secid(query)
+    klt = int(query.get('klt', ['101'])[0])
+    if klt < 100:
+        times = _minute_times(pd.Timestamp.today().strftime('%Y-%m-%d'))
+    else:
+        times = pd.bdate_range('2021-01-01', pd.Timestamp.today()).strftime('%Y-%m-%d')
+    close, vol = _bars(code, len(times))
+    klines = [f'{t},{c:.3f},{c:.3f},{c+0.1:.3f},{c-0.1:.3f},{v},{c*v*10:.1f},0.1,0.01,0.01,0.5'
+              for t,c,v in zip(times, close, vol)]
+    return {'rc': 0, 'data': {'code': code, 'market': int(mkt), 'name': f'转债{code}',
+                              'prePrice': round(float(close[0]), 3), 'klines': klines}}
+
+def fake_search(query):
+    '''searchapi /api/suggest/get, efinance的get_quote_id使用，字段顺序与efinance的Quote一致'''
+    code = query.get('input', ['110001'])[0]
+    mkt = '1' if code[0] in '56' or code[:2] == '11' else '0'
+    item = {'Code': code, 'Name': f'转债{code}', 'PinYin': '', 'ID': f'{code}{mkt}', 'JYS': '',
+            'Classify': 'AStock', 'MarketType': '', 'SecurityTypeName': '', 'SecurityType': '',
+            'MktNum': mkt, 'TypeUS': '', 'QuoteID': f'{mkt}.{code}', 'UnifiedCode': code, 'InnerCode': ''}
+    return {'QuotationCodeTable': {'Data': [item]}}
+
+FAKE_ROUTES = {'/api/qt/stock/get': fake_snap,
+               '/api/qt/stock/trends2/get': fake_trends,
+               '/api/qt/stock/kline/get': fake_kline,
+               '/api/suggest/get': fake_search}
+
+
+#%% 假服务器
+class FakeQuoteServer:
+
+    def __init__(self, payload_dir=None, latency=0.02, jitter=0.02, error_rate=0.0, port=0):
+        '''
+        payload_dir: 录制的响应目录，存在对应文件时优先回放
+        latency, jitter: 每个请求的延迟为latency + uniform(0, jitter)秒
+        error_rate: 返回503的概率
+        '''
+        self.payload_dir = None if payload_dir is None else Path(payload_dir)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.n_requests = 0
+        self.n_errors = 0
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.httpd.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.n_requests += 1
+                time.sleep(server.latency + random.uniform(0, server.jitter))
+                if random.random() < server.error_rate:
+                    server.n_errors += 1
+                    return self._send(503, b'injected error')
+                body = server.respond(self.path)
+                if body is None:
+                    return self._send(404, b'no payload')
+                return self._send(200, body)
+
+            def _send(self, code, body):
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def respond(self, raw_path):
+        '''/host/path?query -> bytes，回放优先，其次模拟数据'''
+        sp = urlsplit(raw_path)
+        host, _, path = sp.path.lstrip('/').partition('/')
+        path = '/' + path
+        if self.payload_dir is not None: #没有参数的录制文件为旧格式，同一接口共用
+            for name in (payload_name(host, path, sp.query), payload_name(host, path)):
+                fn = self.payload_dir.joinpath(name)
+                if fn.exists():
+                    return fn.read_bytes()
+        func = FAKE_ROUTES.get(path)
+        if func is None:
+            return None
+        return json.dumps(func(parse_qs(sp.query)), ensure_ascii=False).encode('utf-8')
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return
+
+
+#%% 资源统计
+def usage():
+    '''(cpu秒数, 峰值rss的MB)，包括子进程'''
+    if resource is None:
+        return time.process_time(), np.nan
+    me, ch = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = me.ru_utime + me.ru_stime + ch.ru_utime + ch.ru_stime
+    rss = max(me.ru_maxrss, ch.ru_maxrss)
+    rss = rss / 1024**2 if sys.platform == 'darwin' else rss / 1024 #mac为bytes，linux为KB
+    return cpu, rss
+
+def bench_universe(N=100):
+    '''模拟的可转债代码，一半上交所一半深交所'''
+    sh = [f'sh{110000+i}' for i in range(N // 2)]
+    sz = [f'sz{123000+i}' for i in range(N - N // 2)]
+    return sh + sz
+
+
+#%% 单个case在独立进程中运行，保证cpu与rss互不影响
+def _init_worker(base_url):
+    '''case进程以及mp_process的子进程中重定向host，不依赖fork继承主进程的修改'''
+    redirect_hosts(base_url)
+    sys.stdout = open(os.devnull, 'w') #屏蔽*_multi的进度输出
+    return
+
+def _run_case(job, mode, stk_list, base_url, N_workers, N_loops, queue):
+    _init_worker(base_url)
+    import MultiTask as mt
+    cycle_list = []
+    def timed_func(*args, **kwargs):
+        if mode == 'thread':
+            cycle_list.extend(mt.mp_thread(*args, **kwargs))
+        else:
+            cycle_list.extend(mt.mp_process(*args, initializer=_init_worker, initargs=(base_url,),
+                                            **kwargs))
+
+    bare_list = [s[2:] for s in stk_list] #EFapi使用不带SE的代码
+    day_str = pd.Timestamp.today().strftime('%Y-%m-%d')
+    cpu0, _ = usage()
+    t0 = time.perf_counter()
+    with tempfile.TemporaryDirectory() as db_dir:
+        if job == 'DCsnap':
+            mt.DCsnap_save(stk_list, db_dir=db_dir, N_thread=N_workers, N_loops=N_loops, mp_func=timed_func)
+        elif job == 'AK1T':
+            mt.AK1T_save(stk_list, day_str, db_dir=db_dir, N_thread=N_workers, N_loops=N_loops, mp_func=timed_func)
+        elif job == 'EF1T':
+            mt.EF1T_save(bare_list, day_str, db_dir=db_dir, N_thread=N_workers, N_loops=N_loops, mp_func=timed_func)
+        elif job == 'EF1D':
+            mt.EF1D_save(bare_list, db_dir=db_dir, N_thread=N_workers, N_loops=N_loops, mp_func=timed_func)
+        else:
+            raise Exception(f'Unknown job {job}')
+    t = time.perf_counter() - t0
+    cpu1, rss = usage()
+    queue.put({'job': job, 'mode': mode, 'symbols': len(stk_list), 'loops': N_loops,
+               'sym_per_s': len(stk_list) * N_loops / t,
+               'p50_cycle': np.percentile(cycle_list, 50), 'p99_cycle': np.percentile(cycle_list, 99),
+               'cpu_s': cpu1 - cpu0, 'peak_rss_mb': rss})
+    return
+
+
+def run_bench(jobs=('DCsnap', 'AK1T', 'EF1T', 'EF1D'), modes=('thread', 'process'),
+              N_symbols=100, N_workers=16, N_loops=3, payload_dir=None,
+              latency=0.02, jitter=0.02, error_rate=0.0):
+    '''每个(job, mode)组合在独立进程中运行，返回结果的df'''
+    server = FakeQuoteServer(payload_dir, latency, jitter, error_rate).start()
+    stk_list = bench_universe(N_symbols)
+    rst_list = []
+    try:
+        for job in jobs:
+            for mode in modes:
+                queue = mp.Queue()
+                p = mp.Process(target=_run_case,
+                               args=(job, mode, stk_list, server.base_url, N_workers, N_loops, queue))
+                p.start()
+                p.join()
+                if queue.empty():
+                    print(f'\tError of {job} {mode}, exitcode {p.exitcode}.')
+                    continue
+                rst = queue.get()
+                print(f"{job:6s} {mode:7s} {rst['sym_per_s']:8.1f} sym/s  p50 {rst['p50_cycle']:.3f}s"
+                      f"  p99 {rst['p99_cycle']:.3f}s  cpu {rst['cpu_s']:.1f}s  rss {rst['peak_rss_mb']:.0f}MB")
+                rst_list.append(rst)
+    finally:
+        server.stop()
+    return pd.DataFrame(rst_list), server.n_requests, server.n_errors
+
+
+#%% main
+if __name__ == '__main__':
+    df, n_req, n_err = run_bench(N_symbols=100, N_workers=16, N_loops=3,
+                                 latency=0.02, jitter=0.03, error_rate=0.01)
+    print(df)
+    print(f'{n_req} requests served, {n_err} errors injected.')
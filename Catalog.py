@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+存储的目录(catalog)：每个分区(day, stk_str)的行数、最早/最晚时间、字节数以及crc32
+保存在{db_dir}/catalog.db(sqlite)中，由各个api的写入方法维护，
+加载、增量更新以及backfill可以直接查询，不需要逐个文件stat或者读取
+
+crc32为文件内容的crc，追加写入时在原crc上继续计算，与整个文件的crc32一致
+不需要按日期分区的存储(日线等)day为''
+
+@author: yhzhang
+"""
+import os
+import time
+import zlib
+import atexit
+import weakref
+import sqlite3
+import threading
+import pandas as pd
+from io import BytesIO
+from pathlib import Path
+
+
+#%% catalog
+def _min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS partitions (
+    day TEXT NOT NULL, stk_str TEXT NOT NULL, rows INTEGER, t_min TEXT, t_max TEXT,
+    bytes INTEGER, crc INTEGER, updated REAL, PRIMARY KEY (day, stk_str))'''
+_META = 'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+_COLS = ('day', 'stk_str', 'rows', 't_min', 't_max', 'bytes', 'crc', 'updated')
+_UPSERT = f'INSERT OR REPLACE INTO partitions VALUES ({",".join("?"*len(_COLS))})'
+_INSTANCES = weakref.WeakSet() #退出时写入全部未flush的记录，不阻止实例被回收
+
+@atexit.register
+def _flush_all():
+    for catalog in list(_INSTANCES):
+        try:
+            catalog.flush()
+        except Exception as e:
+            print(repr(e))
+            print(f'\tError of flushing {catalog.fn}.')
+    return
+
+class Catalog:
+
+    def __init__(self, db_dir, name='catalog.db', flush_n=256, flush_s=5):
+        '''待写入的记录达到flush_n条或者距上次写入超过flush_s秒时写入sqlite'''
+        self.db_dir = Path(db_dir)
+        self.fn = self.db_dir.joinpath(name)
+        self.flush_n = flush_n
+        self.flush_s = flush_s
+        self._init_local()
+
+    def _init_local(self):
+        self.conn = None
+        self.lock = threading.RLock()
+        self.state = {} #key=(day, stk_str), 本进程写入的最新记录(list)，追加写入时在此基础上更新
+        self.dirty = set()
+        self.suspect = set() #写入出错的key，下次追加前重新与文件大小对比
+        self.t_flush = time.time()
+        _INSTANCES.add(self)
+
+    def __del__(self):
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+    def __getstate__(self):
+        '''进程池pickle时不传递连接与锁，子进程中重新连接'''
+        self.flush()
+        dct = self.__dict__.copy()
+        for k in ('conn', 'lock', 'state', 'dirty', 'suspect', 't_flush'):
+            dct.pop(k)
+        return dct
+
+    def __setstate__(self, dct):
+        self.__dict__.update(dct)
+        self._init_local()
+
+    def connect(self):
+        if self.conn is None:
+            self.db_dir.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.fn, timeout=30, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL') #多进程同时写入
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(_SCHEMA)
+            self.conn.execute(_META)
+        return self.conn
+
+    #写入
+    def write_csv(self, fn, df, day, stk_str, mode='w', time_col='timeindex',
+                  encoding='utf-8', **kwargs):
+        '''
+        df.to_csv写入fn并更新记录，mode='a'时追加写入(不写header)
+        先在内存中编码，字节数与crc32不需要再读取文件
+        追加时本进程内存中的记录直接使用，不访问文件系统；
+        记录来自sqlite/文件(其他进程可能写入过)或者上次写入出错时，与文件大小对比，不一致则重新读取文件
+        '''
+        key = (day, stk_str)
+        header = kwargs.pop('header', mode != 'a')
+        data = df.to_csv(header=header, **kwargs).encode(encoding)
+        old = None
+        if mode == 'a':
+            with self.lock:
+                old = self.state.get(key)
+                trusted = old is not None and key not in self.suspect
+                if not trusted:
+                    old = self.get_state(fn, key, time_col, encoding)
+            if not trusted and old is not None:
+                try:
+                    size = os.stat(fn).st_size
+                except FileNotFoundError:
+                    size = 0
+                if old[5] != size:
+                    old = self.scan_file(fn, day, stk_str, time_col, encoding) if size > 0 else None
+        try:
+            with open(fn, mode + 'b') as f:
+                f.write(data)
+        except Exception:
+            with self.lock:
+                self.suspect.add(key)
+            raise
+        self.record(day, stk_str, df, data, old, time_col)
+        with self.lock:
+            self.suspect.discard(key)
+        return
+
+    def record(self, day, stk_str, df, data, old=None, time_col='timeindex'):
+        '''data为写入的bytes，df为对应的数据，old为追加写入之前的记录'''
+        key = (day, stk_str)
+        t = df[time_col] if time_col in df.columns and len(df) > 0 else None
+        t_min = None if t is None else str(t.min())
+        t_max = None if t is None else str(t.max())
+        if old is None:
+            item = [day, stk_str, len(df), t_min, t_max, len(data), zlib.crc32(data)]
+        else:
+            item = [day, stk_str, old[2] + len(df), _min(old[3], t_min), _max(old[4], t_max),
+                    old[5] + len(data), zlib.crc32(data, old[6])]
+        with self.lock:
+            self.state[key] = item + [time.time()]
+            self.dirty.add(key)
+            if len(self.dirty) >= self.flush_n or time.time() - self.t_flush > self.flush_s:
+                self.flush()
+        return
+
+    def get_state(self, fn, key, time_col, encoding):
+        '''追加写入前文件的记录：内存 -> sqlite -> 读取文件(catalog建立之前就存在的文件)'''
+        if key in self.state:
+            return self.state[key]
+        row = self.connect().execute('SELECT * FROM partitions WHERE day=? AND stk_str=?',
+                                     key).fetchone()
+        if row is not None:
+            return list(row)
+        fn = Path(fn)
+        if not fn.exists():
+            return None
+        return self.scan_file(fn, key[0], key[1], time_col, encoding)[:-1]
+
+    def scan_file(self, fn, day, stk_str, time_col='timeindex', encoding='utf-8'):
+        '''读取已有文件得到记录'''
+        with open(fn, 'rb') as f:
+            data = f.read()
+        return self.scan_bytes(data, day, stk_str, time_col, encoding)
+
+    def scan_bytes(self, data, day, stk_str, time_col='timeindex', encoding='utf-8', header=b''):
+        '''由csv的bytes得到记录，header不为空时data为不含表头的追加部分'''
+        try:
+            t = pd.read_csv(BytesIO(header + data), usecols=[time_col], dtype=str, 
+                            encoding=encoding, engine='c')[time_col]
+            n, t_min, t_max = len(t), t.min(), t.max()
+        except UnicodeDecodeError: #encoding不对时报错，不当作没有time_col
+            raise
+        except ValueError: #没有time_col
+            n, t_min, t_max = max(data.count(b'\n') - (0 if header else 1), 0), None, None
+        return [day, stk_str, n, t_min, t_max, len(data), zlib.crc32(data), time.time()]
+
+    def write_bytes(self, fn, day, stk_str, data, offset=0, time_col='timeindex', encoding='utf-8'):
+        '''
+        把其他进程/主机写好的文件内容写入fn，offset>0时data为offset之后的部分(追加或者覆盖尾部)
+        用于合并分片采集的输出，追加时只解析新的行
+        '''
+        fn = Path(fn)
+        key = (day, stk_str)
+        with self.lock:
+            old = self.get_state(fn, key, time_col, encoding) if offset > 0 else None
+        with open(fn, 'r+b' if offset > 0 else 'wb') as f:
+            f.seek(offset)
+            f.write(data)
+            f.truncate()
+        if old is None or old[5] != offset: #记录与文件不一致时重新读取整个文件
+            item = self.scan_file(fn, day, stk_str, time_col, encoding) if offset > 0 else \
+                self.scan_bytes(data, day, stk_str, time_col, encoding)
+        else:
+            with open(fn, 'rb') as f:
+                header = f.readline()
+            new = self.scan_bytes(data, day, stk_str, time_col, encoding, header)
+            item = [day, stk_str, old[2] + new[2], _min(old[3], new[3]), _max(old[4], new[4]),
+                    offset + len(data), zlib.crc32(data, old[6]), time.time()]
+        with self.lock:
+            self.state[key] = item
+            self.dirty.add(key)
+            if len(self.dirty) >= self.flush_n or time.time() - self.t_flush > self.flush_s:
+                self.flush()
+        return
+
+    def upsert(self, rows):
+        with self.lock:
+            conn = self.connect()
+            conn.executemany(_UPSERT, rows)
+            conn.commit()
+        return
+
+    def flush(self):
+        with self.lock:
+            if len(self.dirty) > 0:
+                self.upsert([tuple(self.state[k]) for k in self.dirty])
+                self.dirty.clear()
+            self.t_flush = time.time()
+        return
+
+    def rebuild(self, suffix='.csv', time_col='timeindex', encoding='utf-8'):
+        '''
+        扫描db_dir建立catalog，用于catalog之前已有的存储
+        {db_dir}/{day}/{stk_str}{suffix}以及{db_dir}/{stk_str}{suffix}(day为'')
+        '''
+        n = 0
+        for fn in self.db_dir.iterdir():
+            if fn.is_dir() and len(fn.name) == 10:
+                fn_list = [(x, fn.name) for x in fn.iterdir() if x.name.endswith(suffix)]
+            elif fn.name.endswith(suffix):
+                fn_list = [(fn, '')]
+            else:
+                continue
+            rows = [tuple(self.scan_file(x, day, x.name[:-len(suffix)], time_col, encoding))
+                    for x,day in fn_list]
+            self.upsert(rows)
+            n += len(rows)
+        return n
+
+    def ensure_built(self, suffix='.csv', time_col='timeindex', encoding='utf-8'):
+        '''
+        catalog第一次用于查询缺失时，把catalog建立之前已有的文件(全部日期目录)补充记录，只运行一次，
+        之后的查询只读sqlite；文件被外部修改后需要显式调用reconcile/rebuild
+        '''
+        with self.lock:
+            row = self.connect().execute("SELECT value FROM meta WHERE key='built'").fetchone()
+        if row is not None:
+            return 0
+        day_list = sorted(x.name for x in self.db_dir.iterdir() if x.is_dir() and len(x.name) == 10) \
+            if self.db_dir.exists() else []
+        n = self.reconcile(day_list, suffix, time_col, encoding)
+        with self.lock:
+            conn = self.connect()
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('built', ?)", (str(time.time()),))
+            conn.commit()
+        return n
+
+    def reconcile(self, day_list, suffix='.csv', time_col='timeindex', encoding='utf-8'):
+        '''
+        维护用：day_list中每个日期目录的文件与catalog对比，catalog中没有记录的文件
+        扫描后补充记录，返回补充的数量；只对比文件名，不读取已有记录的文件
+        encoding需要与存储一致(EF/DC为gbk)
+        '''
+        self.flush()
+        n = 0
+        for day in day_list:
+            day_dir = self.db_dir.joinpath(day)
+            if not day_dir.is_dir():
+                continue
+            files = {x.name[:-len(suffix)]: x for x in day_dir.iterdir() if x.name.endswith(suffix)}
+            with self.lock:
+                rows = self.connect().execute('SELECT stk_str FROM partitions WHERE day=?',
+                                              (day,)).fetchall()
+            new = set(files) - {r[0] for r in rows}
+            if new:
+                self.upsert([tuple(self.scan_file(files[k], day, k, time_col, encoding))
+                             for k in sorted(new)])
+                n += len(new)
+        return n
+
+    #查询
+    def query(self, day=None, stk_str=None):
+        '''返回满足条件的记录df，None为不限制'''
+        self.flush()
+        sql = 'SELECT * FROM partitions'
+        cond = [f'{k}=?' for k,v in (('day', day), ('stk_str', stk_str)) if v is not None]
+        args = [v for v in (day, stk_str) if v is not None]
+        if cond:
+            sql += ' WHERE ' + ' AND '.join(cond)
+        with self.lock:
+            rows = self.connect().execute(sql + ' ORDER BY day, stk_str', args).fetchall()
+        return pd.DataFrame(rows, columns=list(_COLS))
+
+    def empty(self):
+        self.flush()
+        with self.lock:
+            return self.connect().execute('SELECT 1 FROM partitions LIMIT 1').fetchone() is None
+
+    def days(self):
+        self.flush()
+        with self.lock:
+            rows = self.connect().execute('SELECT DISTINCT day FROM partitions ORDER BY day').fetchall()
+        return [r[0] for r in rows]
+
+    def has(self, day, stk_str):
+        with self.lock:
+            if (day, stk_str) in self.state:
+                return True
+            row = self.connect().execute('SELECT 1 FROM partitions WHERE day=? AND stk_str=?',
+                                         (day, stk_str)).fetchone()
+        return row is not None
+
+    def last_time(self, stk_str):
+        '''stk_str所有分区中最晚的时间，没有记录时为None'''
+        self.flush()
+        with self.lock:
+            row = self.connect().execute('SELECT MAX(t_max) FROM partitions WHERE stk_str=?',
+                                         (stk_str,)).fetchone()
+        return row[0]
+
+    def matrix(self, stk_iter, day_list):
+        '''(day x stk_str)的bool矩阵，True为catalog中有记录'''
+        stk_list = list(stk_iter)
+        day_list = list(day_list)
+        self.flush()
+        with self.lock:
+            rows = self.connect().execute(
+                f'SELECT day, stk_str FROM partitions WHERE day IN ({",".join("?"*len(day_list))})',
+                day_list).fetchall()
+        have = set(rows)
+        arr = [[(d, stk_str) in have for stk_str in stk_list] for d in day_list]
+        return pd.DataFrame(arr, index=day_list, columns=stk_list, dtype=bool)
+
+    def missing(self, stk_iter, day_list):
+        '''返回{stk_str: [缺失的day_str, ...]}'''
+        mat = self.matrix(stk_iter, day_list)
+        rst = {}
+        for stk_str in mat.columns[~mat.values.all(axis=0)]:
+            rst[stk_str] = list(mat.index[~mat[stk_str].values])
+        return rst
+
+    def verify(self, fn, day, stk_str):
+        '''文件的字节数与crc32是否与记录一致'''
+        df = self.query(day, stk_str)
+        if len(df) == 0:
+            return False
+        with open(fn, 'rb') as f:
+            data = f.read()
+        return len(data) == df['bytes'].iat[0] and zlib.crc32(data) == df['crc'].iat[0]
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+可以中断后继续的批量补数据：完成的(stk_str, 区间)单元记录在{db_dir}/checkpoint.db(sqlite)
+    每个单元完成后立即提交，进程中断或者线程出错后重新运行只处理没有完成的单元
+    失败的单元记录次数与错误，超过max_attempts次后不再重试(reset可以清除)
+    Throttle限制请求速率，交易时段内使用更低的live_rate，与实时采集同时在后台运行
+
+单元的key为字符串，例如日线'sz128106|20210101|20230101|0'，分钟'sz128106|2022-09-01'
+
+@author: yhzhang
+"""
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from Metrics import inc
+
+
+#%% checkpoint
+_SKIPPED = object() #stop之后没有运行的单元
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS units (
+    job TEXT NOT NULL, unit TEXT NOT NULL, status TEXT, attempts INTEGER, info TEXT, updated REAL,
+    PRIMARY KEY (job, unit))'''
+
+class Checkpoint:
+
+    def __init__(self, fn):
+        self.fn = Path(fn)
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            self.fn.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.fn, timeout=30, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(_SCHEMA)
+        return self.conn
+
+    def __getstate__(self):
+        return {'fn': self.fn}
+
+    def __setstate__(self, dct):
+        self.__init__(dct['fn'])
+
+    def pending(self, job, units, max_attempts=3):
+        '''units中没有完成且失败次数少于max_attempts的单元，保持units的顺序'''
+        with self.lock:
+            rows = self.connect().execute(
+                'SELECT unit, status, attempts FROM units WHERE job=?', (job,)).fetchall()
+        skip = {u for u,status,n in rows if status == 'done' or n >= max_attempts}
+        return [u for u in units if u not in skip]
+
+    def done(self, job, unit, info=''):
+        with self.lock:
+            conn = self.connect()
+            conn.execute('INSERT OR REPLACE INTO units VALUES (?,?,?,COALESCE((SELECT attempts FROM '
+                         'units WHERE job=? AND unit=?), 0) + 1,?,?)',
+                         (job, unit, 'done', job, unit, str(info), time.time()))
+            conn.commit()
+        return
+
+    def failed(self, job, unit, err):
+        with self.lock:
+            conn = self.connect()
+            conn.execute('INSERT OR REPLACE INTO units VALUES (?,?,?,COALESCE((SELECT attempts FROM '
+                         'units WHERE job=? AND unit=?), 0) + 1,?,?)',
+                         (job, unit, 'failed', job, unit, repr(err)[:200], time.time()))
+            conn.commit()
+        return
+
+    def progress(self, job):
+        '''{status: 单元数}'''
+        with self.lock:
+            rows = self.connect().execute('SELECT status, COUNT(*) FROM units WHERE job=? '
+                                          'GROUP BY status', (job,)).fetchall()
+        return dict(rows)
+
+    def reset(self, job, failed_only=True):
+        '''清除失败的记录(failed_only=False时清除全部)，下次重新运行'''
+        with self.lock:
+            conn = self.connect()
+            if failed_only:
+                conn.execute("DELETE FROM units WHERE job=? AND status='failed'", (job,))
+            else:
+                conn.execute('DELETE FROM units WHERE job=?', (job,))
+            conn.commit()
+        return
+
+
+#%% throttle
+class Throttle:
+
+    def __init__(self, rate=None, live_rate=None, calendar=None):
+        '''
+        rate为每秒的单元数(None为不限制)，calendar不为None且在交易时段内时使用live_rate
+        多个线程共用，按时间间隔发放
+        '''
+        self.rate = rate
+        self.live_rate = rate if live_rate is None else live_rate
+        self.calendar = calendar
+        self.t_next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def current(self):
+        if self.calendar is not None and self.calendar.in_session():
+            return self.live_rate
+        return self.rate
+
+    def wait(self):
+        rate = self.current()
+        if rate is None or rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            t = max(self.t_next, now)
+            self.t_next = t + 1 / rate
+        if t > now:
+            time.sleep(t - now)
+        return
+
+
+#%% runner
+def run_resumable(job, units, func, checkpoint, N_workers=4, throttle=None, max_attempts=3,
+                  stop=None, name=''):
+    '''
+    对checkpoint中没有完成的units运行func(unit)，func的返回值记录在info中
+    stop为threading.Event，set之后不再开始新的单元(已经开始的完成后记录)
+    return: 本次完成的单元数
+    '''
+    todo = checkpoint.pending(job, units, max_attempts)
+    print(f'{job}: {len(units) - len(todo)} of {len(units)} units done or given up, {len(todo)} to run.')
+    if len(todo) == 0:
+        return 0
+
+    def task(unit):
+        if stop is not None and stop.is_set():
+            return _SKIPPED
+        if throttle is not None:
+            throttle.wait()
+            if stop is not None and stop.is_set():
+                return _SKIPPED
+        return func(unit)
+
+    n = 0
+    with ThreadPoolExecutor(max_workers=N_workers) as p:
+        futures = {p.submit(task, unit): unit for unit in todo}
+        for i,future in enumerate(as_completed(futures)):
+            unit = futures[future]
+            try:
+                info = future.result()
+            except Exception as e:
+                inc('task_errors', name)
+                checkpoint.failed(job, unit, e)
+                print(repr(e))
+                print(f'\tError of No.{i} {unit}.')
+                continue
+            if info is _SKIPPED:
+                continue
+            checkpoint.done(job, unit, info)
+            n += 1
+            print(f'\rNo.{i:4d} {unit} done.', end='')
+    print()
+    return n
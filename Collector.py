@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+常驻的数据采集进程：按job配置依次运行各个采集任务
+session、代码表、api实例以及线程池在job之间复用，开盘前预先建立连接
+非交易日不运行(job设置"trading_only": false除外)，设置了end的循环job只在交易时段内请求
+设置了hedge时，snap与分钟trends的慢请求同时发给镜像host(见Hedge.py)
+DCsnap设置了ring时，snap同时发布到共享内存(见SnapRing.py)，close时删除
+job没有设置universe时，EF接口(EFbill/EFbillD/EF1T/EF1D)使用cb(不带交易所的代码)，其余使用cbse
+
+配置文件(json)示例:
+{
+    "jisilu": "../VSWS/jisilu/2022-09-01",
+    "N_thread": 16,
+    "preconnect": 60,
+    "calendar": "./calendar.csv",
+    "hedge": {"q": 0.95, "max_ratio": 0.1},
+    "jobs": [
+        {"job": "DCsnap", "universe": "cbse", "db_dir": "./DCsnap",
+         "start": "09:30:00", "end": "15:00:00", "interval": 3,
+         "ring": {"name": "cbsnap", "n_slots": 1024}},
+        {"job": "EF1T", "universe": "cb", "db_dir": "./EF1T", "pkl_prfx": "cb",
+         "start": "15:05:00", "N_loops": 1}
+    ]
+}
+使用方法: python Collector.py collector.json
+
+@author: yhzhang
+"""
+import sys
+import json
+import time
+import importlib
+import datetime as dtm
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from AuxFunc import t_now, bare_code_vec
+from MultiTask import mp_thread, load_universe
+from TradeCalendar import TradingCalendar
+from Hedge import enable_hedging
+
+
+#%% job的定义：(模块名, 类名, multi方法名)，模块在第一次使用时才导入
+JOB_SPECS = {'AK1T': ('AKapi', 'AKminute', 'save_minute_multi'),
+             'EF1T': ('EFapi', 'EFminute', 'save_minute_multi'),
+             'EF1D': ('EFapi', 'EFdaily', 'save_daily_multi'),
+             'EFbill': ('EFapi', 'EFbill', 'save_today_multi'),
+             'EFbillD': ('EFapi', 'EFbill', 'save_history_multi'),
+             'DCsnap': ('DCapi', 'DCsnap', 'save_snap_multi')}
+
+#job没有设置universe时使用的代码表，资金流向的接口使用不带交易所的代码
+JOB_UNIVERSE = {'EFbill': 'cb', 'EFbillD': 'cb', 'EF1T': 'cb', 'EF1D': 'cb'}
+DEFAULT_UNIVERSE = 'cbse'
+
+#各个api使用的host，preconnect时预先建立连接
+PRECONNECT_URLS = {'AKapi': ['https://push2.eastmoney.com/', 'https://push2his.eastmoney.com/'],
+                   'EFapi': ['https://push2his.eastmoney.com/', 'http://push2.eastmoney.com/'],
+                   'DCapi': ['http://push2.eastmoney.com/']}
+#实际发送请求的session所在的模块，没有列出的为api模块本身
+#AKapi通过akshare请求，分钟数据使用修改后的bond_zh_cov_sina.py中的session
+PRECONNECT_SESSIONS = {'AKapi': 'akshare.bond.bond_zh_cov_sina'}
+
+
+def wait_until(t_str, ahead=0):
+    '''sleep到今天的t_str(HH:MM:SS)之前ahead秒，已经过了则立即返回'''
+    t = dtm.datetime.combine(dtm.date.today(), dtm.time.fromisoformat(t_str))
+    dt = (t - dtm.datetime.now()).total_seconds() - ahead
+    if dt > 0:
+        time.sleep(dt)
+    return
+
+def before(t_str):
+    if t_str is None:
+        return True
+    return dtm.datetime.now().time() < dtm.time.fromisoformat(t_str)
+
+
+#%% collector
+class Collector:
+
+    def __init__(self, config):
+        '''config为dict或者json文件路径'''
+        if not isinstance(config, dict):
+            with open(config, encoding='utf-8') as f:
+                config = json.load(f)
+        self.config = config
+        self.N_thread = config.get('N_thread', 16)
+        self.pool = ThreadPoolExecutor(max_workers=self.N_thread) #常驻线程池
+        self.providers = {} #key=(job, db_dir)
+        self.universe = None
+        self.calendar = TradingCalendar(config.get('calendar', './calendar.csv'))
+        if config.get('hedge') is not None:
+            enable_hedging(**config['hedge'])
+
+    def get_universe(self, name):
+        '''代码表只读取一次；name可以为cb, cbse, ua, uase或者用+连接, 例如cb+ua'''
+        if self.universe is None:
+            self.universe = load_universe(self.config['jisilu'])
+        rst = []
+        for k in name.split('+'):
+            rst += self.universe[k]
+        return rst
+
+    def job_universe(self, spec):
+        '''spec的代码表，没有设置universe时按job的默认值'''
+        return self.get_universe(spec.get('universe', JOB_UNIVERSE.get(spec['job'], DEFAULT_UNIVERSE)))
+
+    def get_provider(self, job, db_dir):
+        '''api实例在job之间复用，cached以及连接池均保持'''
+        key = (job, db_dir)
+        if key not in self.providers:
+            mod_name, cls_name, _ = JOB_SPECS[job]
+            cls = getattr(importlib.import_module(mod_name), cls_name)
+            self.providers[key] = cls(db_dir)
+        return self.providers[key]
+
+    def preconnect(self, job):
+        '''
+        导入模块并在请求实际使用的session上预先建立到host的连接（DNS以及TCP/TLS握手）
+        session所在的模块没有session(例如没有安装修改后的bond_zh_cov_sina.py)时不预连接
+        '''
+        mod_name = JOB_SPECS[job][0]
+        importlib.import_module(mod_name)
+        session = getattr(importlib.import_module(PRECONNECT_SESSIONS.get(mod_name, mod_name)),
+                          'session', None)
+        if session is None:
+            print(f'\tNo session of {mod_name} to preconnect.')
+            return
+        for url in PRECONNECT_URLS.get(mod_name, []):
+            try:
+                session.head(url, timeout=3)
+            except Exception as e:
+                print(repr(e))
+                print(f'\tError of preconnect {url}.')
+        return
+
+    def build_task(self, spec):
+        '''返回(func, end_func)，func只接受一个stk_list参数'''
+        job = spec['job']
+        db_dir = spec.get('db_dir', f'./{job}')
+        obj = self.get_provider(job, db_dir)
+        method = getattr(obj, JOB_SPECS[job][2])
+        day_str = spec.get('day_str', t_now(1,0)[:10])
+        end_func = None
+        if job in ('AK1T', 'EF1T'):
+            func = partial(method, cached=True)
+            end_func = partial(obj.pickle_cache, day_str, prefix=spec.get('pkl_prfx', 'data'))
+        elif job == 'EF1D':
+            func = partial(method, ts=spec.get('ts', '20210101'), te=spec.get('te', '20230101'),
+                           fqt=spec.get('fqt', 0))
+        elif job in ('EFbill', 'EFbillD'): #每轮结束后更新资金流向矩阵
+            func = method
+            day_str = day_str if job == 'EFbill' else None
+            end_func = partial(obj.build_panel, self.job_universe(spec), day_str)
+        else:
+            func = partial(method, cached=spec.get('cached', False))
+            if job == 'DCsnap' and spec.get('ring') is not None and obj.ring is None:
+                from SnapRing import SnapRing
+                codes = bare_code_vec(self.job_universe(spec)).tolist() #与snap的code一致
+                obj.ring = SnapRing(spec['ring']['name'], codes, spec['ring'].get('n_slots', 1024))
+        return func, end_func
+
+    def run_job(self, spec):
+        '''
+        start不为None时等待到start，并提前preconnect秒建立连接
+        end不为None时在交易时段内循环运行直到end，否则运行N_loops次
+        '''
+        job = spec['job']
+        if spec.get('trading_only', True) and not self.calendar.is_trading_day():
+            print(f'{t_now(1,0)[:10]} is not a trading day, job {job} skipped.')
+            return
+        stk_list = self.job_universe(spec)
+        func, end_func = self.build_task(spec)
+        if spec.get('start') is not None:
+            wait_until(spec['start'], ahead=self.config.get('preconnect', 60))
+            self.preconnect(job)
+            wait_until(spec['start'])
+        else:
+            self.preconnect(job)
+
+        end, interval = spec.get('end'), spec.get('interval', 0)
+        N_loops = spec.get('N_loops', 1)
+        i = 0
+        while (end is not None and before(end)) or (end is None and i < N_loops):
+            if end is not None and not self.calendar.wait_session(end): #午休时sleep到13:00
+                break
+            t0 = time.time()
+            mp_thread(func, stk_list, self.N_thread, 1, end_func, executor=self.pool)
+            i += 1
+            dt = interval - (time.time() - t0)
+            if dt > 0:
+                time.sleep(dt)
+        return
+
+    def run(self):
+        for spec in self.config['jobs']:
+            try:
+                self.run_job(spec)
+            except Exception as e:
+                print(repr(e))
+                print(f"\tError of job {spec.get('job')}.")
+        return
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        for obj in self.providers.values():
+            if getattr(obj, 'ring', None) is not None:
+                obj.ring.close()
+                obj.ring = None
+        return
+
+
+#%% main
+if __name__ == '__main__':
+    collector = Collector(sys.argv[1] if len(sys.argv) > 1 else './collector.json')
+    collector.run()
+    collector.close()
@@ -11,14 +11,31 @@ import time
 import datetime as dtm
 import requests
 
-from AuxFunc import t_now, add_cbse, add_uase, formal_day
+from functools import partial
+from AuxFunc import t_now, add_cbse, add_uase, formal_day, read_csv_typed
+from LoadCache import cache_key, cached_read
+from Metrics import timed_get, timer, inc, observe
+from Hedge import hedged_get
+from Pipeline import DirCache, run_pipeline, group_by_dir
+from Catalog import Catalog
+from TradeCalendar import TradingCalendar
 
 #%%
+#keep-alive的session，多个线程共用连接池，常驻进程中连接保持warm
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=64)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+
 def dc_get_snap(symbol):
     '''
     symbol同时支持可转债与股票的盘口数据，输入格式为: sz128106, sh600036
     return: dict格式的数据
     '''
+    return dc_parse_snap(dc_fetch_snap(symbol))
+
+def dc_fetch_snap(symbol):
+    '''只进行网络请求，返回requests的response'''
     market_type = {"sh": "1", "sz": "0"}
     params = {
         "fltt": '2',
@@ -34,7 +51,12 @@ def dc_get_snap(symbol):
     }
     url = 'http://push2.eastmoney.com/api/qt/stock/get'
 
-    resp = requests.get(url, params)
+    resp = hedged_get(session.get, url, params=params) #启用对冲时慢请求同时发给镜像host
+    return resp
+
+def dc_parse_snap(resp):
+    '''把dc_fetch_snap的response解析为dict'''
+    t0 = time.perf_counter()
     # data = json.loads(resp.text)['data']
     data = resp.json()['data']
     
@@ -69,17 +91,75 @@ def dc_get_snap(symbol):
         else:
             rst[k] = typ(v)
     rst['amount'] = np.round(rst['amount']/10000, 2)
+    observe('parse', 'push2.eastmoney.com', time.perf_counter() - t0)
     return rst
 
 
+#%% 盘口的差分编码
+'''文件中kf=1的行为完整的盘口(关键帧)，kf=0的行的盘口价量为相对上一行的差分
+新文件、进程重启后的第一行均为关键帧，缺失的档位价格记为0
+追加写入时按已有文件的header：没有kf列的旧文件写入完整的行，delta=False写入有kf列的文件时为关键帧'''
+BOOK_COLS = [f'{typ}{i}{pv}' for typ in ['ask', 'bid'] for i in range(1,6) for pv in ['p', 'v']]
+
+def book_values(rst):
+    '''盘口的价量list，nan的价格记为0'''
+    return [0.0 if (k[-1] == 'p' and np.isnan(rst[k])) else rst[k] for k in BOOK_COLS]
+
+def encode_book(rst, book, last_book):
+    '''返回写入文件的行，last_book为None时为关键帧'''
+    row = dict(rst)
+    if last_book is None:
+        row.update(zip(BOOK_COLS, book))
+        row['kf'] = 1
+    else:
+        for k,v,lv in zip(BOOK_COLS, book, last_book):
+            row[k] = round(v - lv, 3) if k[-1] == 'p' else int(v - lv)
+        row['kf'] = 0
+    return row
+
+def read_snap(fn, columns=None):
+    '''读取snap文件并还原盘口，columns不为None时附带读取kf列用于解码'''
+    if columns is not None:
+        columns = list(columns) + ['kf']
+    df = read_csv_typed(fn, columns, encoding='gbk')
+    return decode_book(df)
+
+def decode_book(df):
+    '''按关键帧分段累加还原盘口，没有kf列的旧文件原样返回'''
+    if 'kf' not in df.columns:
+        return df
+    cols = [k for k in BOOK_COLS if k in df.columns]
+    seg = df['kf'].cumsum()
+    book = df[cols].groupby(seg).cumsum()
+    for k in cols:
+        if k[-1] == 'p':
+            v = book[k].round(3)
+            df[k] = v.where(v != 0, np.nan)
+        else:
+            df[k] = book[k].astype(np.int64)
+    return df.drop(columns='kf')
+
+
 #%%
 #### 东方财富网，实时买卖五档盘口的数据，3S频率
 class DCsnap:
     
-    def __init__(self, db_dir):
-        '''数据库文件存储路径db_dir'''
+    def __init__(self, db_dir, cache=None, delta=True, ring=None):
+        '''
+        数据库文件存储路径db_dir, cache为LoadCache实例时load_snap使用读取缓存
+        delta=True时交易所时间没有更新的snap不写入，盘口按差分编码存储
+        ring为SnapRing实例时新的snap同时发布到共享内存
+        '''
         self.db_dir = Path(db_dir)
         self.cached = {} #key=股票代码（str, no-SE格式）
+        self.cache = cache
+        self.delta = delta
+        self.ring = ring
+        self.last_state = {} #key=stk_str, (snap的内容, 盘口价量list)
+        self.headers = {} #key=fn, 已有文件的列名list
+        self.need_kf = set() #写入失败的stk_str，下一次写入的第一行为关键帧
+        self.dirs = DirCache()
+        self.catalog = Catalog(self.db_dir) #写入时记录每个(day, stk_str)的行数、时间范围以及crc
     
     def get_snap(self, stk_str):
         '''获取可转债的盘口数据'''
@@ -96,21 +176,123 @@ class DCsnap:
     def save_snap(self, stk_str, cached=False):
         '''保存到本地的文件中，同时可选是否保存到self.cached中'''
         rst = dc_get_snap(stk_str)
+        row = self.prepare_row(stk_str, rst, cached)
+        if row is not None:
+            with timer('persist', self.db_dir.name):
+                self.write_snaps(self.snap_fn(stk_str, rst), stk_str, [(rst, row)])
+        return rst
+    
+    def snap_fn(self, stk_str, rst):
+        return self.db_dir.joinpath(rst['timeindex'][0:10], f'{stk_str}.csv')
+    
+    def reset(self, stk_str):
+        '''文件被外部替换(例如分片换手)后清除stk_str的状态，下一行为关键帧并重新读取header'''
+        self.last_state.pop(stk_str, None)
+        self.need_kf.discard(stk_str)
+        for fn in [fn for fn in self.headers if fn.stem == stk_str]:
+            self.headers.pop(fn, None)
+            self.dirs.discard(fn)
+        return
+
+    def get_header(self, fn):
+        '''已有文件的列名list，文件不存在时为None'''
+        if not self.dirs.exists(fn):
+            self.headers.pop(fn, None)
+            return None
+        if fn not in self.headers:
+            if len(self.headers) > 20000: #只是缓存，过多时清空重新读取
+                self.headers.clear()
+            with open(fn, encoding='gbk') as f:
+                self.headers[fn] = f.readline().rstrip('\r\n').split(',')
+        return self.headers[fn]
+    
+    def prepare_row(self, stk_str, rst, cached=False):
+        '''返回需要写入文件的行，与上一个snap相比没有变化时返回None'''
+        last = self.last_state.get(stk_str)
+        book = book_values(rst)
+        state = (rst['timeindex'], rst['volume'], rst['amount'], rst['last'], tuple(book))
+        if self.delta and last is not None and last[0] == state:
+            inc('snap_dup', self.db_dir.name) #交易所时间(f86)、成交与盘口都没有更新，不重复写入
+            return None
         if cached:
-            k = rst['code']
-            self.cached.setdefault(k, [])
-            self.cached[k].append(rst)
-
-        day = rst['timeindex'][0:10]
-        fn_dir = self.db_dir.joinpath(f'{day}')
-        if not fn_dir.exists():
-            fn_dir.mkdir(parents=True)
-        fn = fn_dir.joinpath(f'{stk_str}.csv')
-        if not fn.exists():
-            pd.DataFrame(rst, index=[0]).to_csv(fn, encoding='gbk', index=False)
+            self.cached.setdefault(rst['code'], []).append(rst)
+        if self.ring is not None:
+            self.ring.publish(rst)
+        header = self.get_header(self.snap_fn(stk_str, rst))
+        if header is not None and 'kf' not in header: #旧格式的文件，写入完整的行
+            row = rst
+        elif self.delta:
+            row = encode_book(rst, book, None if last is None or header is None else last[1])
+        elif header is not None: #delta=False追加到差分编码的文件，完整的行为关键帧
+            row = encode_book(rst, book, None)
+        else:
+            row = rst
+        self.last_state[stk_str] = (state, book)
+        return row
+    
+    def write_snaps(self, fn, stk_str, items):
+        '''
+        items为[(rst, row), ...]，写入失败时之前的差分基准没有写入文件：
+        去掉last_state(相同的snap不会被当作重复)，下一次写入的第一行改为关键帧，
+        之后已经按差分编码的行相对的是这个关键帧，可以正确还原
+        '''
+        rows = [row for rst,row in items]
+        if stk_str in self.need_kf and 'kf' in rows[0]:
+            rst = items[0][0]
+            rows[0] = encode_book(rst, book_values(rst), None)
+        try:
+            self.write_rows(fn, rows)
+        except Exception:
+            self.need_kf.add(stk_str)
+            self.last_state.pop(stk_str, None)
+            raise
+        self.need_kf.discard(stk_str)
+        return
+
+    def write_rows(self, fn, rows):
+        '''写入同一个文件的多行，文件不存在时写入header，追加时按已有文件的列顺序'''
+        self.dirs.ensure(fn.parent)
+        header = self.get_header(fn)
+        if header is None:
+            df = pd.DataFrame(rows)
+            self.catalog.write_csv(fn, df, fn.parent.name, fn.stem, encoding='gbk', index=False)
+            self.dirs.add(fn)
+            self.headers[fn] = list(df.columns)
         else: #追加模式进行数据录入
-            pd.DataFrame(rst, index=[0]).to_csv(fn, encoding='gbk', mode='a', index=False, header=False)
-        return rst
+            df = pd.DataFrame(rows, columns=header)
+            self.catalog.write_csv(fn, df, fn.parent.name, fn.stem, mode='a', encoding='gbk', 
+                                   index=False)
+        return
+    
+    def save_snap_pipe(self, stk_iter, N_fetch=16, cached=False, N_parse=1, N_write=1):
+        '''
+        fetch/parse/persist分为三个stage的流水线，stage之间为有界队列
+        writer按日期目录分批写入，同一文件的多行合并为一次写入
+        '''
+        def parse(stk_str, resp):
+            rst = dc_parse_snap(resp)
+            return (rst, self.prepare_row(stk_str, rst, cached))
+
+        def write(batch):
+            batch = [(stk_str, rst, row) for stk_str,(rst, row) in batch if row is not None]
+            errors = []
+            with timer('persist', self.db_dir.name):
+                for day_dir,lst in group_by_dir(batch, lambda x: self.snap_fn(x[0], x[1])).items():
+                    self.dirs.ensure(day_dir)
+                    fn_items = {}
+                    for fn,(stk_str, rst, row) in lst:
+                        fn_items.setdefault((fn, stk_str), []).append((rst, row))
+                    for (fn, stk_str),items in fn_items.items(): #一个文件失败不影响其他文件
+                        try:
+                            self.write_snaps(fn, stk_str, items)
+                        except Exception as e:
+                            errors.append(e)
+            if errors:
+                raise errors[0]
+            return
+
+        return run_pipeline(stk_iter, dc_fetch_snap, parse, write, N_fetch, N_parse, N_write,
+                            name=self.db_dir.name)
     
     def save_snap_multi(self, stk_iter, cached=False):
         '''存储含有多个stk_str的iteration'''
@@ -122,6 +304,7 @@ class DCsnap:
                 dt,lt = rst['timeindex'], rst['localtime']
                 print(f'\rNo.{i:3d} {stk_str} {dt} @ local {lt} snapdata saved.', end='') 
             except Exception as e:
+                inc('task_errors', self.db_dir.name)
                 print('\n', repr(e))
                 print(f'\tError of No.{i} {stk_str}.')
         print()
@@ -131,24 +314,148 @@ class DCsnap:
         '''存储cached中的某一只转债的多个snap数据, stk_str:128139'''
         dct = self.cached[stk_str]
         day = dct[0]['timeindex'][0:10]
-        fn_dir = self.db_dir.joinpath(f'{day}')
-        if not fn_dir.exists():
-            fn_dir.mkdir(parents=True)
+        fn_dir = self.dirs.ensure(self.db_dir.joinpath(f'{day}'))
         fn = fn_dir.joinpath(f'{stk_str}.csv')
-        pd.DataFrame(dct).to_csv(fn, encoding='gbk')
+        self.catalog.write_csv(fn, pd.DataFrame(dct), day, stk_str, encoding='gbk')
         return 
     
-    def load_snap(self, day_str, stk_str):
-        '''导入某只转债一天的snap数据, stk_str:128139'''
+    def load_snap(self, day_str, stk_str, columns=None):
+        '''导入某只转债一天的snap数据, stk_str:128139, 差分编码的盘口会被还原'''
+        day_str = formal_day(day_str)
         fn = self.db_dir.joinpath(day_str, f'{stk_str}.csv')
-        df = pd.read_csv(fn, encoding='gbk', engine='c')
+        key = cache_key(self.db_dir, stk_str, day_str, columns)
+        df = cached_read(self.cache, fn, key, partial(read_snap, fn, columns))
         return df
 
 
+#%% 逐笔成交
+#### 东方财富网，逐笔成交数据，增量获取
+DEAL_DTYPE = np.dtype([('time', '<i4'), ('price', '<f8'), ('volume', '<i4'), ('num', '<i4')]) #time为当天的秒数
 
+def parse_deal_lines(lines):
+    '''details的每行"HH:MM:SS,price,volume,num,..."向量化解析为DEAL_DTYPE的数组'''
+    arr = np.empty(len(lines), dtype=DEAL_DTYPE)
+    if len(lines) == 0:
+        return arr
+    cols = np.array([line.split(',', 4)[:4] for line in lines])
+    c = cols[:,0].astype('U8').view(np.uint32).reshape(-1, 8).astype(np.int32) - 48 #字符转数字
+    arr['time'] = (c[:,0]*10 + c[:,1])*3600 + (c[:,3]*10 + c[:,4])*60 + c[:,6]*10 + c[:,7]
+    arr['price'] = cols[:,1].astype(np.float64)
+    arr['volume'] = cols[:,2].astype(np.int32)
+    arr['num'] = cols[:,3].astype(np.int32)
+    return arr
+
+def dc_get_deal(symbol, count=1000000):
+    '''
+    获取symbol最新交易日的最后count笔成交, symbol格式为: sz128106, sh600036
+    return: DEAL_DTYPE的数组
+    '''
+    market_type = {"sh": "1", "sz": "0"}
+    params = {
+        'secid': f"{market_type[symbol[:2]]}.{symbol[2:]}",
+        'fields1': 'f1,f2,f3,f4,f5',
+        'fields2': 'f51,f52,f53,f54,f55',
+        'pos': f'-{int(count)}',
+    }
+    url = 'https://push2.eastmoney.com/api/qt/stock/details/get'
+    resp = timed_get(session.get, url, params=params)
+    t0 = time.perf_counter()
+    data = resp.json()['data']
+    arr = parse_deal_lines(data['details'] if data else [])
+    observe('parse', 'push2.eastmoney.com', time.perf_counter() - t0)
+    return arr
 
 
+class DCdeal:
+    '''
+    逐笔成交的增量采集，每个stk_str保存游标(最后一笔的time, 该秒已保存的笔数)
+    每次只请求最近window笔，窗口覆盖不到游标时扩大窗口重新请求
+    数据按DEAL_DTYPE追加写入{db_dir}/{day}/{stk_str}.bin
+    接口返回的是最新交易日的成交(响应中没有日期)，day由calendar.session_day()决定，
+    周末、节假日以及开盘之前请求时写入上一个交易日
+    '''
+    
+    def __init__(self, db_dir, window=200, calendar=None):
+        self.db_dir = Path(db_dir)
+        self.window = window
+        self.calendar = TradingCalendar() if calendar is None else calendar
+        self.windows = {} #key=stk_str, 下次请求的笔数
+        self.cursor = {} #key=(day, stk_str), (time, 该秒已保存的笔数)
+        self.dirs = DirCache()
+    
+    def deal_fn(self, day_str, stk_str):
+        return self.db_dir.joinpath(formal_day(day_str), f'{stk_str}.bin')
+    
+    def get_cursor(self, day_str, stk_str):
+        '''内存中没有游标时从文件末尾恢复，文件不存在时为None'''
+        key = (day_str, stk_str)
+        if key not in self.cursor:
+            fn = self.deal_fn(day_str, stk_str)
+            if not fn.exists() or fn.stat().st_size == 0:
+                return None
+            tail = np.memmap(fn, dtype=DEAL_DTYPE, mode='r')[-5000:]
+            t_last = int(tail['time'][-1])
+            self.cursor[key] = (t_last, int((tail['time'] == t_last).sum()))
+        return self.cursor[key]
+    
+    def new_deals(self, arr, cur, complete):
+        '''从请求的窗口中取出游标之后的成交，窗口没有覆盖游标时返回None'''
+        if cur is None:
+            return arr
+        t_last, n_last = cur
+        if not complete and (len(arr) == 0 or arr['time'][0] >= t_last):
+            return None
+        mask = arr['time'] > t_last
+        mask[np.flatnonzero(arr['time'] == t_last)[n_last:]] = True
+        return arr[mask]
+    
+    def save_deal(self, stk_str, day_str=None):
+        '''获取并追加写入新的成交，返回新增的笔数，day_str为None时为接口返回的交易日'''
+        day_str = self.calendar.session_day() if day_str is None else formal_day(day_str)
+        cur = self.get_cursor(day_str, stk_str)
+        count = self.windows.get(stk_str, self.window) if cur is not None else 1000000
+        while True:
+            arr = dc_get_deal(stk_str, count)
+            new = self.new_deals(arr, cur, len(arr) < count)
+            if new is not None:
+                break
+            inc('deal_window_miss', self.db_dir.name)
+            count *= 4
+        
+        if len(new) > 0:
+            fn = self.deal_fn(day_str, stk_str)
+            self.dirs.ensure(fn.parent)
+            with timer('persist', self.db_dir.name):
+                with open(fn, 'ab') as f:
+                    new.tofile(f)
+            t_last = int(new['time'][-1])
+            self.cursor[(day_str, stk_str)] = (t_last, int((arr['time'] == t_last).sum()))
+        self.windows[stk_str] = max(self.window, 2*len(new) + 50)
+        return len(new)
     
+    def save_deal_multi(self, stk_iter, day_str=None):
+        '''存储含有多个stk_str的iteration'''
+        for i,stk_str in enumerate(stk_iter):
+            try:
+                n = self.save_deal(stk_str, day_str)
+                print(f'\rNo.{i:3d} {stk_str} {n:5d} new deals saved.', end='')
+            except Exception as e:
+                inc('task_errors', self.db_dir.name)
+                print('\n', repr(e))
+                print(f'\tError of No.{i} {stk_str}.')
+        print()
+        return 
+    
+    def load_deal(self, day_str, stk_str):
+        '''读取一天的逐笔成交，timeindex为datetime'''
+        day_str = formal_day(day_str)
+        arr = np.fromfile(self.deal_fn(day_str, stk_str), dtype=DEAL_DTYPE)
+        df = pd.DataFrame(arr)
+        df.insert(0, 'timeindex', pd.Timestamp(day_str) + pd.to_timedelta(arr['time'], unit='s'))
+        return df
+
+
+
 #%% main
 if __name__ == '__main__':
     dc = DCsnap('./DCsnap')
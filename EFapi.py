@@ -7,11 +7,20 @@ Created on Wed Aug 31 13:14:26 2022
 import numpy as np
 import pandas as pd 
 from pathlib import Path
-import _pickle as cp
 import multiprocessing as mp
 
 import efinance as ef
-from AuxFunc import formal_day
+from efinance.shared import session #efinance内部共用的session，Collector预连接使用
+from functools import partial
+from AuxFunc import t_now, formal_day, formal_day_vec, read_csv_typed, read_csv_multi
+from AuxFunc import session_minute, session_label
+from LoadCache import cache_key, cached_read
+from PklStore import PklStore, pkl_fn, load_legacy_pkl
+from Metrics import timer, inc
+from Pipeline import DirCache, run_pipeline
+from Catalog import Catalog
+from MinuteCache import MinuteCache
+from Checkpoint import Checkpoint, run_resumable
 
 
 #%% efinance api
@@ -29,7 +38,12 @@ def ef_get_data(stk_str, klt=1, ts='20200101', te='20230101', fqt=0):
         df = ef.stock.get_quote_history(stk_str, klt=1)
     else:
         df = ef.stock.get_quote_history(stk_str, beg=ts, end=te, klt=klt, fqt=fqt)
-    col_dict = {'股票名称':'stk_nm', '股票代码':'stk_str', '日期':'timeindex', 
+    return ef_format(df, klt)
+
+def ef_format(df, klt):
+    '''efinance返回的df转变为存储的格式，getter中的原始列名(名称, 代码)同样支持'''
+    col_dict = {'股票名称':'stk_nm', '股票代码':'stk_str', '名称':'stk_nm', '代码':'stk_str',
+                '日期':'timeindex', 
                 '昨收':'preclose', '开盘':'open', '收盘':'close', '最高':'high',
                 '最低':'low', '成交量':'volume', '成交额':'amount', '振幅':'amp', 
                 '涨跌幅':'rtn', '涨跌额':'rtn_v', '换手率':'turnover'} #振幅 amplitude
@@ -40,16 +54,28 @@ def ef_get_data(stk_str, klt=1, ts='20200101', te='20230101', fqt=0):
     return df
 
 
+#存储csv的列类型，读取时显式指定以减少类型推断，stk_str按str读取以保留前导0
+KLINE_DTYPE = {'stk_nm':str, 'stk_str':str, 'timeindex':str, 'preclose':np.float64,
+               'open':np.float64, 'close':np.float64, 'high':np.float64, 'low':np.float64,
+               'volume':np.float64, 'amount':np.float64, 'amp':np.float64, 'rtn':np.float64,
+               'rtn_v':np.float64, 'turnover':np.float64}
+
+
 #%%
 '''使用efinance对于minute以及day级别的数据进行存储
 stk_str不能有SE信息，正确输入：128106, 600036'''
 
 class EFminute:
     
-    def __init__(self, db_dir, mp_mng=False):
+    def __init__(self, db_dir, mp_mng=False, cache=None):
+        '''cache为LoadCache实例时load_minute使用读取缓存'''
         self.db_dir = Path(db_dir)
         self.mp_mng = mp_mng
-        self.cached = mp.Manager().dict() if mp_mng else {}
+        self.cached = mp.Manager().dict() if mp_mng else MinuteCache() #紧凑存储，取值时生成DataFrame
+        self.cache = cache
+        self.pkl_stores = {} #pickle_cache的增量存储，key=文件路径
+        self.dirs = DirCache()
+        self.catalog = Catalog(self.db_dir) #写入时记录每个(day, stk_str)的行数、时间范围以及crc
     
     def get_minute(self, stk_str):
         '''获取当天的可转债min数据（实时close数据，3S频率），使用ef.stock.get_quote_history接口'''
@@ -72,13 +98,32 @@ class EFminute:
             self.cached[stk_str[2:]] = df
             
         dt = df['timeindex'].iat[-1]
-        day = dt[:10]
-        day_path = self.db_dir.joinpath(day)
-        if not day_path.exists():
-            day_path.mkdir(parents=True)
+        day_path = self.dirs.ensure(self.db_dir.joinpath(dt[:10]))
         fn = day_path.joinpath(f'{stk_str}.csv')
-        df.to_csv(fn, encoding='gbk')
+        with timer('persist', self.db_dir.name):
+            self.catalog.write_csv(fn, df, dt[:10], stk_str, encoding='gbk')
         return dt
+    
+    def save_minute_pipe(self, stk_iter, N_fetch=16, cached=False, N_parse=1, N_write=1):
+        '''fetch/parse/persist分为三个stage的流水线，stage之间为有界队列，writer按日期目录分批写入'''
+        def parse(stk_str, df):
+            if len(df) == 0:
+                raise Exception(f'Empty df for {stk_str}')
+            if cached:
+                self.cached[stk_str[2:]] = df
+            return df
+
+        def write(batch):
+            with timer('persist', self.db_dir.name):
+                for stk_str,df in sorted(batch, key=lambda x: x[1]['timeindex'].iat[-1][:10]):
+                    day_str = df['timeindex'].iat[-1][:10]
+                    day_path = self.dirs.ensure(self.db_dir.joinpath(day_str))
+                    self.catalog.write_csv(day_path.joinpath(f'{stk_str}.csv'), df, day_str, stk_str,
+                                           encoding='gbk')
+            return
+
+        return run_pipeline(stk_iter, self.get_minute, parse, write, N_fetch, N_parse, N_write,
+                            name=self.db_dir.name)
 
     def cache_minute_multi(self, stk_iter):
         '''存储含有多个stk_str的iteration'''
@@ -87,6 +132,7 @@ class EFminute:
                 dt = self.cache_minute(stk_str)
                 print(f'\rNo.{i:3d} {stk_str} {dt} minute data cached.', end='')
             except Exception as e:
+                inc('task_errors', self.db_dir.name)
                 print(repr(e))
                 print(f'\tError of No.{i} {stk_str}.')
         print()
@@ -99,49 +145,72 @@ class EFminute:
                 dt = self.save_minute(stk_str, cached)
                 print(f'\rNo.{i:3d} {stk_str} {dt} minute data saved.', end='')
             except Exception as e:
+                inc('task_errors', self.db_dir.name)
                 print(repr(e))
                 print(f'\tError of No.{i} {stk_str}.')
         print()
         return
     
-    def load_minute(self, stk_str, day_str):
-        '''读取day_str, stk_str返回df'''
+    def load_minute(self, stk_str, day_str, columns=None, dtype=KLINE_DTYPE):
+        '''读取day_str, stk_str返回df, columns为需要读取的列'''
         day_str = formal_day(day_str)
         fn = self.db_dir.joinpath(day_str, f'{stk_str}.csv')
-        df = pd.read_csv(fn, index_col=0, encoding='gbk', engine='c')
+        key = cache_key(self.db_dir, stk_str, day_str, columns, dtype)
+        df = cached_read(self.cache, fn, key, 
+                         partial(read_csv_typed, fn, columns, dtype, index_col=0, encoding='gbk'))
         return df
     
-    def load_minute_multi(self, stk_str, day_list):
-        '''返回多天的day_str合并的df'''
-        day_list = [formal_day(day_str) for day_str in day_list]
+    def load_minute_multi(self, stk_str, day_list, columns=None, dtype=KLINE_DTYPE,
+                          N_workers=8, process=False):
+        '''返回多天的day_str合并的df, 多个文件并发读取'''
+        day_list = formal_day_vec(day_list)
         fn_list = [self.db_dir.joinpath(day_str, f'{stk_str}.csv') for day_str in day_list]
-        df_list = [pd.read_csv(fn, index_col=0, encoding='gbk', engine='c') for fn in fn_list]
-        df = pd.concat(df_list, axis=0)
+        df = read_csv_multi(fn_list, columns, dtype, N_workers, process, 
+                            index_col=0, encoding='gbk')
+        return df
+    
+    def load_minute_day(self, stk_iter, day_str, columns=None, dtype=KLINE_DTYPE,
+                        N_workers=8, process=False):
+        '''返回一天内多个stk_str合并的df, 外层index为stk_str'''
+        day_str = formal_day(day_str)
+        stk_list = list(stk_iter)
+        fn_list = [self.db_dir.joinpath(day_str, f'{stk_str}.csv') for stk_str in stk_list]
+        df = read_csv_multi(fn_list, columns, dtype, N_workers, process, keys=stk_list,
+                            index_col=0, encoding='gbk')
         return df
     
     def pickle_cache(self, day_str, prefix='data'):
-        '''存储day_str的所有可转债的pkl数据'''
-        fn = self.db_dir.joinpath(f'{prefix}{day_str}.pkl')
-        with open(fn, 'wb') as f:
-            if self.mp_mng:
-                cp.dump(self.cached.copy(), f)
-            else:
-                cp.dump(self.cached, f)
+        '''增量存储day_str的cached数据，只写入上次存储后变化的stk_str'''
+        fn = pkl_fn(self.db_dir, day_str, prefix)
+        if fn not in self.pkl_stores:
+            self.pkl_stores[fn] = PklStore(fn)
+        store = self.pkl_stores[fn]
+        if self.mp_mng:
+            store.dump(self.cached.copy())
+        else: #stamps没有变化的stk_str不生成DataFrame
+            store.dump(self.cached, self.cached.stamps())
         return 
 
-    def load_pkl(self, day_str, prefix='data'):
-        fn = self.db_dir.joinpath(f'{prefix}{day_str}.pkl')
-        with open(fn, 'rb') as f:
-            rst = cp.load(f)
+    def load_pkl(self, day_str, prefix='data', keys=None):
+        '''读取pickle_cache存储的数据，keys为需要读取的stk_str，None为全部'''
+        fn = pkl_fn(self.db_dir, day_str, prefix)
+        store = PklStore(fn)
+        if not store.idx_fn.exists(): #兼容旧格式的pkl文件
+            return load_legacy_pkl(self.db_dir, day_str, prefix, keys)
+        rst = store.load(keys)
         return rst
 
 
 
 class EFdaily:
     
-    def __init__(self, db_dir):
-        '''数据库文件存储路径db_dir'''
+    def __init__(self, db_dir, cache=None):
+        '''数据库文件存储路径db_dir, cache为LoadCache实例时load_daily使用读取缓存'''
         self.db_dir = Path(db_dir)
+        self.cache = cache
+        self.dirs = DirCache()
+        self.catalog = Catalog(self.db_dir) #日线不分日期，day为''
+        self.checkpoint = Checkpoint(self.db_dir.joinpath('checkpoint.db'))
 
     def get_daily(self, stk_str, ts='20200101', te='20230101', fqt=0):
         '''
@@ -154,10 +223,9 @@ class EFdaily:
     def save_daily(self, stk_str, ts='20200101', te='20230101', fqt=0):
         '''存储获取的可转债数据'''
         df = self.get_daily(stk_str, ts, te, fqt)
-        if not self.db_dir.exists():
-            self.db_dir.mkdir(parents=True)
-        fn = self.db_dir.joinpath(f'{stk_str}.csv')
-        df.to_csv(fn, encoding='gbk')
+        fn = self.dirs.ensure(self.db_dir).joinpath(f'{stk_str}.csv')
+        with timer('persist', self.db_dir.name):
+            self.catalog.write_csv(fn, df, '', stk_str, encoding='gbk')
         return 
     
     def save_daily_multi(self, stk_iter, ts='20200101', te='20230101', fqt=0):
@@ -167,54 +235,468 @@ class EFdaily:
                 self.save_daily(stk_str, ts, te, fqt)
                 print(f'\rNo.{i} {stk_str} daily data saved.', end='') #\r在一行一直刷新
             except Exception as e:
+                inc('task_errors', self.db_dir.name)
                 print(repr(e))
                 print(f'\tError of No.{i} {stk_str}.')
         print()
         return 
+    
+    def save_daily_resume(self, stk_iter, ts='20200101', te='20230101', fqt=0, N_workers=4,
+                          throttle=None, stop=None, max_attempts=3):
+        '''
+        可以中断后继续的save_daily：每只完成后记录在{db_dir}/checkpoint.db，重新运行时跳过
+        throttle为Checkpoint.Throttle时限制请求速率，stop为threading.Event时可以从外部停止
+        return: 本次完成的数量
+        '''
+        units = [f'{stk_str}|{ts}|{te}|{fqt}' for stk_str in stk_iter]
+        def func(unit):
+            stk_str = unit.split('|')[0]
+            self.save_daily(stk_str, ts, te, fqt)
+            return ''
+        return run_resumable('daily', units, func, self.checkpoint, N_workers, throttle, 
+                             max_attempts, stop, self.db_dir.name)
+
+    def save_daily_stream(self, stk_iter, ts='20200101', te='20230101', fqt=0, N_workers=8):
+        '''
+        有界线程池并发下载，每完成一只即写入文件，内存占用不随stk_iter的长度增长
+        使用getter.get_quote_history_stream(需要把修改后的getter.py安装为efinance/common/getter.py，
+        getter.py使用相对导入..common.config与.config，不在efinance.stock中)
+        '''
+        from efinance.common.getter import get_quote_history_stream
+        self.dirs.ensure(self.db_dir)
+        stream = get_quote_history_stream(stk_iter, beg=ts, end=te, klt=101, fqt=fqt, 
+                                          max_workers=N_workers)
+        for i,(stk_str,df) in enumerate(stream):
+            if df is None:
+                inc('task_errors', self.db_dir.name)
+                print(f'\tError of No.{i} {stk_str}.')
+                continue
+            fn = self.db_dir.joinpath(f'{stk_str}.csv')
+            with timer('persist', self.db_dir.name):
+                self.catalog.write_csv(fn, ef_format(df, 101), '', stk_str, encoding='gbk')
+            print(f'\rNo.{i} {stk_str} daily data saved.', end='')
+        print()
+        return 
         
-    def load_daily(self, stk_str):
-        '''读取stk_str返回df'''
+    def load_daily(self, stk_str, columns=None, dtype=KLINE_DTYPE, fqt=0):
+        '''
+        读取stk_str返回df，fqt=1,2时用本地的复权因子计算前复权、后复权价格
+        复权需要timeindex，columns中没有时附带读取，复权后去掉
+        '''
         fn = self.db_dir.joinpath(f'{stk_str}.csv')
-        df = pd.read_csv(fn, index_col=0, encoding='gbk', engine='c')
+        read_cols = adjust_columns(columns, fqt)
+        key = cache_key(self.db_dir, stk_str, None, read_cols, dtype)
+        df = cached_read(self.cache, fn, key, 
+                         partial(read_csv_typed, fn, read_cols, dtype, index_col=0, encoding='gbk'))
+        if fqt != 0:
+            df = adjust_price(df, self.load_factor(stk_str), fqt)
+            if read_cols is not columns:
+                df = df.drop(columns='timeindex')
+        return df
+    
+    def load_daily_multi(self, stk_iter, columns=None, dtype=KLINE_DTYPE,
+                         N_workers=8, process=False, fqt=0):
+        '''
+        并发读取多个stk_str的日线数据, 外层index为stk_str
+        fqt=1,2时没有因子表的stk_str价格为NaN，其余的stk_str正常复权
+        '''
+        stk_list = list(stk_iter)
+        fn_list = [self.db_dir.joinpath(f'{stk_str}.csv') for stk_str in stk_list]
+        read_cols = adjust_columns(columns, fqt)
+        df = read_csv_multi(fn_list, read_cols, dtype, N_workers, process, keys=stk_list,
+                            index_col=0, encoding='gbk')
+        if fqt != 0:
+            tables = {}
+            for stk_str in stk_list:
+                if self.factor_fn(stk_str).exists():
+                    tables[stk_str] = self.load_factor(stk_str)
+                else:
+                    inc('task_errors', self.db_dir.name)
+                    print(f'\tNo factor of {stk_str}, prices are NaN.')
+            df = adjust_price(df, tables, fqt)
+            if read_cols is not columns:
+                df = df.drop(columns='timeindex')
+        return df
+    
+    #复权因子: 只存储不复权的日线，复权价格在读取时计算
+    def factor_fn(self, stk_str):
+        return self.db_dir.joinpath('factor', f'{stk_str}.csv')
+    
+    def load_factor(self, stk_str):
+        '''复权因子表(timeindex, factor)，timeindex为因子生效的日期，最后一行为最后检查的日期'''
+        fn = self.factor_fn(stk_str)
+        return read_csv_typed(fn, None, {'timeindex':str, 'factor':np.float64}, index_col=0)
+    
+    def save_factor(self, stk_str, te='20500101'):
+        '''
+        后复权价格 = 不复权价格 * factor，后复权的历史数据不随除权变化
+        已有因子表时只下载最后检查日期之后的后复权数据，返回因子表的行数
+        不复权的close优先使用本地存储的日线(save_daily, fqt=0)
+        '''
+        fn = self.factor_fn(stk_str)
+        old = self.load_factor(stk_str) if fn.exists() else None
+        ts = '19000101' if old is None else old['timeindex'].iat[-1].replace('-', '')
+        hfq = self.get_daily(stk_str, ts, te, fqt=2)
+        if self.db_dir.joinpath(f'{stk_str}.csv').exists():
+            raw = self.load_daily(stk_str, ['timeindex', 'close'])
+        else:
+            raw = self.get_daily(stk_str, ts, te, fqt=0)
+        table = factor_table(raw, hfq)
+        if old is not None:
+            table = merge_factor(old, table)
+        self.dirs.ensure(fn.parent)
+        with timer('persist', self.db_dir.name):
+            table.to_csv(fn)
+        return len(table)
+    
+    def save_factor_multi(self, stk_iter, te='20500101'):
+        '''存储含有多个stk_str的iteration'''
+        for i,stk_str in enumerate(stk_iter):
+            try:
+                n = self.save_factor(stk_str, te)
+                print(f'\rNo.{i} {stk_str} {n} factor rows saved.', end='')
+            except Exception as e:
+                inc('task_errors', self.db_dir.name)
+                print(repr(e))
+                print(f'\tError of No.{i} {stk_str}.')
+        print()
+        return 
+
+
+#%% 复权因子的计算
+PRICE_COLS = ('preclose', 'open', 'close', 'high', 'low')
+
+def factor_table(raw, hfq, rtol=5e-4):
+    '''
+    由同一段时间的不复权与后复权close计算因子，只保留因子变化的日期以及最后一天
+    价格只保留2~3位小数，相邻两天的比值变化超过舍入误差(与rtol中较大者)时认为除权
+    每一段的因子取该段的中位数
+    '''
+    df = pd.merge(raw[['timeindex', 'close']], hfq[['timeindex', 'close']], on='timeindex',
+                  suffixes=('', '_hfq'))
+    df = df[(df['close'] > 0) & (df['close_hfq'] > 0)]
+    if len(df) == 0:
+        raise Exception('No overlapping close for factor')
+    f = df['close_hfq'].values / df['close'].values
+    tol = np.maximum(rtol, 0.005/df['close'].values + 0.005/df['close_hfq'].values)
+    chg = np.r_[True, np.abs(np.diff(f)) / f[:-1] > tol[1:]]
+    fac = pd.Series(f).groupby(np.cumsum(chg)).median().values
+    dates = df['timeindex'].values
+    table = pd.DataFrame({'timeindex': np.r_[dates[chg], dates[-1:]],
+                          'factor': np.round(np.r_[fac, fac[-1:]], 6)})
+    return table
+
+def merge_factor(old, new, rtol=1e-3):
+    '''增量的因子表接在旧表之后，新表的第一段与旧表最后的因子相同时沿用旧的因子'''
+    f_old = old['factor'].iat[-1]
+    new = new.copy()
+    if abs(new['factor'].iat[0] / f_old - 1) < rtol:
+        new.loc[new['factor'] == new['factor'].iat[0], 'factor'] = f_old
+    table = pd.concat([old.iloc[:-1], new], axis=0, ignore_index=True)
+    keep = np.r_[True, table['factor'].values[1:] != table['factor'].values[:-1]]
+    keep[-1] = True
+    return table[keep].reset_index(drop=True)
+
+def factor_at(table, timeindex):
+    '''timeindex每一天对应的因子，早于因子表的日期使用第一个因子'''
+    i = np.searchsorted(table['timeindex'].values, np.asarray(timeindex, dtype=str), side='right') - 1
+    return table['factor'].values[np.clip(i, 0, len(table) - 1)]
+
+def adjust_columns(columns, fqt):
+    '''复权时需要读取的列：columns中没有timeindex时加上'''
+    if fqt == 0 or columns is None or 'timeindex' in columns:
+        return columns
+    return ['timeindex'] + list(columns)
+
+def adjust_price(df, table, fqt):
+    '''
+    fqt=2后复权: price * factor; fqt=1前复权: price * factor / 最新的factor
+    table为dict时df的外层index为stk_str(load_daily_multi)，各个stk_str使用自己的因子表，
+    按stk_str分组一次得到每组的行位置，不在table中的stk_str价格为NaN
+    '''
+    if isinstance(table, dict):
+        t_arr = df['timeindex'].values
+        f = np.full(len(df), np.nan)
+        for stk_str,pos in df.groupby(level=0, sort=False).indices.items():
+            t = table.get(stk_str)
+            if t is None:
+                continue
+            f[pos] = factor_at(t, t_arr[pos])
+            if fqt == 1:
+                f[pos] /= t['factor'].iat[-1]
+    else:
+        f = factor_at(table, df['timeindex'].values)
+        if fqt == 1:
+            f = f / table['factor'].iat[-1]
+    cols = [c for c in PRICE_COLS if c in df.columns]
+    return df.assign(**{c: np.round(df[c].values * f, 3) for c in cols})
+
+
+#资金流向的列名，日线与日内分钟数据共用
+BILL_COLS = {'名称':'stk_nm', '代码':'stk_str', '日期':'timeindex', '时间':'timeindex',
+             '主力净流入':'main', '小单净流入':'small', '中单净流入':'medium',
+             '大单净流入':'large', '超大单净流入':'xlarge',
+             '主力净流入占比':'main_pct', '小单流入净占比':'small_pct', '中单流入净占比':'medium_pct',
+             '大单流入净占比':'large_pct', '超大单流入净占比':'xlarge_pct',
+             '收盘价':'close', '涨跌幅':'rtn'}
+BILL_DTYPE = {'stk_nm':str, 'stk_str':str, 'timeindex':str}
+
+def bill_format(df):
+    df = df.rename(columns=BILL_COLS)
+    if len(df) > 0 and len(df['timeindex'].iat[0]) == 16: #日内数据精确到分钟
+        df['timeindex'] = df['timeindex'] + ':00'
+    return df
+
+
+class EFbill:
+    '''
+    可转债、正股的资金流向(get_history_bill, get_today_bill)批量采集
+    日线：第一次获取全部历史，之后只请求上次日期之后的几天并追加，{db_dir}/hist/{stk_str}.csv
+    日内分钟：每次请求与已保存的数据按timeindex合并，{db_dir}/{day}/{stk_str}.csv
+    build_panel把所有stk_str的数据转为按字段的(timeindex x stk_str)矩阵，
+        存入{db_dir}/panel{day}.pkz，load_panel可以只读取需要的字段
+    需要安装修改后的getter.py (get_history_bill的lmt参数)
+    '''
+
+    def __init__(self, db_dir):
+        self.db_dir = Path(db_dir)
+        self.last = {} #key=stk_str, 已保存的(最后一个日期, 行数)
+        self.today = {} #key=stk_str, (day, 已保存的日内数据)，每个stk_str只保留最新的一天
+        self.dirs = DirCache()
+
+    def reset(self, stk_str):
+        '''文件被外部替换(例如分片换手)后清除stk_str的状态，下次从文件重新读取'''
+        self.last.pop(stk_str, None)
+        self.today.pop(stk_str, None)
+        return
+
+    def hist_fn(self, stk_str):
+        return self.db_dir.joinpath('hist', f'{stk_str}.csv')
+
+    def today_fn(self, day_str, stk_str):
+        return self.db_dir.joinpath(formal_day(day_str), f'{stk_str}.csv')
+
+    def get_last(self, stk_str):
+        '''已保存的(最后一个日期, 行数)，内存中没有时读取文件的timeindex列，文件不存在时为None'''
+        if stk_str not in self.last:
+            fn = self.hist_fn(stk_str)
+            if not fn.exists():
+                return None
+            df = read_csv_typed(fn, ['timeindex'], BILL_DTYPE, index_col=0, encoding='gbk')
+            if len(df) == 0:
+                return None
+            self.last[stk_str] = (df['timeindex'].iat[-1], len(df))
+        return self.last[stk_str]
+
+    def save_history(self, stk_str):
+        '''增量更新日线资金流向，返回新增的行数'''
+        from efinance.common.getter import get_history_bill
+        last = self.get_last(stk_str)
+        if last is None:
+            lmt = 100000
+        else: #上次日期之后的工作日数，多请求几天以防遗漏
+            lmt = int(np.busday_count(last[0], formal_day(t_now(1,0)[:10]))) + 3
+        df = bill_format(get_history_bill(stk_str, lmt=lmt))
+        if last is not None:
+            df = df[df['timeindex'] > last[0]]
+        if len(df) == 0:
+            return 0
+        fn = self.hist_fn(stk_str)
+        self.dirs.ensure(fn.parent)
+        n = 0 if last is None else last[1]
+        df.index = range(n, n + len(df)) #追加时index接在已有的行之后
+        with timer('persist', self.db_dir.name):
+            if last is None:
+                df.to_csv(fn, encoding='gbk')
+            else:
+                df.to_csv(fn, mode='a', header=False, encoding='gbk')
+        self.last[stk_str] = (df['timeindex'].iat[-1], n + len(df))
+        return len(df)
+
+    def save_today(self, stk_str):
+        '''获取当天的分钟资金流向并与已保存的数据合并，返回最新数据的datetime'''
+        from efinance.common.getter import get_today_bill
+        df = bill_format(get_today_bill(stk_str))
+        if len(df) == 0:
+            raise Exception(f'Empty df for {stk_str}')
+        day_str = df['timeindex'].iat[-1][:10]
+        fn = self.today_fn(day_str, stk_str)
+        day_old, old = self.today.get(stk_str, (None, None))
+        if day_old != day_str:
+            old = None
+        if old is None and fn.exists():
+            old = self.load_today(day_str, stk_str)
+        if old is not None: #接口返回的分钟不完整时，已保存的分钟保留
+            df = pd.concat([old, df], axis=0, ignore_index=True)
+            df = df.drop_duplicates('timeindex', keep='last').sort_values('timeindex')
+            df = df.reset_index(drop=True)
+        self.dirs.ensure(fn.parent)
+        with timer('persist', self.db_dir.name):
+            df.to_csv(fn, encoding='gbk')
+        self.today[stk_str] = (day_str, df)
+        return df['timeindex'].iat[-1]
+
+    def save_history_multi(self, stk_iter):
+        '''存储含有多个stk_str的iteration'''
+        for i,stk_str in enumerate(stk_iter):
+            try:
+                n = self.save_history(stk_str)
+                print(f'\rNo.{i:3d} {stk_str} {n:5d} new days of bill saved.', end='')
+            except Exception as e:
+                inc('task_errors', self.db_dir.name)
+                print(repr(e))
+                print(f'\tError of No.{i} {stk_str}.')
+        print()
+        return
+
+    def save_today_multi(self, stk_iter):
+        '''存储含有多个stk_str的iteration'''
+        for i,stk_str in enumerate(stk_iter):
+            try:
+                dt = self.save_today(stk_str)
+                print(f'\rNo.{i:3d} {stk_str} {dt} minute bill saved.', end='')
+            except Exception as e:
+                inc('task_errors', self.db_dir.name)
+                print(repr(e))
+                print(f'\tError of No.{i} {stk_str}.')
+        print()
+        return
+
+    def load_history(self, stk_str, columns=None):
+        fn = self.hist_fn(stk_str)
+        return read_csv_typed(fn, columns, BILL_DTYPE, index_col=0, encoding='gbk')
+
+    def load_today(self, day_str, stk_str, columns=None):
+        fn = self.today_fn(day_str, stk_str)
+        return read_csv_typed(fn, columns, BILL_DTYPE, index_col=0, encoding='gbk')
+
+    def panel_fn(self, day_str=None):
+        return pkl_fn(self.db_dir, 'hist' if day_str is None else formal_day(day_str), 'panel')
+
+    def build_panel(self, stk_iter, day_str=None, N_workers=8):
+        '''
+        并发读取stk_iter的csv，转为{字段: DataFrame(timeindex x stk_str)}并存储
+        day_str=None为日线，否则为该日的分钟数据；文件不存在的stk_str跳过
+        只有发生变化的字段会重新写入，返回写入的字段数量
+        '''
+        fn_func = self.hist_fn if day_str is None else partial(self.today_fn, day_str)
+        stk_list = [stk_str for stk_str in stk_iter if fn_func(stk_str).exists()]
+        if len(stk_list) == 0:
+            return 0
+        df = read_csv_multi([fn_func(stk_str) for stk_str in stk_list], None, BILL_DTYPE,
+                            N_workers, keys=stk_list, index_col=0, encoding='gbk')
+        df = df.drop(columns=['stk_nm', 'stk_str'], errors='ignore')
+        df.index = pd.MultiIndex.from_arrays([df['timeindex'].values, df.index.get_level_values(0)])
+        wide = df.drop(columns='timeindex').unstack(level=1).sort_index() #列为(字段, stk_str)
+        panel = {c: wide[c].reindex(columns=stk_list) for c in wide.columns.levels[0]}
+        store = PklStore(self.panel_fn(day_str))
+        return store.dump(panel)
+
+    def load_panel(self, fields=None, day_str=None):
+        '''读取build_panel的矩阵，fields为需要的字段，None为全部'''
+        store = PklStore(self.panel_fn(day_str))
+        return store.load(fields)
+
+
+
+#%% 由1min数据本地合成5/15/30/60min的K线
+def resample_minute(df, klt):
+    '''
+    ef_format后的1min数据合成为klt分钟的K线，bar不跨越11:30/13:00以及日期
+    preclose由第一分钟的close - rtn_v得到，amp/rtn/rtn_v按合成后的bar重新计算
+    '''
+    if len(df) == 0:
         return df
+    idx = session_minute(df['timeindex'])
+    end = -(-idx // klt) * klt #向上取整到klt的整数倍
+    label = df['timeindex'].str[:11].values + session_label(end).values
+    df = df.assign(timeindex=label, preclose=df['close'] - df['rtn_v'])
+    agg = {'stk_nm':'first', 'stk_str':'first', 'preclose':'first', 'open':'first', 'close':'last',
+           'high':'max', 'low':'min', 'volume':'sum', 'amount':'sum', 'turnover':'sum'}
+    agg = {k:v for k,v in agg.items() if k in df.columns}
+    bar = df.groupby('timeindex', sort=False).agg(agg)
+    #一天中后面的bar以前一个bar的close为preclose
+    day = bar.index.str[:10]
+    prev = bar['close'].shift(1)
+    pre = np.where(day == np.roll(day, 1), prev, bar['preclose'])
+    pre[0] = bar['preclose'].iat[0]
+    bar['preclose'] = pre
+    bar['amp'] = np.round((bar['high'] - bar['low']) / bar['preclose'] * 100, 2)
+    bar['rtn'] = np.round((bar['close'] / bar['preclose'] - 1) * 100, 2)
+    bar['rtn_v'] = np.round(bar['close'] - bar['preclose'], 3)
+    bar = bar.reset_index()
+    cols = [c for c in ['stk_nm', 'stk_str', 'timeindex', 'open', 'close', 'high', 'low', 'volume', 
+                        'amount', 'amp', 'rtn', 'rtn_v', 'turnover'] if c in bar.columns]
+    return bar[cols]
 
 
 # 只针对某一个klt的数据进行获取和存储
 class EFkline:
     
-    def __init__(self, db_dir, klt=5):
+    LOCAL_KLT = (5, 15, 30, 60) #可以由1min数据合成的klt
+    
+    def __init__(self, db_dir, klt=5, minute_dir=None):
+        '''
+        minute_dir为EFminute的存储路径，不为None且klt在LOCAL_KLT中时，
+            fqt=0的数据由本地1min数据合成，不再下载；其余的klt/fqt仍然下载
+        '''
         self.db_dir = Path(db_dir)
         self.klt = klt
         self.fq_dict = {1:'1T', 5:'5T', 15:'15T', 30:'30T', 
                      60:'1H', 101:'1D', 102:'1W', 103:'1M'}
+        self.efm = None if minute_dir is None else EFminute(minute_dir)
+        self.dirs = DirCache()
+        self.catalog = Catalog(self.db_dir)
+    
+    def is_local(self, fqt=0):
+        '''1min数据在采集当天保存，相当于不复权，所以只有fqt=0可以本地合成'''
+        return self.efm is not None and self.klt in self.LOCAL_KLT and fqt == 0
+    
+    def minute_days(self, stk_str, ts='20200101', te='20230101'):
+        '''minute_dir中ts~te之间存在stk_str数据的日期，查询EFminute的catalog，不遍历目录'''
+        ts, te = formal_day(ts), formal_day(te)
+        self.efm.catalog.ensure_built(encoding='gbk')
+        day = self.efm.catalog.query(stk_str=stk_str)['day']
+        return sorted(day[(day >= ts) & (day <= te)])
+    
+    def build_data(self, stk_str, ts='20200101', te='20230101'):
+        '''由本地的1min数据合成klt的K线'''
+        day_list = self.minute_days(stk_str, ts, te)
+        if len(day_list) == 0:
+            raise Exception(f'No minute data for {stk_str}')
+        df = self.efm.load_minute_multi(stk_str, day_list)
+        return resample_minute(df.reset_index(drop=True), self.klt)
         
     def get_data(self, stk_str, ts='20200101', te='20230101', fqt=0):
+        if self.is_local(fqt):
+            return self.build_data(stk_str, ts, te)
         df = ef_get_data(stk_str, self.klt, ts, te, fqt)
         return df
 
     def save_data(self, stk_str, ts='20200101', te='20230101', fqt=0):
         df = self.get_data(stk_str, ts, te, fqt)
-        if not self.db_dir.exists():
-            self.db_dir.mkdir(parents=True)
-        fn = self.db_dir.joinpath(f'{stk_str}.csv')
-        df.to_csv(fn, encoding='gbk')
+        fn = self.dirs.ensure(self.db_dir).joinpath(f'{stk_str}.csv')
+        with timer('persist', self.db_dir.name):
+            self.catalog.write_csv(fn, df, '', stk_str, encoding='gbk')
         return 
     
     def save_data_multi(self, stk_iter, ts='20200101', te='20230101', fqt=0):
         '''存储含有多个stk_str的iteration'''
+        freq = self.fq_dict.get(self.klt, self.klt)
         for i,stk_str in enumerate(stk_iter):
             try:
-                self.save_daily(stk_str, ts, te, fqt)
-                print(f'\rNo.{i} {stk_str} daily data saved.', end='') #\r在一行一直刷新
+                self.save_data(stk_str, ts, te, fqt)
+                print(f'\rNo.{i} {stk_str} {freq} data saved.', end='') #\r在一行一直刷新
             except Exception as e:
+                inc('task_errors', self.db_dir.name)
                 print(repr(e))
                 print(f'\tError of No.{i} {stk_str}.')
         print()
         return 
     
-    def load_data(self, stk_str):
+    def load_data(self, stk_str, columns=None, dtype=KLINE_DTYPE):
         fn = self.db_dir.joinpath(f'{stk_str}.csv')
-        df = pd.read_csv(fn, index_col=0, encoding='gbk', engine='c')
+        df = read_csv_typed(fn, columns, dtype, index_col=0, encoding='gbk')
         return df
 
 #%% main
@@ -222,7 +704,7 @@ if __name__ == '__main__':
     
     efm = EFminute('./EF1T')
     efd = EFdaily('./EF1D')
-    efk = EFkline('./EF5T', 5)
+    efk = EFkline('./EF5T', 5, minute_dir='./EF1T')
     pass
 
 
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+对延迟敏感的请求(dc_get_snap, 分钟trends)在东财的镜像host之间对冲(hedged request)
+    先请求原host，超过该host fetch耗时的p95仍未返回时，向另一个镜像发送相同的请求，使用先返回的结果
+    额外请求的数量用令牌桶限制在请求数的max_ratio以内，慢的请求不会让负载翻倍
+    延迟取自Metrics中各个host的fetch直方图，样本不足时使用default_delay
+
+默认不启用，enable_hedging()之后hedged_get才会发送对冲请求
+Collector配置中"hedge": {"q": 0.95, "max_ratio": 0.1}时启动时启用
+
+@author: yhzhang
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from Metrics import METRICS, timed_get, inc, url_host
+
+
+#%% hedger
+#等价的前端host，对冲请求按顺序轮流发给镜像
+MIRRORS = {'push2.eastmoney.com': ('80.push2.eastmoney.com', '16.push2.eastmoney.com',
+                                   'push2his.eastmoney.com'),
+           'push2his.eastmoney.com': ('push2.eastmoney.com', '80.push2.eastmoney.com')}
+
+class Hedger:
+
+    def __init__(self, mirrors=MIRRORS, q=0.95, min_delay=0.05, max_delay=2.0, default_delay=0.3,
+                 min_samples=50, max_ratio=0.1, burst=5, N_thread=32, enabled=True):
+        '''
+        延迟为原host fetch耗时的q分位数，限制在[min_delay, max_delay]之间
+        每个请求增加max_ratio个令牌(最多burst个)，每个对冲请求消耗1个
+        '''
+        self.mirrors = {k: tuple(v) for k,v in mirrors.items()}
+        self.q = q
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.N_thread = N_thread
+        self.enabled = enabled
+        self.tokens = burst
+        self.rr = 0 #轮流选择镜像
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def delay(self, host):
+        h = METRICS.hists.get(('fetch', host))
+        if h is None or h.n < self.min_samples:
+            return self.default_delay
+        return min(max(h.quantile(self.q), self.min_delay), self.max_delay)
+
+    def acquire(self, host):
+        '''令牌足够时返回对冲使用的镜像host，否则返回None'''
+        with self.lock:
+            if self.tokens < 1:
+                return None
+            self.tokens -= 1
+            alts = self.mirrors[host]
+            self.rr += 1
+            return alts[self.rr % len(alts)]
+
+    def get(self, get, url, **kwargs):
+        '''与timed_get相同，返回先成功的response；两个请求都失败时抛出原请求的异常'''
+        host = url_host(url)
+        if not self.enabled or host not in self.mirrors:
+            return timed_get(get, url, **kwargs)
+        with self.lock:
+            self.tokens = min(self.tokens + self.max_ratio, self.burst)
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.N_thread)
+        first = self.pool.submit(timed_get, get, url, **kwargs)
+        done, _ = wait([first], timeout=self.delay(host))
+        alt = None if done else self.acquire(host)
+        if alt is None:
+            return first.result()
+
+        inc('hedges', host)
+        second = self.pool.submit(timed_get, get, url.replace(host, alt, 1), **kwargs)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    if f is second:
+                        inc('hedge_wins', host)
+                    return f.result() #落后的请求在后台结束，结果丢弃
+        return first.result()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+        return
+
+
+#%% 全局实例，各个api模块共用
+HEDGER = Hedger(enabled=False)
+
+def enable_hedging(**kwargs):
+    '''按kwargs(Hedger的参数)重新设置并启用'''
+    global HEDGER
+    HEDGER.shutdown()
+    HEDGER = Hedger(**kwargs)
+    return HEDGER
+
+def disable_hedging():
+    HEDGER.enabled = False
+    return
+
+def hedged_get(get, url, **kwargs):
+    '''未启用时等同于timed_get'''
+    return HEDGER.get(get, url, **kwargs)
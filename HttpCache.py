@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+变化很慢的接口(可转债列表/详情、代码表、基本信息、价值分析)的http响应缓存
+    响应保存在sqlite(默认./http_cache.db，环境变量CB_HTTP_CACHE可以修改)中，key为url+params
+    每个endpoint有自己的TTL，过期后stale秒之内先返回旧的响应，同时在后台线程更新(stale-while-revalidate)
+    更新失败时，stale>0的endpoint返回旧的响应；总大小超过max_bytes时按最近访问时间淘汰
+    含有价格等实时字段的endpoint(get_base_info)stale为0，过期后必须重新请求
+    多个进程(线程)同时请求同一个key时，只有取得租约(inflight表)的发送请求，其余的等待结果
+    命中时的访问时间先记在内存中，批量写入sqlite
+
+cached_get的参数与timed_get相同，另外指定endpoint，返回requests.Response
+
+@author: yhzhang
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import requests
+from urllib.parse import urlencode
+from requests.structures import CaseInsensitiveDict
+
+from Metrics import timed_get, inc, url_host
+
+
+#%% ttl
+#(ttl, stale)秒
+TTLS = {'bond_zh_cov': (6*3600, 18*3600),
+        'bond_zh_cov_info': (24*3600, 6*24*3600),
+        'bond_zh_cov_value_analysis': (12*3600, 24*3600),
+        '_code_id_map': (24*3600, 6*24*3600),
+        'get_base_info': (12*3600, 0)} #含有最新价等字段，不使用过期的响应
+DEFAULT_TTL = (3600, 0)
+IGNORE_PARAMS = ('_',) #时间戳参数不参与key
+
+_SCHEMA = ('''CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY, endpoint TEXT, url TEXT, status INTEGER, headers TEXT, encoding TEXT,
+    body BLOB, size INTEGER, fetched REAL, accessed REAL)''',
+    'CREATE INDEX IF NOT EXISTS idx_accessed ON responses (accessed)',
+    'CREATE TABLE IF NOT EXISTS inflight (key TEXT PRIMARY KEY, until REAL)')
+
+def cache_key(url, params=None):
+    if params is None:
+        items = []
+    else:
+        items = params.items() if isinstance(params, dict) else params
+        items = sorted((str(k), str(v)) for k,v in items if k not in IGNORE_PARAMS)
+    s = f'{url}?{urlencode(items)}'
+    return hashlib.sha1(s.encode('utf-8')).hexdigest(), s
+
+def to_response(row):
+    '''(url, status, headers, encoding, body) -> requests.Response'''
+    resp = requests.Response()
+    resp.url, resp.status_code = row[0], row[1]
+    resp.headers = CaseInsensitiveDict(json.loads(row[2]))
+    resp.encoding = row[3]
+    resp._content = row[4]
+    return resp
+
+
+#%% cache
+class ResponseCache:
+
+    def __init__(self, fn=None, max_bytes=256*2**20, lease=60, enabled=True, n_locks=64,
+                 touch_n=256, touch_s=60):
+        '''
+        lease为一个进程请求同一个key的租约(秒)，超过后其他进程可以重新请求
+        n_locks为进程内的锁的数量，key按hash分配到固定的锁上，只在查询与取得租约时持有
+        累计touch_n个或超过touch_s秒时写入访问时间
+        '''
+        self.fn = os.environ.get('CB_HTTP_CACHE', './http_cache.db') if fn is None else fn
+        self.max_bytes = max_bytes
+        self.lease = lease
+        self.enabled = enabled
+        self.ttls = dict(TTLS)
+        self.local = threading.local() #sqlite连接每个线程一个
+        self.locks = [threading.Lock() for _ in range(n_locks)] #进程内同一个key只请求一次
+        self.touch_n = touch_n
+        self.touch_s = touch_s
+        self.touched = {} #key: 访问时间，还没有写入sqlite
+        self.t_touch = time.time()
+        self.touch_lock = threading.Lock()
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.fn, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            for sql in _SCHEMA:
+                conn.execute(sql)
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def set_ttl(self, endpoint, ttl, stale=0):
+        self.ttls[endpoint] = (ttl, stale)
+        return
+
+    def lookup(self, key):
+        return self.connect().execute(
+            'SELECT url, status, headers, encoding, body, fetched FROM responses WHERE key=?',
+            (key,)).fetchone()
+
+    def store(self, key, endpoint, resp):
+        conn = self.connect()
+        now = time.time()
+        conn.execute('INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?,?,?,?)',
+                     (key, endpoint, resp.url, resp.status_code, json.dumps(dict(resp.headers)),
+                      resp.encoding, resp.content, len(resp.content), now, now))
+        conn.commit()
+        self.evict()
+        return
+
+    def evict(self):
+        '''总大小超过max_bytes时删除最久没有访问的，直到max_bytes的90%'''
+        conn = self.connect()
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        self.flush_touched() #按最新的访问时间淘汰
+        rows = conn.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall()
+        drop = []
+        for key, size in rows:
+            if total <= 0.9 * self.max_bytes:
+                break
+            drop.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM responses WHERE key=?', drop)
+        conn.commit()
+        inc('cache_evicted', '', len(drop))
+        return
+
+    def acquire(self, key):
+        '''
+        取得跨进程的租约，返回租约的到期时间(release时用于确认是自己的租约)
+        已经有其他进程在请求时返回None
+        '''
+        conn = self.connect()
+        now = time.time()
+        until = now + self.lease
+        conn.execute('DELETE FROM inflight WHERE key=? AND until<?', (key, now))
+        cur = conn.execute('INSERT OR IGNORE INTO inflight VALUES (?,?)', (key, until))
+        conn.commit()
+        return until if cur.rowcount == 1 else None
+
+    def release(self, key, until):
+        '''只删除自己取得的租约'''
+        conn = self.connect()
+        conn.execute('DELETE FROM inflight WHERE key=? AND until=?', (key, until))
+        conn.commit()
+        return
+
+    def fetch(self, key, endpoint, get, url, until=None, **kwargs):
+        '''请求并保存，只缓存200的响应，until为取得的租约(None为没有取得租约)'''
+        try:
+            resp = timed_get(get, url, **kwargs)
+            if resp.status_code == 200:
+                self.store(key, endpoint, resp)
+        finally:
+            if until is not None:
+                self.release(key, until)
+        return resp
+
+    def revalidate(self, key, endpoint, get, url, until, **kwargs):
+        '''后台更新，失败时保留旧的响应'''
+        def run():
+            try:
+                self.fetch(key, endpoint, get, url, until, **kwargs)
+            except Exception as e:
+                print(repr(e))
+                print(f'\tError of revalidating {url}.')
+        threading.Thread(target=run, daemon=True).start()
+        return
+
+    def get(self, get, url, endpoint, **kwargs):
+        if not self.enabled:
+            return timed_get(get, url, **kwargs)
+        key, _ = cache_key(url, kwargs.get('params'))
+        host = url_host(url)
+        ttl, stale = self.ttls.get(endpoint, DEFAULT_TTL)
+        lock = self.locks[int(key[:8], 16) % len(self.locks)]
+        t0 = time.time()
+        while True:
+            with lock: #只在查询与取得租约时持有，请求在锁外进行
+                row = self.lookup(key)
+                age = float('inf') if row is None else time.time() - row[5]
+                if age < ttl:
+                    inc('cache_hits', host)
+                    self.touch(key)
+                    return to_response(row)
+                if age < ttl + stale:
+                    inc('cache_stale', host)
+                    until = self.acquire(key)
+                    if until is not None:
+                        self.revalidate(key, endpoint, get, url, until, **kwargs)
+                    self.touch(key)
+                    return to_response(row)
+                until = self.acquire(key)
+                if until is not None:
+                    row = self.lookup(key) #查询与取得租约之间其他请求可能已经完成
+                    if row is not None and time.time() - row[5] < ttl:
+                        self.release(key, until)
+                        inc('cache_hits', host)
+                        self.touch(key)
+                        return to_response(row)
+            if until is not None:
+                break
+            if time.time() - t0 > self.lease: #其他进程的请求没有结果，不取得租约直接请求
+                break
+            time.sleep(0.1) #其他进程(线程)正在请求
+        inc('cache_misses', host)
+        try:
+            return self.fetch(key, endpoint, get, url, until, **kwargs)
+        except Exception:
+            if row is None or stale <= 0: #stale为0的endpoint不返回过期的响应
+                raise
+            inc('cache_stale', host)
+            return to_response(row) #过期的响应总比没有好
+
+    def touch(self, key):
+        '''记录访问时间，累计touch_n个或超过touch_s秒时写入'''
+        with self.touch_lock:
+            self.touched[key] = time.time()
+            due = len(self.touched) >= self.touch_n or time.time() - self.t_touch > self.touch_s
+        if due:
+            self.flush_touched()
+        return
+
+    def flush_touched(self):
+        with self.touch_lock:
+            items = [(t, key) for key, t in self.touched.items()]
+            self.touched = {}
+            self.t_touch = time.time()
+        if items:
+            conn = self.connect()
+            conn.executemany('UPDATE responses SET accessed=? WHERE key=?', items)
+            conn.commit()
+        return
+
+    def clear(self, endpoint=None):
+        conn = self.connect()
+        if endpoint is None:
+            conn.execute('DELETE FROM responses')
+        else:
+            conn.execute('DELETE FROM responses WHERE endpoint=?', (endpoint,))
+        conn.commit()
+        return
+
+
+#%% 全局实例，各个api模块共用
+HTTP_CACHE = ResponseCache()
+
+def cached_get(get, url, endpoint, **kwargs):
+    '''与timed_get相同，endpoint决定TTL'''
+    return HTTP_CACHE.get(get, url, endpoint, **kwargs)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+进程内的读取缓存，供各个api类的load_*方法使用
+
+@author: yhzhang
+"""
+import os
+import threading
+from collections import OrderedDict
+
+
+#%% key
+def cache_key(db_dir, stk_str, day_str=None, columns=None, dtype=None):
+    '''生成(store, symbol, day, columns, dtype)的可hash的key'''
+    col_key = None if columns is None else tuple(columns)
+    typ_key = None if dtype is None else tuple(sorted((k, str(v)) for k,v in dtype.items()))
+    return (str(db_dir), stk_str, day_str, col_key, typ_key)
+
+def file_stamp(fn):
+    '''文件的(mtime, size)，任一变化则缓存失效'''
+    st = os.stat(fn)
+    return (st.st_mtime_ns, st.st_size)
+
+def df_nbytes(df):
+    '''df占用的内存大小，包括object列'''
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+#%% LRU cache
+class LoadCache:
+    '''
+    以字节数为上限的LRU缓存，按文件mtime/size判断失效
+    返回的是缓存中的df本身，调用方不要原地修改，需要修改时copy=True
+    '''
+
+    def __init__(self, max_bytes=512*1024**2):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._dict = OrderedDict() #key: (stamp, df, nbytes)
+        self._lock = threading.Lock()
+
+    def get(self, fn, key, loader, copy=False):
+        '''命中且文件未变化时直接返回，否则调用loader()读取并放入缓存'''
+        stamp = file_stamp(fn)
+        with self._lock:
+            item = self._dict.get(key)
+            if item is not None and item[0] == stamp:
+                self._dict.move_to_end(key)
+                self.hits += 1
+                return item[1].copy() if copy else item[1]
+
+        df = loader() #读取不占用锁，多线程读取不同文件不会互相阻塞
+        nbytes = df_nbytes(df)
+        with self._lock:
+            self.misses += 1
+            self._pop(key)
+            if nbytes <= self.max_bytes:
+                self._dict[key] = (stamp, df, nbytes)
+                self.nbytes += nbytes
+                while self.nbytes > self.max_bytes:
+                    self._pop(next(iter(self._dict)))
+        return df.copy() if copy else df
+
+    def _pop(self, key):
+        item = self._dict.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[2]
+        return
+
+    def invalidate(self, key):
+        with self._lock:
+            self._pop(key)
+        return
+
+    def clear(self):
+        with self._lock:
+            self._dict.clear()
+            self.nbytes = 0
+        return
+
+    def info(self):
+        return {'items': len(self._dict), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def cached_read(cache, fn, key, loader):
+    '''cache为None时直接读取，用于各类中可选的缓存'''
+    if cache is None:
+        return loader()
+    return cache.get(fn, key, loader)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+热路径的耗时统计：fetch/parse/persist各阶段按host的直方图，以及bytes/errors/retries计数
+定期导出到json文件，或者在本地端口提供/metrics文本
+
+@author: yhzhang
+"""
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+
+#%% histogram
+#直方图上界(秒)，0.5ms~60s按约1.5倍递增
+BUCKETS = tuple(round(0.0005 * 1.5**i, 6) for i in range(30) if 0.0005 * 1.5**i < 60) + (60.0, float('inf'))
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, v):
+        self.counts[bisect_left(BUCKETS, v)] += 1
+        self.n += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+        return
+
+    def quantile(self, q):
+        '''按桶的上界估计分位数'''
+        if self.n == 0:
+            return float('nan')
+        k = q * self.n
+        cum = 0
+        for ub,c in zip(BUCKETS, self.counts):
+            cum += c
+            if cum >= k:
+                return min(ub, self.max)
+        return self.max
+
+    def summary(self):
+        return {'n': self.n, 'mean': self.total / self.n if self.n else float('nan'),
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'max': self.max}
+
+
+#%% registry
+def url_host(url):
+    return urlsplit(url).hostname or ''
+
+class Metrics:
+
+    def __init__(self):
+        self.hists = {} #key=(stage, host)
+        self.counters = {} #key=(name, host)
+        self.lock = threading.Lock()
+        self.t_start = time.time()
+
+    def observe(self, stage, host, seconds):
+        with self.lock:
+            h = self.hists.get((stage, host))
+            if h is None:
+                h = self.hists[(stage, host)] = Histogram()
+            h.observe(seconds)
+        return
+
+    def inc(self, name, host='', value=1):
+        with self.lock:
+            self.counters[(name, host)] = self.counters.get((name, host), 0) + value
+        return
+
+    @contextmanager
+    def timer(self, stage, host=''):
+        '''with timer('fetch', host): ...，异常时同时计入errors'''
+        t0 = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f'{stage}_errors', host)
+            raise
+        finally:
+            self.observe(stage, host, time.perf_counter() - t0)
+
+    def reset(self):
+        with self.lock:
+            self.hists.clear()
+            self.counters.clear()
+            self.t_start = time.time()
+        return
+
+    def snapshot(self):
+        with self.lock:
+            hists = {f'{stage}|{host}': h.summary() for (stage, host),h in self.hists.items()}
+            counters = {f'{name}|{host}': v for (name, host),v in self.counters.items()}
+        return {'time': time.time(), 'uptime': time.time() - self.t_start,
+                'histograms': hists, 'counters': counters}
+
+    def to_text(self):
+        '''prometheus的文本格式'''
+        lines = []
+        with self.lock:
+            for (stage, host),h in sorted(self.hists.items()):
+                lab = f'stage="{stage}",host="{host}"'
+                cum = 0
+                for ub,c in zip(BUCKETS, h.counts):
+                    cum += c
+                    le = '+Inf' if ub == float('inf') else f'{ub}'
+                    lines.append(f'stk_stage_seconds_bucket{{{lab},le="{le}"}} {cum}')
+                lines.append(f'stk_stage_seconds_sum{{{lab}}} {h.total}')
+                lines.append(f'stk_stage_seconds_count{{{lab}}} {h.n}')
+            for (name, host),v in sorted(self.counters.items()):
+                lines.append(f'stk_{name}_total{{host="{host}"}} {v}')
+        return '\n'.join(lines) + '\n'
+
+    def export_file(self, fn):
+        '''写入json，先写临时文件再替换'''
+        tmp = f'{fn}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp, fn)
+        return
+
+    def start_exporter(self, fn=None, port=None, interval=10):
+        '''后台线程每interval秒写一次fn；port不为None时在127.0.0.1:port提供/metrics'''
+        if fn is not None:
+            def loop():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        self.export_file(fn)
+                    except Exception as e:
+                        print('\n', repr(e))
+            threading.Thread(target=loop, daemon=True).start()
+        if port is not None:
+            metrics = self
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.to_text().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, *args):
+                    pass
+            httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            httpd.daemon_threads = True
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return
+
+
+#%% 全局实例，各个api模块共用
+METRICS = Metrics()
+timer = METRICS.timer
+inc = METRICS.inc
+observe = METRICS.observe
+
+def timed_get(get, url, **kwargs):
+    '''get为requests.get或session.get，统计fetch耗时与响应的bytes'''
+    host = url_host(url)
+    with timer('fetch', host):
+        resp = get(url, **kwargs)
+    inc('bytes', host, len(resp.content))
+    inc('requests', host)
+    return resp
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+分钟数据cached的紧凑存储，替代{stk_str: DataFrame}
+    timeindex保存为int64(datetime64[s])，价格等float列保存为int32的10^-4单位(tick)，
+    不能无损转换的列(超过4位小数、NaN、超出int32范围，以及amount)保留float64，
+    volume保存为int64，整列相同的列(stk_nm, stk_str, preclose等)只保存一个值
+    每个代码一个CompactFrame(numpy数组)，需要时再生成DataFrame，还原的值与写入的完全相同
+
+MinuteCache的用法与dict相同：cached[k] = df写入时压缩，cached[k]返回DataFrame
+frames()返回{k: DataFrame}，存储的格式不变；stamps()返回每个key的写入序号，
+pickle_cache把cached本身与stamps交给PklStore.dump，没有变化的key不生成DataFrame
+
+@author: yhzhang
+"""
+import numpy as np
+import pandas as pd
+from collections.abc import MutableMapping
+
+
+#%% compact frame
+TIME_COL = 'timeindex'
+INT_COLS = ('volume',)
+FLOAT64_COLS = ('amount',) #万元，4位小数不够
+DECIMALS = 4
+SCALE = 10 ** DECIMALS
+
+def encode_time(s):
+    '''"YYYY-MM-DD HH:MM:SS"的Series -> int64秒'''
+    t = pd.to_datetime(s, format='%Y-%m-%d %H:%M:%S')
+    return t.to_numpy(dtype='datetime64[s]').view(np.int64)
+
+def decode_time(arr):
+    s = np.datetime_as_string(arr.view('datetime64[s]'), unit='s')
+    return np.char.replace(s, 'T', ' ').astype(object)
+
+def encode_ticks(a):
+    '''float64 -> int32的tick，不能无损还原时返回None'''
+    with np.errstate(invalid='ignore'):
+        ticks = np.round(a * SCALE)
+        if not (np.abs(ticks) < 2**31).all() or not (ticks / SCALE == a).all():
+            return None
+    return ticks.astype(np.int32)
+
+class CompactFrame:
+    '''一个代码的分钟数据：cols为{列名: (类型, 数据)}，类型为const/time/int/tick/obj(其余的列原样保存)'''
+    __slots__ = ('columns', 'cols', 'index', 'n')
+
+    def __init__(self, df):
+        self.columns = list(df.columns)
+        self.n = len(df)
+        self.index = None if isinstance(df.index, pd.RangeIndex) and df.index.start == 0 \
+            and df.index.step == 1 else df.index.to_numpy()
+        self.cols = {}
+        for k in self.columns:
+            s = df[k]
+            is_str = s.dtype == object or pd.api.types.is_string_dtype(s.dtype)
+            if k == TIME_COL and is_str:
+                self.cols[k] = ('time', encode_time(s))
+            elif self.n > 0 and is_str and (s.iat[0] == s).all():
+                self.cols[k] = ('const', s.iat[0])
+            elif k in INT_COLS and s.dtype.kind in 'iuf' and s.notna().all():
+                self.cols[k] = ('int', s.to_numpy(np.int64))
+            elif s.dtype.kind == 'f' and k not in FLOAT64_COLS:
+                if self.n > 0 and (s.iat[0] == s).all():
+                    self.cols[k] = ('const', s.iat[0])
+                else:
+                    a = s.to_numpy(np.float64)
+                    ticks = encode_ticks(a)
+                    self.cols[k] = ('obj', a) if ticks is None else ('tick', ticks)
+            else:
+                self.cols[k] = ('obj', s.to_numpy())
+
+    def column(self, k):
+        typ, v = self.cols[k]
+        if typ == 'const':
+            return np.full(self.n, v, dtype=object if isinstance(v, str) else None)
+        if typ == 'time':
+            return decode_time(v)
+        if typ == 'tick':
+            return v / SCALE
+        return v
+
+    def to_frame(self, columns=None):
+        '''columns为需要的列，None为全部'''
+        columns = self.columns if columns is None else [k for k in self.columns if k in columns]
+        df = pd.DataFrame({k: self.column(k) for k in columns}, copy=False)
+        if self.index is not None:
+            df.index = self.index
+        return df
+
+    def times(self):
+        '''int64秒，不生成字符串'''
+        typ, v = self.cols[TIME_COL]
+        return v if typ == 'time' else encode_time(pd.Series(v))
+
+    def nbytes(self):
+        return sum(v.nbytes for typ,v in self.cols.values() if isinstance(v, np.ndarray))
+
+    def __len__(self):
+        return self.n
+
+
+#%% cache
+class MinuteCache(MutableMapping):
+
+    def __init__(self):
+        self.data = {}
+        self.version = {} #key -> 写入序号
+        self.n_set = 0
+
+    def __setitem__(self, k, df):
+        self.data[k] = df if isinstance(df, CompactFrame) else CompactFrame(df)
+        self.n_set += 1
+        self.version[k] = self.n_set
+
+    def __getitem__(self, k):
+        return self.data[k].to_frame()
+
+    def __delitem__(self, k):
+        del self.data[k]
+        del self.version[k]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def compact(self, k):
+        '''不生成DataFrame，直接返回CompactFrame'''
+        return self.data[k]
+
+    def frames(self, keys=None, columns=None):
+        keys = list(self.data) if keys is None else keys
+        return {k: self.data[k].to_frame(columns) for k in keys if k in self.data}
+
+    def stamps(self):
+        '''{key: 写入序号}，key被重新写入后序号变化'''
+        return dict(self.version)
+
+    def nbytes(self):
+        return sum(v.nbytes() for v in self.data.values())
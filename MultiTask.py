@@ -6,21 +6,31 @@ Created on Wed Aug 31 11:07:51 2022
 """
 import numpy as np 
 import pandas as pd 
+import time
+import threading
 import multiprocessing as mp
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from AuxFunc import t_now
 
 
 #%% multi task
-def mp_process(func, stk_list, N_procs=8, N_loops=1, end_func=None, *args, **kwargs):  
+def mp_process(func, stk_list, N_procs=8, N_loops=1, end_func=None, *args, calendar=None, 
+               initializer=None, initargs=(), **kwargs):  
     '''func需要进行wrapper，只留下接受一个参数的位置。
-    多进程的cpu占用不高，但是内存的开销很大'''
+    多进程的cpu占用不高，但是内存的开销很大
+    calendar不为None时每个loop开始前等待到交易时段内，当天的交易时段结束后不再运行
+    initializer(*initargs)在每个子进程启动时运行(spawn时子进程不继承主进程运行时的修改)
+    return: 每个loop的耗时(秒)的list'''
     stk_idx = np.linspace(0, len(stk_list), N_procs+1).astype(int)
     print('program start @', t_now(1,1))
     
-    with mp.Pool(processes=N_procs) as p:
+    cycle_list = []
+    with mp.Pool(processes=N_procs, initializer=initializer, initargs=initargs) as p:
         for time_i in range(N_loops):
+            if calendar is not None and not calendar.wait_session():
+                break
             print(time_i, 'start @', t_now())
+            t0 = time.perf_counter()
             rst_list = []
             for i in range(N_procs):
                 arg = stk_list[stk_idx[i]:stk_idx[i+1]]
@@ -29,24 +39,34 @@ def mp_process(func, stk_list, N_procs=8, N_loops=1, end_func=None, *args, **kwa
             rst_end = [rst.get() for rst in rst_list] #单次立即执行
             if not end_func is None:
                 end_func(*args, **kwargs)
+            cycle_list.append(time.perf_counter() - t0)
             print(time_i, 'end @', t_now())
             print('-'*100)
         p.close()
         p.join()
         
     print('program end @', t_now(1,1))
-    return 
+    return cycle_list
 
 
-def mp_thread(func, stk_list, N_thread=16, N_loops=1, end_func=None, *args, **kwargs):
+def mp_thread(func, stk_list, N_thread=16, N_loops=1, end_func=None, *args, executor=None, 
+              calendar=None, **kwargs):
     '''func需要进行wrapper，只留下接受一个参数的位置。
-    多线程的cpu占用稍高，但是内存占用显著降低'''
+    多线程的cpu占用稍高，但是内存占用显著降低
+    executor不为None时使用外部常驻的线程池，结束后不关闭
+    calendar不为None时每个loop开始前等待到交易时段内，当天的交易时段结束后不再运行
+    return: 每个loop的耗时(秒)的list'''
     stk_idx = np.linspace(0, len(stk_list), N_thread+1).astype(int)
     print('program start @', t_now(1,1))
     
-    with ThreadPoolExecutor(max_workers=N_thread) as p:
+    cycle_list = []
+    p = ThreadPoolExecutor(max_workers=N_thread) if executor is None else executor
+    try:
         for time_i in range(N_loops):
+            if calendar is not None and not calendar.wait_session():
+                break
             print(time_i, 'start @', t_now())
+            t0 = time.perf_counter()
             rst_list = []
             for i in range(N_thread):
                 arg = stk_list[stk_idx[i]:stk_idx[i+1]]
@@ -56,66 +76,145 @@ def mp_thread(func, stk_list, N_thread=16, N_loops=1, end_func=None, *args, **kw
                 
             if not end_func is None:
                 end_func(*args, **kwargs)
+            cycle_list.append(time.perf_counter() - t0)
             print(time_i, 'end @', t_now())
             print('-'*100)
-        p.shutdown(wait=False)
+    finally:
+        if executor is None:
+            p.shutdown(wait=True)
         
     print('program end @', t_now(1,1))
-    return 
+    return cycle_list
+
+def mp_pipe(func, stk_list, N_thread=16, N_loops=1, end_func=None, *args, calendar=None, **kwargs):
+    '''func为*_pipe方法，接受(stk_list, N_fetch)，并发在流水线内部完成。
+    fetch/parse/persist分开，磁盘写入不阻塞网络请求
+    calendar不为None时每个loop开始前等待到交易时段内
+    return: 每个loop的耗时(秒)的list'''
+    print('program start @', t_now(1,1))
+    cycle_list = []
+    for time_i in range(N_loops):
+        if calendar is not None and not calendar.wait_session():
+            break
+        print(time_i, 'start @', t_now())
+        t0 = time.perf_counter()
+        func(stk_list, N_thread)
+        if not end_func is None:
+            end_func(*args, **kwargs)
+        cycle_list.append(time.perf_counter() - t0)
+        print(time_i, 'end @', t_now())
+        print('-'*100)
+    print('program end @', t_now(1,1))
+    return cycle_list
 
 #%% run here
-from AKapi import AKminute
-from EFapi import EFminute, EFdaily
-from DCapi import DCsnap
+#各个api在函数内导入，只运行DCsnap时不需要导入akshare/efinance
 from functools import partial
-from pathlib import Path
-from AuxFunc import add_cbse, add_uase
+from Universe import load_universe #代码表的读取与缓存，Collector也从这里导入
+from Metrics import METRICS
+from TradeCalendar import TradingCalendar
+from Checkpoint import Throttle
 
 def AK1T_save(stk_list, day_str, db_dir='./AK1T', pkl_prfx='data',
-              N_thread=16, N_loops=1):
+              N_thread=16, N_loops=1, mp_func=mp_thread, calendar=None):
+    from AKapi import AKminute
     akm = AKminute(db_dir)
-    mp_thread(partial(akm.save_minute_multi, cached=True), 
-              stk_list, N_thread=N_thread, N_loops=N_loops, 
-              end_func=partial(akm.pickle_cache, day_str, prefix=pkl_prfx))
+    method = akm.save_minute_pipe if mp_func is mp_pipe else akm.save_minute_multi
+    mp_func(partial(method, cached=True), 
+              stk_list, N_thread, N_loops=N_loops, 
+              end_func=partial(akm.pickle_cache, day_str, prefix=pkl_prfx), calendar=calendar)
     return akm
 
+def AK1T_backfill(stk_list, db_dir='./AK1T', day_list=None, N_thread=16, calendar=None,
+                  rate=None, live_rate=None, background=False):
+    '''
+    补齐最近5个交易日内缺失的分钟数据，并发在backfill内部完成
+    rate/live_rate为每秒请求的代码数(交易时段内使用live_rate)，background=True时在后台线程运行，
+    返回(akm, (thread, stop))，stop.set()后停止
+    '''
+    from AKapi import AKminute
+    akm = AKminute(db_dir)
+    throttle = Throttle(rate, live_rate, calendar)
+    if background:
+        return akm, start_background(akm.backfill, stk_list, day_list, N_workers=N_thread,
+                                     calendar=calendar, throttle=throttle)
+    rst = akm.backfill(stk_list, day_list, N_workers=N_thread, calendar=calendar, throttle=throttle)
+    return akm, rst
+
 def EF1T_save(stk_list, day_str, db_dir='./EF1T', pkl_prfx='data',
-              N_thread=16, N_loops=1):
+              N_thread=16, N_loops=1, mp_func=mp_thread, calendar=None):
+    from EFapi import EFminute
     efm = EFminute(db_dir)
-    mp_thread(partial(efm.save_minute_multi, cached=True), 
-              stk_list, N_thread=N_thread, N_loops=N_loops, 
-              end_func = partial(efm.pickle_cache, day_str, prefix=pkl_prfx))
+    method = efm.save_minute_pipe if mp_func is mp_pipe else efm.save_minute_multi
+    mp_func(partial(method, cached=True), 
+              stk_list, N_thread, N_loops=N_loops, 
+              end_func = partial(efm.pickle_cache, day_str, prefix=pkl_prfx), calendar=calendar)
     return efm
 
 def EF1D_save(stk_list, db_dir='./EF1D', ts='20210101', te='20230101', fqt=0,
-              N_thread=16, N_loops=1):
-    efd = EFdaily('./EF1D')
-    mp_thread(partial(efd.save_daily_multi, ts=ts, te=te, fqt=fqt),
+              N_thread=16, N_loops=1, mp_func=mp_thread):
+    from EFapi import EFdaily
+    efd = EFdaily(db_dir)
+    mp_func(partial(efd.save_daily_multi, ts=ts, te=te, fqt=fqt),
               stk_list, 
-              N_thread=N_thread, N_loops=N_loops, end_func=None)
+              N_thread, N_loops=N_loops, end_func=None)
     return efd
 
+def EF1D_backfill(stk_list, db_dir='./EF1D', ts='20210101', te='20230101', fqt=0, N_thread=4,
+                  rate=None, live_rate=None, calendar=None, background=False):
+    '''
+    可以中断后继续的EF1D_save：完成的代码记录在{db_dir}/checkpoint.db，重新运行时只下载没有完成的
+    rate/live_rate为每秒请求的代码数(calendar不为None时交易时段内使用live_rate)
+    background=True时在后台线程运行，返回(efd, (thread, stop))，否则返回(efd, 本次完成的数量)
+    '''
+    from EFapi import EFdaily
+    efd = EFdaily(db_dir)
+    throttle = Throttle(rate, live_rate, calendar)
+    if background:
+        return efd, start_background(efd.save_daily_resume, stk_list, ts, te, fqt, N_thread,
+                                     throttle=throttle)
+    n = efd.save_daily_resume(stk_list, ts, te, fqt, N_thread, throttle=throttle)
+    return efd, n
+
+def start_background(method, *args, **kwargs):
+    '''method接受stop(threading.Event)参数，在daemon线程中运行，返回(thread, stop)'''
+    stop = threading.Event()
+    th = threading.Thread(target=method, args=args, kwargs=dict(kwargs, stop=stop), daemon=True)
+    th.start()
+    return th, stop
+
 def DCsnap_save(stk_list, cached=False, db_dir='./DCsnap',
-                N_thread=16, N_loops=1):
+                N_thread=16, N_loops=1, mp_func=mp_thread, calendar=None):
+    '''calendar为TradingCalendar时只在交易时段内循环请求'''
+    from DCapi import DCsnap
     dc = DCsnap(db_dir)
-    mp_thread(partial(dc.save_snap_multi, cached=cached),
+    method = dc.save_snap_pipe if mp_func is mp_pipe else dc.save_snap_multi
+    mp_func(partial(method, cached=cached),
               stk_list, 
-              N_thread=N_thread, N_loops=N_loops, end_func=None)
+              N_thread, N_loops=N_loops, end_func=None, calendar=calendar)
     return dc
 
+def EFbill_save(stk_list, db_dir='./EFbill', history=True, panel=True,
+                N_thread=16, N_loops=1, mp_func=mp_thread):
+    '''history=True为增量更新日线资金流向，False为合并当天的分钟资金流向；panel=True时最后生成矩阵'''
+    from EFapi import EFbill
+    efb = EFbill(db_dir)
+    method = efb.save_history_multi if history else efb.save_today_multi
+    day_str = None if history else t_now(1,0)[:10]
+    end_func = partial(efb.build_panel, stk_list, day_str) if panel else None
+    mp_func(method, stk_list, N_thread, N_loops=N_loops, end_func=end_func)
+    return efb
+
 #%% main_func
 
 
 if __name__ == '__main__':
     day_str = '2022-09-01'
-    for f in Path(f'../VSWS/jisilu/{day_str}').iterdir():
-        params = pd.read_csv(f, index_col=0, encoding='gbk', engine='c')
-        break
-    assert len(params)>300, "Error for not reading params_df."
-    cb_list = params['转债代码'].map(str).tolist()
-    cbse_list = [add_cbse(s) for s in cb_list]
-    ua_list = params['正股代码'].map(str).str[1:].tolist()
-    uase_list = [add_uase(s) for s in ua_list]
+    universe = load_universe(f'../VSWS/jisilu/{day_str}')
+    cb_list, cbse_list = universe['cb'], universe['cbse']
+    ua_list, uase_list = universe['ua'], universe['uase']
+    
+    METRICS.start_exporter('./metrics.json', port=None, interval=10) #各阶段耗时的直方图
     
     # raise Exception
     
@@ -124,16 +223,23 @@ if __name__ == '__main__':
     # akm = AK1T_save(uase_list, day_str, db_dir='./DataMinute', pkl_prfx='ua',
     #                 N_thread=16, N_loops=1)
     
+    # akm, rst = AK1T_backfill(cbse_list+uase_list, db_dir='./DataMinute', N_thread=16)
+    
     # efm = EF1T_save(cb_list, day_str, db_dir='./EF1T', pkl_prfx='cb',
     #                 N_thread=16, N_loops=1)
     # efm = EF1T_save(ua_list, day_str, db_dir='./EF1T', pkl_prfx='ua',
     #                 N_thread=16, N_loops=1)
     
+    # efb = EFbill_save(cb_list+ua_list, db_dir='./EFbill', history=True,
+    #                   N_thread=16, N_loops=1)
+    
     # efd = EF1D_save(cb_list+ua_list, db_dir='./EF1D', ts='20210101', te='20230101', fqt=0,
     #                 N_thread=16, N_loops=1)
     
+    calendar = TradingCalendar('./calendar.csv') #非交易时段不请求
+    
     dc = DCsnap_save(cbse_list, cached=False, db_dir='./DCsnap',
-                     N_thread=16, N_loops=1)
+                     N_thread=16, N_loops=1, calendar=calendar)
     
     
     pass
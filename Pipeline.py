@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+fetch -> parse -> persist的分段流水线，stage之间为有界队列，每个stage有独立的并发数
+网络请求不会被磁盘阻塞，磁盘写入也不会占用网络请求的线程
+
+@author: yhzhang
+"""
+import time
+import queue
+import threading
+from collections import defaultdict
+
+from Metrics import inc
+
+
+#%% 目录与文件是否存在的缓存
+class DirCache:
+    '''
+    已经确认存在的目录与文件，避免每次保存都调用Path.exists()
+    确认的结果只保留ttl秒，之后重新访问文件系统，外部删除的文件/目录最多ttl秒后重新创建
+    '''
+
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self.paths = {} #key=path, 确认存在的时间
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        '''进程池pickle时不包含lock，缓存也不需要传递'''
+        return {'ttl': self.ttl}
+
+    def __setstate__(self, dct):
+        self.__init__(dct['ttl'])
+
+    def known(self, path):
+        t = self.paths.get(path)
+        return t is not None and time.monotonic() - t < self.ttl
+
+    def ensure(self, path):
+        '''目录不存在时创建，返回path'''
+        if self.known(path):
+            return path
+        path.mkdir(parents=True, exist_ok=True)
+        self.add(path)
+        return path
+
+    def exists(self, fn):
+        '''文件是否存在，只有不在缓存中(或者已经过期)时才访问文件系统'''
+        if self.known(fn):
+            return True
+        if fn.exists():
+            self.add(fn)
+            return True
+        self.discard(fn)
+        return False
+
+    def add(self, fn):
+        with self.lock:
+            self.paths[fn] = time.monotonic()
+        return
+
+    def discard(self, fn):
+        with self.lock:
+            self.paths.pop(fn, None)
+        return
+
+
+#%% pipeline
+_STOP = object()
+
+def group_by_dir(batch, fn_func):
+    '''把writer的一批数据按所在目录分组，key为目录'''
+    rst = defaultdict(list)
+    for item in batch:
+        fn = fn_func(item)
+        rst[fn.parent].append((fn, item))
+    return rst
+
+def run_pipeline(items, fetch, parse, write, N_fetch=16, N_parse=1, N_write=1,
+                 maxsize=64, batch=64, name=''):
+    '''
+    fetch(item) -> raw, 网络请求
+    parse(item, raw) -> obj, 解析
+    write(list of (item, obj)) -> None, 一次写入一批，writer从队列中一次最多取batch个
+    maxsize为stage之间队列的长度上限，下游变慢时上游阻塞
+    return: (成功的item数量, [(item, stage, repr(e)), ...])
+    '''
+    fetch_q = queue.Queue()
+    parse_q = queue.Queue(maxsize=maxsize)
+    write_q = queue.Queue(maxsize=maxsize)
+    errors = []
+    n_ok = [0]
+    lock = threading.Lock()
+
+    def on_error(item, stage, e):
+        inc(f'{stage}_errors', name)
+        with lock:
+            errors.append((item, stage, repr(e)))
+        print('\n', repr(e))
+        print(f'\tError of {item} @ {stage}.')
+
+    def fetch_worker():
+        while True:
+            item = fetch_q.get()
+            if item is _STOP:
+                return
+            try:
+                parse_q.put((item, fetch(item)))
+            except Exception as e:
+                on_error(item, 'fetch', e)
+
+    def parse_worker():
+        while True:
+            task = parse_q.get()
+            if task is _STOP:
+                return
+            item, raw = task
+            try:
+                write_q.put((item, parse(item, raw)))
+            except Exception as e:
+                on_error(item, 'parse', e)
+
+    def write_worker():
+        stop = False
+        while not stop:
+            task = write_q.get()
+            if task is _STOP:
+                return
+            tasks = [task]
+            while len(tasks) < batch: #队列中已有的数据一起写入
+                try:
+                    task = write_q.get_nowait()
+                except queue.Empty:
+                    break
+                if task is _STOP:
+                    stop = True
+                    break
+                tasks.append(task)
+            try:
+                write(tasks)
+                with lock:
+                    n_ok[0] += len(tasks)
+                print(f'\r{name} {n_ok[0]} items saved, last {tasks[-1][0]}.', end='')
+            except Exception as e:
+                on_error([t[0] for t in tasks], 'persist', e)
+
+    items = list(items)
+    for item in items:
+        fetch_q.put(item)
+    stages = []
+    for worker,N,q in [(fetch_worker, N_fetch, fetch_q), (parse_worker, N_parse, parse_q),
+                       (write_worker, N_write, write_q)]:
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(N)]
+        for t in threads:
+            t.start()
+        stages.append((threads, q))
+    #上游stage全部结束后再向下游发送结束信号
+    for threads,q in stages:
+        for _ in threads:
+            q.put(_STOP)
+        for t in threads:
+            t.join()
+    print()
+    return n_ok[0], errors
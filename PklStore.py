@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+增量、压缩、可部分读取的cached存储，替代整体pickle的pickle_cache/load_pkl
+
+数据文件{prefix}{day}.pkz中每个key是一个独立的zlib压缩块，只追加写入；
+索引文件{prefix}{day}.pkz.idx记录key -> (offset, length, crc, raw_len)，以及数据文件的代数gen
+    compact写入新一代的数据文件{prefix}{day}.pkz.{gen}，替换索引之后再删除旧的数据文件，
+    任何时候中断，索引都指向完整的数据文件
+
+@author: yhzhang
+"""
+import os
+import zlib
+import _pickle as cp
+from pathlib import Path
+
+
+#%% block store
+class PklStore:
+
+    def __init__(self, fn, level=1):
+        '''fn为数据文件路径，level为zlib压缩等级'''
+        self.fn = Path(fn)
+        self.idx_fn = self.fn.with_name(self.fn.name + '.idx')
+        self.level = level
+        self.stamps = {} #key -> 上次写入时调用方给出的stamp，只在内存中
+        self.index, self.dead, self.gen = self._read_index()
+
+    def _read_index(self):
+        if not self.idx_fn.exists():
+            return {}, 0, 0
+        with open(self.idx_fn, 'rb') as f:
+            rst = cp.load(f)
+        return rst['index'], rst['dead'], rst.get('gen', 0)
+
+    def _write_index(self):
+        '''先写临时文件再替换，中断时旧索引仍然指向有效的块'''
+        tmp = self.idx_fn.with_name(self.idx_fn.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            cp.dump({'index': self.index, 'dead': self.dead, 'gen': self.gen}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.idx_fn)
+        return
+
+    def data_fn(self, gen=None):
+        '''第gen代的数据文件，第0代为fn本身(兼容没有gen的索引)'''
+        gen = self.gen if gen is None else gen
+        return self.fn if gen == 0 else self.fn.with_name(f'{self.fn.name}.{gen}')
+
+    def dump(self, dct, stamps=None):
+        '''
+        只写入与上次dump相比发生变化的key，返回写入的key数量
+        stamps为{key: stamp}(例如MinuteCache.stamps())，stamp与上次写入时相同的key不读取dct[k]、不pickle
+        '''
+        stamps = {} if stamps is None else stamps
+        changed, seen = [], {}
+        for k in dct.keys():
+            stamp = stamps.get(k)
+            if stamp is not None and k in self.index and self.stamps.get(k) == stamp:
+                continue
+            raw = cp.dumps(dct[k], -1)
+            crc = zlib.crc32(raw)
+            seen[k] = stamp
+            item = self.index.get(k)
+            if item is not None and item[2] == crc and item[3] == len(raw):
+                continue
+            changed.append((k, raw, crc))
+        if len(changed) == 0:
+            self.stamps.update(seen)
+            return 0
+
+        with open(self.data_fn(), 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            for k,raw,crc in changed:
+                blk = zlib.compress(raw, self.level)
+                f.write(blk)
+                if k in self.index:
+                    self.dead += self.index[k][1]
+                self.index[k] = (offset, len(blk), crc, len(raw))
+                offset += len(blk)
+        self._write_index()
+        self.stamps.update(seen) #写入成功后才记录
+
+        live = sum(item[1] for item in self.index.values())
+        if self.dead > live: #失效块多于有效块时整理文件
+            self.compact()
+        return len(changed)
+
+    def load(self, keys=None):
+        '''读取keys对应的数据，keys=None时读取全部，只读取需要的块'''
+        self.index, self.dead, self.gen = self._read_index()
+        if keys is None:
+            keys = list(self.index.keys())
+        rst = {}
+        items = sorted((self.index[k][0], k) for k in keys if k in self.index)
+        with open(self.data_fn(), 'rb') as f:
+            for offset,k in items:
+                f.seek(offset)
+                blk = f.read(self.index[k][1])
+                rst[k] = cp.loads(zlib.decompress(blk))
+        return rst
+
+    def keys(self):
+        return list(self._read_index()[0].keys())
+
+    def compact(self):
+        '''
+        把有效的块写入新一代的数据文件，替换索引后再删除旧的数据文件
+        替换索引之前中断时旧索引与旧数据文件不变，新文件在下次compact时被覆盖
+        '''
+        old_fn, new_fn = self.data_fn(), self.data_fn(self.gen + 1)
+        index = {}
+        offset = 0
+        with open(old_fn, 'rb') as f_in, open(new_fn, 'wb') as f_out:
+            for k,(off,length,crc,raw_len) in self.index.items():
+                f_in.seek(off)
+                f_out.write(f_in.read(length))
+                index[k] = (offset, length, crc, raw_len)
+                offset += length
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        self.index, self.dead, self.gen = index, 0, self.gen + 1
+        self._write_index()
+        old_fn.unlink(missing_ok=True)
+        return
+
+
+#%% 供AKminute/EFminute使用
+def pkl_fn(db_dir, day_str, prefix='data'):
+    return Path(db_dir).joinpath(f'{prefix}{day_str}.pkz')
+
+def load_legacy_pkl(db_dir, day_str, prefix='data', keys=None):
+    '''读取旧格式的整体pkl文件'''
+    fn = Path(db_dir).joinpath(f'{prefix}{day_str}.pkl')
+    with open(fn, 'rb') as f:
+        rst = cp.load(f)
+    if keys is not None:
+        rst = {k:rst[k] for k in keys if k in rst}
+    return rst
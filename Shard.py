@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+多个worker(进程或者主机)分片采集
+    代码按一致性哈希(HashRing)分配给worker，增减worker时只有少量代码换手
+    每轮coordinator把分片发给worker，worker用Collector的job配置写入自己的目录，
+    结束后把有变化的文件(追加时只有新增的部分)发回，由coordinator合并到同一个db_dir并更新catalog
+    worker断开或者超时则从ring中去掉，它的代码在同一轮内重新分配给其余的worker
+    代码换到新的worker时，先把主存储中当天以及不分日期的文件发给它，增量更新/追加写入保持一致
+
+通信使用multiprocessing.connection(pickle + authkey)，可以在本机多进程或者多台主机之间运行
+    pickle的连接只能在可信的网络中使用：authkey由config['authkey']或者环境变量CB_SHARD_AUTHKEY给出，
+    没有authkey时不启动(local模式每次随机生成)；coordinator默认只监听127.0.0.1，
+    其他主机上的worker通过ssh隧道连接(ssh -L 6000:127.0.0.1:6000 coordinator_host)
+只合并csv，各个worker的pkl/panel缓存不合并，需要时在主存储上重新生成
+
+使用方法:
+    export CB_SHARD_AUTHKEY=...
+    python Shard.py coordinator collector.json 127.0.0.1:6000 N_workers
+    python Shard.py worker 127.0.0.1:6000 [work_dir]
+    python Shard.py local collector.json N_workers
+
+@author: yhzhang
+"""
+import os
+import sys
+import time
+import zlib
+import bisect
+import socket
+import hashlib
+import threading
+import multiprocessing as mp
+from pathlib import Path
+from multiprocessing.connection import Listener, Client, wait
+
+from AuxFunc import t_now
+from Catalog import Catalog
+from MultiTask import mp_thread
+from Collector import Collector, JOB_SPECS
+
+
+#%% hash ring
+class HashRing:
+
+    def __init__(self, nodes=(), vnodes=64):
+        '''每个node在环上放vnodes个虚拟节点，代码分给顺时针方向的第一个虚拟节点'''
+        self.vnodes = vnodes
+        self.keys = [] #排序的hash
+        self.ring = {} #key=hash, node
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def add(self, node):
+        for i in range(self.vnodes):
+            h = self.hash(f'{node}#{i}')
+            self.ring[h] = node
+            bisect.insort(self.keys, h)
+        return
+
+    def remove(self, node):
+        for i in range(self.vnodes):
+            h = self.hash(f'{node}#{i}')
+            if self.ring.pop(h, None) is not None:
+                self.keys.pop(bisect.bisect_left(self.keys, h))
+        return
+
+    def nodes(self):
+        return set(self.ring.values())
+
+    def node(self, key):
+        if len(self.keys) == 0:
+            return None
+        i = bisect.bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.ring[self.keys[i]]
+
+    def assign(self, stk_iter):
+        '''返回{node: [stk_str, ...]}，保持stk_iter中的顺序'''
+        rst = {}
+        for stk_str in stk_iter:
+            rst.setdefault(self.node(stk_str), []).append(stk_str)
+        return rst
+
+
+#%% worker
+AUTHKEY_ENV = 'CB_SHARD_AUTHKEY'
+MERGE_SUFFIX = ('.csv',)
+
+def get_authkey(config=None):
+    '''config['authkey']或者环境变量CB_SHARD_AUTHKEY，都没有时报错'''
+    key = (config or {}).get('authkey') or os.environ.get(AUTHKEY_ENV)
+    if not key:
+        raise Exception(f'No authkey: set config["authkey"] or environment variable {AUTHKEY_ENV}.')
+    return key.encode('utf-8') if isinstance(key, str) else key
+
+def split_rel(rel):
+    '''相对路径 -> (day, stk_str)，{day}/{stk_str}.csv或者{stk_str}.csv(day为'')'''
+    parts = rel.split('/')
+    day = parts[0] if len(parts) == 2 and len(parts[0]) == 10 else ''
+    return day, parts[-1].rsplit('.', 1)[0]
+
+def collect_changes(root, sent):
+    '''
+    root中上次发送之后有变化的文件，返回[(rel, offset, data), ...]
+    sent: {rel: (size, crc, mtime_ns)}为已经发送的状态，原内容没有改变时只发送offset之后追加的部分
+    '''
+    rst = []
+    root = Path(root)
+    if not root.exists():
+        return rst
+    for fn in root.rglob('*'):
+        if fn.suffix not in MERGE_SUFFIX or not fn.is_file():
+            continue
+        rel = fn.relative_to(root).as_posix()
+        st = fn.stat()
+        old = sent.get(rel)
+        if old is not None and old[0] == st.st_size and old[2] == st.st_mtime_ns:
+            continue
+        with open(fn, 'rb') as f:
+            data = f.read()
+        crc = zlib.crc32(data)
+        if old is not None and old[0] == len(data) and old[1] == crc:
+            pass
+        elif old is not None and old[0] < len(data) and zlib.crc32(data[:old[0]]) == old[1]:
+            rst.append((rel, old[0], data[old[0]:]))
+        else:
+            rst.append((rel, 0, data))
+        sent[rel] = (len(data), crc, st.st_mtime_ns)
+    return rst
+
+def job_encoding(job):
+    '''job的csv编码，AKapi为utf-8，其余为gbk'''
+    return 'utf-8' if JOB_SPECS[job][0] == 'AKapi' else 'gbk'
+
+def receive_handoff(obj, db_dir, rel, data, encoding):
+    '''
+    写入换手的文件，并清除provider中该代码的状态：
+    catalog的记录按新文件重新计算，DCsnap的差分基准/header、EFbill的游标等在reset中清除
+    '''
+    fn = db_dir.joinpath(rel)
+    fn.parent.mkdir(parents=True, exist_ok=True)
+    day, stk_str = split_rel(rel)
+    if getattr(obj, 'catalog', None) is not None:
+        obj.catalog.write_bytes(fn, day, stk_str, data, encoding=encoding)
+    else:
+        with open(fn, 'wb') as f:
+            f.write(data)
+    if getattr(obj, 'dirs', None) is not None:
+        obj.dirs.discard(fn)
+    if hasattr(obj, 'reset'):
+        obj.reset(stk_str)
+    return fn
+
+def run_worker(address, authkey=None, name=None, work_dir='./shard'):
+    '''
+    连接coordinator并循环处理分片，直到收到stop或者连接断开
+    每个job写入{work_dir}/{name}/{job}，authkey为None时使用get_authkey()
+    '''
+    name = f'{socket.gethostname()}-{os.getpid()}' if name is None else name
+    authkey = get_authkey() if authkey is None else authkey
+    conn = Client(tuple(address), authkey=authkey)
+    conn.send(('hello', name))
+    _, config = conn.recv()
+    collector = Collector(dict(config, jobs=[]))
+    root = Path(work_dir, name)
+    sent_dct = {} #key=job目录
+    try:
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                break
+            if msg[0] == 'stop':
+                break
+            _, spec, shard, handoff = msg
+            db_dir = root.joinpath(spec['job'])
+            db_dir.mkdir(parents=True, exist_ok=True)
+            sent = sent_dct.setdefault(db_dir, {})
+            obj = collector.get_provider(spec['job'], str(db_dir))
+            for rel, data in handoff: #换手的代码先同步主存储中的文件，之前的状态作废
+                fn = receive_handoff(obj, db_dir, rel, data, job_encoding(spec['job']))
+                sent[rel] = (len(data), zlib.crc32(data), fn.stat().st_mtime_ns)
+            func, _ = collector.build_task(dict(spec, db_dir=str(db_dir)))
+            t0 = time.perf_counter()
+            mp_thread(func, shard, collector.N_thread, 1, executor=collector.pool)
+            conn.send(('done', collect_changes(db_dir, sent), time.perf_counter() - t0))
+    finally:
+        conn.close()
+        collector.close()
+    return
+
+
+#%% coordinator
+class Coordinator:
+
+    def __init__(self, config=None, address=('127.0.0.1', 0), authkey=None, vnodes=64,
+                 round_timeout=600):
+        '''
+        config为发给worker的Collector配置(jisilu, N_thread等)，address端口为0时自动选择
+        authkey为None时使用get_authkey(config)
+        '''
+        config = {} if config is None else config
+        authkey = get_authkey(config) if authkey is None else authkey
+        self.config = {k:v for k,v in config.items() if k != 'authkey'} #authkey不发给worker
+        self.vnodes = vnodes
+        self.round_timeout = round_timeout
+        self.ring = HashRing(vnodes=vnodes)
+        self.workers = {} #key=name, conn
+        self.owner = {} #key=(db_dir, stk_str), 上一轮采集该代码的worker
+        self.catalogs = {} #key=db_dir
+        self.lock = threading.Lock()
+        self.closed = False
+        self.listener = Listener(tuple(address), authkey=authkey)
+        self.address = self.listener.address
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        '''新的worker加入ring，从下一轮开始分到代码'''
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+                _, name = conn.recv()
+                conn.send(('config', self.config))
+            except Exception as e:
+                if self.closed:
+                    break
+                print(repr(e))
+                print('\tError of accepting worker.')
+                continue
+            with self.lock:
+                self.workers[name] = conn
+                self.ring.add(name)
+            print(f'worker {name} joined @ {t_now()}')
+        return
+
+    def wait_workers(self, n, timeout=60):
+        t0 = time.time()
+        while len(self.workers) < n and time.time() - t0 < timeout:
+            time.sleep(0.05)
+        return len(self.workers)
+
+    def drop(self, name):
+        with self.lock:
+            conn = self.workers.pop(name, None)
+            self.ring.remove(name)
+        if conn is not None:
+            conn.close()
+        print(f'worker {name} dropped @ {t_now()}')
+        return
+
+    def get_catalog(self, db_dir):
+        if db_dir not in self.catalogs:
+            db_dir.mkdir(parents=True, exist_ok=True)
+            self.catalogs[db_dir] = Catalog(db_dir)
+        return self.catalogs[db_dir]
+
+    def handoff(self, db_dir, name, shard, day_str):
+        '''shard中上一轮不属于name的代码：主存储中day_str以及不分日期的文件'''
+        rst = []
+        for stk_str in shard:
+            if self.owner.get((db_dir, stk_str)) == name:
+                continue
+            for rel in (f'{day_str}/{stk_str}.csv', f'{stk_str}.csv'):
+                fn = db_dir.joinpath(rel)
+                if fn.exists():
+                    with open(fn, 'rb') as f:
+                        rst.append((rel, f.read()))
+        return rst
+
+    def merge(self, db_dir, files, encoding):
+        '''worker发回的文件写入主存储并更新catalog'''
+        catalog = self.get_catalog(db_dir)
+        for rel, offset, data in files:
+            fn = db_dir.joinpath(rel)
+            fn.parent.mkdir(parents=True, exist_ok=True)
+            day, stk_str = split_rel(rel)
+            if offset > 0 and (not fn.exists() or fn.stat().st_size < offset):
+                print(f'\tError of merging {rel}: offset {offset} beyond file.')
+                continue
+            catalog.write_bytes(fn, day, stk_str, data, offset, encoding=encoding)
+        catalog.flush()
+        return
+
+    def run_round(self, spec, stk_list, day_str=None):
+        '''
+        运行一轮：按ring分片并发给各个worker，等待全部完成并合并
+        worker断开或者超过round_timeout时，它未完成的代码按其余worker组成的ring重新分配
+        return: {worker: 耗时(秒)}
+        '''
+        day_str = t_now(1,0)[:10] if day_str is None else day_str
+        db_dir = Path(spec.get('db_dir', f"./{spec['job']}")).resolve()
+        encoding = job_encoding(spec['job'])
+        with self.lock:
+            workers = dict(self.workers)
+            queue = {name: [] for name in workers}
+            for name, shard in self.ring.assign(stk_list).items():
+                queue[name].append(shard)
+        busy = {} #key=conn, (name, shard, t0)
+        cost = {}
+
+        def dispatch(name):
+            if name not in workers or len(queue[name]) == 0 or \
+                    any(v[0] == name for v in busy.values()):
+                return
+            shard = queue[name].pop(0)
+            try:
+                workers[name].send(('run', spec, shard, self.handoff(db_dir, name, shard, day_str)))
+                busy[workers[name]] = (name, shard, time.time())
+            except OSError as e:
+                print(repr(e))
+                fail(name, shard)
+
+        def fail(name, shard):
+            '''只把name的代码分给其余worker，其他代码的分配不变'''
+            pending = shard + sum(queue.pop(name, []), [])
+            workers.pop(name, None)
+            self.drop(name)
+            if len(workers) == 0:
+                raise Exception(f'No shard worker left, {len(pending)} stocks not collected.')
+            for name2, sub in HashRing(workers, self.vnodes).assign(pending).items():
+                queue[name2].append(sub)
+                dispatch(name2)
+
+        if len(workers) == 0:
+            raise Exception('No shard worker.')
+        for name in list(workers):
+            dispatch(name)
+        while busy:
+            for conn in wait(list(busy), timeout=1):
+                name, shard, t0 = busy.pop(conn)
+                try:
+                    _, files, dt = conn.recv()
+                except (EOFError, OSError) as e:
+                    print(repr(e))
+                    fail(name, shard)
+                    continue
+                self.merge(db_dir, files, encoding)
+                for stk_str in shard:
+                    self.owner[(db_dir, stk_str)] = name
+                cost[name] = cost.get(name, 0) + dt
+                dispatch(name)
+            for conn,(name, shard, t0) in list(busy.items()):
+                if time.time() - t0 > self.round_timeout:
+                    busy.pop(conn)
+                    print(f'\tError of worker {name}: timeout.')
+                    fail(name, shard)
+        return cost
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            workers = dict(self.workers)
+            self.workers.clear()
+        for conn in workers.values():
+            try:
+                conn.send(('stop',))
+            except OSError:
+                pass
+            conn.close()
+        self.listener.close()
+        for catalog in self.catalogs.values():
+            catalog.flush()
+        return
+
+
+#%% run
+def serve(config, address, N_workers=1, coordinator=None):
+    '''按config['jobs']依次运行，每个job运行N_loops轮(间隔interval秒)'''
+    coord = Coordinator(config, address) if coordinator is None else coordinator
+    print('coordinator listening on', coord.address)
+    coord.wait_workers(N_workers, timeout=config.get('worker_timeout', 600))
+    universe = Collector(dict(config, jobs=[])) #只用于读取代码表
+    try:
+        for spec in config['jobs']:
+            stk_list = universe.job_universe(spec)
+            for i in range(spec.get('N_loops', 1)):
+                t0 = time.time()
+                try:
+                    cost = coord.run_round(spec, stk_list)
+                    print(spec['job'], i, {k: round(v, 2) for k,v in cost.items()})
+                except Exception as e:
+                    print(repr(e))
+                    print(f"\tError of job {spec.get('job')}.")
+                    break
+                dt = spec.get('interval', 0) - (time.time() - t0)
+                if dt > 0:
+                    time.sleep(dt)
+    finally:
+        coord.close()
+        universe.close()
+    return
+
+def run_local(config, N_workers=3, work_dir='./shard', process=True):
+    '''本机运行：coordinator监听localhost，启动N_workers个worker进程(process=False时为线程)'''
+    authkey = os.urandom(32) #只在本机的进程之间使用
+    coord = Coordinator(config, ('127.0.0.1', 0), authkey)
+    start = mp.Process if process else threading.Thread
+    procs = [start(target=run_worker, args=(coord.address, authkey, f'w{i}', work_dir), daemon=True)
+             for i in range(N_workers)]
+    for p in procs:
+        p.start()
+    serve(config, coord.address, N_workers, coordinator=coord)
+    for p in procs:
+        p.join(timeout=10)
+    return
+
+def parse_address(s):
+    host, port = s.rsplit(':', 1)
+    return host, int(port)
+
+
+#%% main
+if __name__ == '__main__':
+    import json
+    mode = sys.argv[1]
+    if mode == 'worker':
+        run_worker(parse_address(sys.argv[2]), work_dir=sys.argv[3] if len(sys.argv) > 3 else './shard')
+    else:
+        with open(sys.argv[2], encoding='utf-8') as f:
+            config = json.load(f)
+        if mode == 'coordinator':
+            serve(config, parse_address(sys.argv[3]), int(sys.argv[4]) if len(sys.argv) > 4 else 1)
+        else:
+            run_local(config, int(sys.argv[3]) if len(sys.argv) > 3 else 3)
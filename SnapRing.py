@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+实时盘口的共享内存ring buffer：DCsnap采集时发布，本机的策略/监控进程直接读取，不经过csv
+    每个代码一个固定长度的slot数组，tick为固定的TICK_DTYPE，seq为该代码的第几个tick(从1开始)
+    heads[i]为代码i最新的seq，消费者比较heads即可知道哪些代码有更新
+    每个代码只有一个写入者：先把slot的seq置为0，写入字段，再写seq与heads，
+    读者(seqlock)复制slot之后重新读取slot的seq，复制前后seq都等于期望值的tick才返回，
+    复制过程中被写入或者覆盖的tick不返回
+
+共享内存的布局: header(magic, n_sym, n_slots, 0) | codes(S8 x n_sym) | heads(i8 x n_sym) |
+               ticks(TICK_DTYPE x n_sym x n_slots)
+
+@author: yhzhang
+"""
+import time
+import numpy as np
+import pandas as pd
+import datetime as dtm
+from multiprocessing import shared_memory, resource_tracker
+
+
+#%% tick
+MAGIC = 0x534e4150 #'SNAP'
+PRICE_FIELDS = ['preclose', 'open', 'high', 'low', 'last', 'avgp', 'amount']
+BOOK_P = [f'{typ}{i}p' for typ in ['ask', 'bid'] for i in range(1,6)]
+BOOK_V = [f'{typ}{i}v' for typ in ['ask', 'bid'] for i in range(1,6)]
+TICK_DTYPE = np.dtype([('seq', '<i8'), ('time', '<i8'), ('local_ns', '<i8'), ('volume', '<i8')] +
+                      [(k, '<f8') for k in PRICE_FIELDS + BOOK_P] + [(k, '<i4') for k in BOOK_V])
+HEADER_DTYPE = np.dtype('<i8')
+TZ = dtm.timezone(dtm.timedelta(hours=8))
+
+def _layout(n_sym, n_slots):
+    '''codes, heads, ticks的offset以及总字节数'''
+    o_codes = 4 * HEADER_DTYPE.itemsize
+    o_heads = o_codes + 8 * n_sym
+    o_heads += -o_heads % 8
+    o_ticks = o_heads + 8 * n_sym
+    size = o_ticks + TICK_DTYPE.itemsize * n_sym * n_slots
+    return o_codes, o_heads, o_ticks, size
+
+def tick_time(t_str):
+    '''"YYYY-MM-DD HH:MM:SS"(北京时间) -> epoch秒'''
+    return int(dtm.datetime.fromisoformat(t_str).replace(tzinfo=TZ).timestamp())
+
+def to_frame(ticks):
+    '''tick数组 -> DataFrame，time转换为timeindex字符串'''
+    df = pd.DataFrame(ticks)
+    df.insert(1, 'timeindex', pd.to_datetime(df['time'], unit='s', utc=True)
+              .dt.tz_convert('Asia/Shanghai').dt.strftime('%Y-%m-%d %H:%M:%S'))
+    return df.drop(columns='time')
+
+
+#%% ring
+class SnapRing:
+
+    def __init__(self, name, codes=None, n_slots=1024, create=None):
+        '''
+        codes不为None时创建(已存在同名的则先删除)，否则按name连接已有的共享内存
+        codes为no-SE格式的代码，与dc_get_snap返回的code一致
+        '''
+        self.name = name
+        self.owner = codes is not None if create is None else create
+        if self.owner:
+            codes = [str(c) for c in codes]
+            try: #上次异常退出时残留的共享内存
+                old = shared_memory.SharedMemory(name=name)
+                old.close()
+                old.unlink()
+            except FileNotFoundError:
+                pass
+            size = _layout(len(codes), n_slots)[-1]
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            header = np.ndarray(4, HEADER_DTYPE, self.shm.buf)
+            header[:] = (MAGIC, len(codes), n_slots, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self.shm._name, 'shared_memory') #消费者退出时不删除
+        self._attach()
+        if self.owner:
+            self.codes[:] = np.array(codes, dtype='S8')
+            self.heads[:] = 0
+            self.ticks['seq'] = 0
+        self.index = {c.decode(): i for i,c in enumerate(self.codes.tolist())}
+
+    def _attach(self):
+        header = np.ndarray(4, HEADER_DTYPE, self.shm.buf)
+        if header[0] != MAGIC:
+            raise Exception(f'Shared memory {self.name} is not a snap ring.')
+        self.n_sym, self.n_slots = int(header[1]), int(header[2])
+        o_codes, o_heads, o_ticks, _ = _layout(self.n_sym, self.n_slots)
+        self.codes = np.ndarray(self.n_sym, 'S8', self.shm.buf, o_codes)
+        self.heads = np.ndarray(self.n_sym, '<i8', self.shm.buf, o_heads)
+        self.ticks = np.ndarray((self.n_sym, self.n_slots), TICK_DTYPE, self.shm.buf, o_ticks)
+        return
+
+    def __getstate__(self):
+        '''进程池pickle时按name重新连接'''
+        return {'name': self.name}
+
+    def __setstate__(self, dct):
+        self.__init__(dct['name'], create=False)
+
+    #发布
+    def publish(self, rst):
+        '''rst为dc_parse_snap的dict，不在codes中的代码忽略，返回seq'''
+        i = self.index.get(rst['code'])
+        if i is None:
+            return 0
+        seq = int(self.heads[i]) + 1
+        slot = self.ticks[i, seq % self.n_slots]
+        slot['seq'] = 0 #写入过程中读者不会使用这个slot
+        slot['time'] = tick_time(rst['timeindex'])
+        slot['volume'] = rst['volume']
+        for k in PRICE_FIELDS + BOOK_P + BOOK_V:
+            slot[k] = rst[k]
+        slot['local_ns'] = time.time_ns()
+        slot['seq'] = seq
+        self.heads[i] = seq
+        return seq
+
+    #读取
+    def seq(self, code):
+        return int(self.heads[self.index[code]])
+
+    def view(self, code):
+        '''代码的slot数组(共享内存上的view，不复制)，slot的顺序为seq % n_slots'''
+        return self.ticks[self.index[code]]
+
+    def latest(self, code, n=1):
+        '''最近n个tick(按seq升序)，复制后重新读取seq，写入中或者已被覆盖的tick去掉'''
+        i = self.index[code]
+        head = int(self.heads[i])
+        n = min(n, head, self.n_slots - 1)
+        if n <= 0:
+            return np.empty(0, TICK_DTYPE)
+        seqs = np.arange(head - n + 1, head + 1)
+        slots = seqs % self.n_slots
+        arr = self.ticks[i, slots].copy()
+        ok = (arr['seq'] == seqs) & (self.ticks['seq'][i, slots] == seqs)
+        return arr[ok]
+
+    def last(self, retry=3):
+        '''
+        所有代码的最新tick(n_sym条)，没有数据的代码seq为0
+        复制过程中被写入的代码按新的heads重新读取，retry次之后仍然不一致的seq记为0
+        '''
+        rows = np.arange(self.n_sym)
+        heads = self.heads.copy()
+        arr = self.ticks[rows, heads % self.n_slots].copy()
+        for k in range(retry + 1):
+            bad = (arr['seq'] != heads) | (self.ticks['seq'][rows, heads % self.n_slots] != heads)
+            bad &= heads > 0
+            if not bad.any() or k == retry:
+                break
+            idx = rows[bad]
+            heads[idx] = self.heads[idx]
+            arr[idx] = self.ticks[idx, heads[idx] % self.n_slots]
+        arr['seq'][bad | (heads == 0)] = 0
+        return arr
+
+    def changed(self, last_heads=None):
+        '''返回(有更新的代码list, 当前的heads)，last_heads为上次返回的heads'''
+        heads = self.heads.copy()
+        mask = heads > 0 if last_heads is None else heads != last_heads
+        return [self.codes[i].decode() for i in np.flatnonzero(mask)], heads
+
+    def wait(self, last_heads, timeout=None, interval=0.0005):
+        '''等待到有代码更新，返回同changed；超时时返回([], last_heads)'''
+        t0 = time.perf_counter()
+        while True:
+            codes, heads = self.changed(last_heads)
+            if codes:
+                return codes, heads
+            if timeout is not None and time.perf_counter() - t0 > timeout:
+                return [], last_heads
+            time.sleep(interval)
+
+    def close(self):
+        '''创建者close时同时删除共享内存'''
+        self.codes = self.heads = self.ticks = None
+        self.shm.close()
+        if self.owner: #同一个resource_tracker中的消费者可能已经取消了登记
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
+        return
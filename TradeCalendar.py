@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+本地的交易日历与交易时段
+    采集循环只在交易日的09:30-11:30, 13:00-15:00内请求
+    各个存储的catalog与交易日对比，得到缺失的(day, stk_str)
+
+交易日保存在本地csv中(默认./calendar.csv)，不存在、超过max_age天没有更新、
+或者查询的日期超过最后一个交易日时用ak.tool_trade_date_hist_sina更新(两次更新至少间隔retry秒)，
+更新推迟到第一次查询交易日时进行，构造时不导入akshare，
+akshare不可用时使用已有的文件，没有文件时退化为周一至周五
+
+@author: yhzhang
+"""
+import time
+import numpy as np
+import pandas as pd
+import datetime as dtm
+from pathlib import Path
+
+from AuxFunc import formal_day
+from Catalog import Catalog
+
+
+#%% calendar
+SESSIONS = (('09:30:00', '11:30:00'), ('13:00:00', '15:00:00'))
+
+class TradingCalendar:
+
+    def __init__(self, fn='./calendar.csv', sessions=SESSIONS, max_age=7, retry=3600):
+        self.fn = Path(fn)
+        self.sessions = sessions
+        self.max_age = max_age
+        self.retry = retry
+        self.t_update = None #上次尝试更新的时间(monotonic)
+        self.days = None #排序的交易日(YYYY-MM-DD)的ndarray，None为只按周一至周五判断
+        if self.fn.exists():
+            self.days = pd.read_csv(self.fn, dtype=str, engine='c')['day'].values
+        #不存在或过期时在第一次查询时更新
+        self.stale = self.days is None or time.time() - self.fn.stat().st_mtime > max_age * 86400
+
+    def refresh(self):
+        '''尝试更新，retry秒之内只尝试一次，失败时保留已有的交易日'''
+        if self.t_update is not None and time.monotonic() - self.t_update < self.retry:
+            return False
+        self.t_update = time.monotonic()
+        try:
+            self.update()
+            return True
+        except Exception as e:
+            print(repr(e))
+            print('\tError of updating calendar, ' +
+                  ('weekdays are used.' if self.days is None else f'{self.fn} is used.'))
+            return False
+
+    def ensure(self, day_str):
+        '''日历过期或day_str超过已有的最后一个交易日时更新日历'''
+        if self.stale:
+            self.stale = False
+            self.refresh()
+        elif self.days is not None and (len(self.days) == 0 or day_str > self.days[-1]):
+            self.refresh()
+        return
+
+    def update(self):
+        '''从新浪获取全部交易日(包含当年剩余的交易日)并保存'''
+        import akshare as ak
+        df = ak.tool_trade_date_hist_sina()
+        days = pd.to_datetime(df['trade_date']).dt.strftime('%Y-%m-%d').values
+        self.days = np.sort(days)
+        pd.DataFrame({'day': self.days}).to_csv(self.fn, index=False)
+        return
+
+    def is_trading_day(self, day_str=None):
+        day_str = dtm.date.today().isoformat() if day_str is None else formal_day(day_str)
+        self.ensure(day_str)
+        if self.days is None:
+            return dtm.date.fromisoformat(day_str).weekday() < 5
+        i = np.searchsorted(self.days, day_str)
+        return i < len(self.days) and self.days[i] == day_str
+
+    def trading_days(self, ts, te):
+        '''ts~te之间(包含两端)的交易日list'''
+        ts, te = formal_day(ts), formal_day(te)
+        self.ensure(te)
+        if self.days is None:
+            days = pd.bdate_range(ts, te).strftime('%Y-%m-%d').values
+        else:
+            days = self.days[np.searchsorted(self.days, ts):np.searchsorted(self.days, te, 'right')]
+        return list(days)
+
+    def last_days(self, n, day_str=None):
+        '''day_str(默认今天)以及之前的n个交易日'''
+        day_str = dtm.date.today().isoformat() if day_str is None else formal_day(day_str)
+        ts = (dtm.date.fromisoformat(day_str) - dtm.timedelta(days=3*n + 15)).isoformat()
+        return self.trading_days(ts, day_str)[-n:]
+
+    def session_day(self, t=None, t_open='09:15:00'):
+        '''
+        t(datetime，默认现在)时行情接口返回的最新交易日：t的日期以及之前最近的交易日，
+        交易日的t_open(集合竞价)之前为上一个交易日
+        '''
+        t = dtm.datetime.now() if t is None else t
+        day = t.date()
+        if t.strftime('%H:%M:%S') < t_open:
+            day = day - dtm.timedelta(days=1)
+        return self.last_days(1, day.isoformat())[-1]
+
+    def in_session(self, t=None):
+        '''t(datetime，默认现在)是否在交易日的交易时段内'''
+        t = dtm.datetime.now() if t is None else t
+        if not self.is_trading_day(t.date().isoformat()):
+            return False
+        t_str = t.strftime('%H:%M:%S')
+        return any(s <= t_str <= e for s,e in self.sessions)
+
+    def next_open(self, t=None):
+        '''t之后(包含t)最近的交易时段开始时间，t在交易时段内时返回t'''
+        t = dtm.datetime.now() if t is None else t
+        if self.in_session(t):
+            return t
+        day = t.date()
+        for _ in range(30):
+            if self.is_trading_day(day.isoformat()):
+                for s,e in self.sessions:
+                    t_open = dtm.datetime.combine(day, dtm.time.fromisoformat(s))
+                    if t_open >= t:
+                        return t_open
+            day = day + dtm.timedelta(days=1)
+        raise Exception(f'No trading session within 30 days after {t}')
+
+    def wait_session(self, end=None):
+        '''
+        sleep到交易时段内；end(HH:MM:SS)不为None且今天的下一个时段在end之后时不等待
+        return: 是否处在交易时段内，False时调用方应结束循环
+        '''
+        t = dtm.datetime.now()
+        t_open = self.next_open(t)
+        if t_open.date() != t.date(): #今天已经没有交易时段
+            return False
+        if end is not None and t_open.time() >= dtm.time.fromisoformat(end):
+            return False
+        dt = (t_open - t).total_seconds()
+        if dt > 0:
+            time.sleep(dt)
+        return True
+
+
+#%% 分区
+def expected_vs_present(db_dir, stk_iter, ts, te, calendar=None, suffix='.csv', encoding='utf-8'):
+    '''
+    ts~te之间每个交易日的(day x stk_str)存在矩阵，只查询db_dir的catalog
+    catalog第一次使用时补充之前已有的文件(ensure_built)，encoding为存储的编码(EF/DC为gbk)
+    '''
+    calendar = TradingCalendar() if calendar is None else calendar
+    day_list = calendar.trading_days(ts, te)
+    catalog = Catalog(db_dir)
+    catalog.ensure_built(suffix, encoding=encoding)
+    return catalog.matrix(stk_iter, day_list)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+可转债与正股代码表(集思录文件)的读取
+只读取代码与名称列并指定类型，解析结果按文件的mtime/size缓存在内存以及同目录的.univ.pkl中
+返回的各个格式的代码list按行对齐，第i个可转债对应第i个正股
+
+@author: yhzhang
+"""
+import os
+import _pickle as cp
+import pandas as pd
+from pathlib import Path
+
+from AuxFunc import add_cbse_vec, add_uase_vec, secid_vec
+
+
+#%% universe
+UNIV_COLS = {'转债代码': str, '转债名称': str, '正股代码': str, '正股名称': str}
+_MEMO = {} #key=文件路径, (mtime_ns, size, rst)
+
+def jisilu_file(jisilu):
+    '''jisilu为文件时直接返回，为目录时返回其中按文件名排序的第一个csv'''
+    path = Path(jisilu)
+    if path.is_file():
+        return path
+    fn_list = sorted(p for p in path.iterdir() if p.suffix == '.csv')
+    if len(fn_list) == 0:
+        raise Exception(f'No jisilu csv in {path}')
+    return fn_list[0]
+
+def parse_universe(fn):
+    '''读取代码与名称列，正股代码为加了前缀1的整数，去掉第一位'''
+    df = pd.read_csv(fn, usecols=list(UNIV_COLS), dtype=UNIV_COLS, encoding='gbk', engine='c')
+    cb = df['转债代码'].to_numpy(dtype=str)
+    ua = df['正股代码'].str[1:].to_numpy(dtype=str)
+    cbse, uase = add_cbse_vec(cb), add_uase_vec(ua)
+    rst = {'cb': cb, 'cbse': cbse, 'cb_sfx': add_cbse_vec(cb, prefix=False), 'cb_secid': secid_vec(cbse),
+           'ua': ua, 'uase': uase, 'ua_sfx': add_uase_vec(ua, prefix=False), 'ua_secid': secid_vec(uase),
+           'cb_nm': df['转债名称'].to_numpy(dtype=str), 'ua_nm': df['正股名称'].to_numpy(dtype=str)}
+    return rst
+
+def load_universe_arrays(jisilu):
+    '''
+    返回{格式: np.ndarray}，格式为cb, cbse, cb_sfx, cb_secid, ua, uase, ua_sfx, ua_secid, cb_nm, ua_nm
+    例如: 110038, sh110038, 110038.SH, 1.110038
+    文件没有变化时使用内存或者.univ.pkl中的结果
+    '''
+    fn = jisilu_file(jisilu)
+    st = os.stat(fn)
+    stamp = (st.st_mtime_ns, st.st_size)
+    item = _MEMO.get(fn)
+    if item is not None and item[0] == stamp:
+        return item[1]
+
+    pkl = fn.with_name(fn.name + '.univ.pkl')
+    rst = None
+    if pkl.exists():
+        with open(pkl, 'rb') as f:
+            saved = cp.load(f)
+        if saved['stamp'] == stamp:
+            rst = saved['rst']
+    if rst is None:
+        rst = parse_universe(fn)
+        try:
+            with open(pkl, 'wb') as f:
+                cp.dump({'stamp': stamp, 'rst': rst}, f, -1)
+        except OSError as e: #只读目录时只缓存在内存中
+            print(repr(e))
+    _MEMO[fn] = (stamp, rst)
+    return rst
+
+def load_universe(jisilu_dir):
+    '''读取jisilu_dir中的集思录文件，返回各个格式的可转债与正股代码list'''
+    rst = load_universe_arrays(jisilu_dir)
+    assert len(rst['cb'])>300, "Error for not reading params_df."
+    return {k: v.tolist() for k,v in rst.items()}
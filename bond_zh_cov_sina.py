@@ -7,10 +7,16 @@ http://vip.stock.finance.sina.com.cn/mkt/#hskzz_z
 """
 import datetime
 import re
+import time
 
 import pandas as pd
 import requests
 requests.adapters.DEFAULT_RETRIES = 10
+#分钟数据的keep-alive session，多个线程共用连接池
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=64)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
 
 from py_mini_racer import py_mini_racer
 from tqdm import tqdm
@@ -24,6 +30,19 @@ from akshare.bond.cons import (
 from akshare.stock.cons import hk_js_decode
 from akshare.utils import demjson
 
+try:
+    from Metrics import timed_get, observe
+    from Hedge import hedged_get
+    from HttpCache import cached_get
+except ImportError: #作为akshare包内文件使用且项目目录不在sys.path时不统计
+    def timed_get(get, url, **kwargs):
+        return get(url, **kwargs)
+    def observe(stage, host, seconds):
+        return
+    def cached_get(get, url, endpoint, **kwargs):
+        return get(url, **kwargs)
+    hedged_get = timed_get
+
 
 def _get_zh_bond_hs_cov_page_count() -> int:
     """
@@ -35,7 +54,7 @@ def _get_zh_bond_hs_cov_page_count() -> int:
     params = {
         "node": "hskzz_z",
     }
-    r = requests.get(zh_sina_bond_hs_cov_count_url, params=params)
+    r = timed_get(requests.get, zh_sina_bond_hs_cov_count_url, params=params)
     page_count = int(re.findall(re.compile(r"\d+"), r.text)[0]) / 80
     if isinstance(page_count, int):
         return page_count
@@ -55,8 +74,8 @@ def bond_zh_hs_cov_spot() -> pd.DataFrame:
     zh_sina_bond_hs_payload_copy = zh_sina_bond_hs_cov_payload.copy()
     for page in tqdm(range(1, page_count + 1), leave=False):
         zh_sina_bond_hs_payload_copy.update({"page": page})
-        res = requests.get(
-            zh_sina_bond_hs_cov_url, params=zh_sina_bond_hs_payload_copy
+        res = timed_get(
+            requests.get, zh_sina_bond_hs_cov_url, params=zh_sina_bond_hs_payload_copy
         )
         data_json = demjson.decode(res.text)
         big_df = pd.concat(
@@ -74,8 +93,8 @@ def bond_zh_hs_cov_daily(symbol: str = "sh010107") -> pd.DataFrame:
     :return: 指定沪深可转债代码的日 K 线数据
     :rtype: pandas.DataFrame
     """
-    r = requests.get(
-        zh_sina_bond_hs_cov_hist_url.format(
+    r = timed_get(
+        requests.get, zh_sina_bond_hs_cov_hist_url.format(
             symbol, datetime.datetime.now().strftime("%Y_%m_%d")
         )
     )
@@ -110,7 +129,7 @@ def _code_id_map() -> dict:
         "fields": "f12",
         "_": "1623833739532",
     }
-    r = requests.get(url, params=params)
+    r = cached_get(requests.get, url, "_code_id_map", params=params)
     data_json = r.json()
     temp_df = pd.DataFrame(data_json["data"]["diff"])
     temp_df["market_id"] = 1
@@ -129,7 +148,7 @@ def _code_id_map() -> dict:
         "fields": "f12",
         "_": "1623833739532",
     }
-    r = requests.get(url, params=params)
+    r = cached_get(requests.get, url, "_code_id_map", params=params)
     data_json = r.json()
     temp_df_sz = pd.DataFrame(data_json["data"]["diff"])
     temp_df_sz["sz_id"] = 0
@@ -143,6 +162,7 @@ def bond_zh_hs_cov_min(
     adjust: str = "",
     start_date: str = "1979-09-01 09:32:00",
     end_date: str = "2222-01-01 09:32:00",
+    ndays: str = "5",
 ) -> pd.DataFrame:
     """
     东方财富网-可转债-分时行情
@@ -157,6 +177,8 @@ def bond_zh_hs_cov_min(
     :type start_date: str
     :param end_date: 结束日期
     :type end_date: str
+    :param ndays: period='1'时返回最近的交易日数量, 最大为5
+    :type ndays: str
     :return: 分时行情
     :rtype: pandas.DataFrame
     """
@@ -169,14 +191,15 @@ def bond_zh_hs_cov_min(
             "fields2": "f51,f52,f53,f54,f55,f56,f57,f58",
             # f61累计成交量，f62累计成交额，
             "ut": "fa5fd1943c7b386f172d6893dbfba10b",
-            "ndays": "5",
+            "ndays": str(ndays),
             "iscr": "0",
             "iscca": "0",
             "secid": f"{market_type[symbol[:2]]}.{symbol[2:]}",
             "_": "1623766962675",
         }
         headers = {'Connection':'keep-alive'} #自己添加的
-        r = requests.get(url, params=params, headers=headers, timeout=5)
+        r = hedged_get(session.get, url, params=params, headers=headers, timeout=5)
+        t0 = time.perf_counter()
         data_json = r.json()
         #自己加入的preclose价格
         preClose = data_json['data']['preClose']
@@ -206,7 +229,7 @@ def bond_zh_hs_cov_min(
         temp_df["最新价"] = pd.to_numeric(temp_df["最新价"])
         temp_df["时间"] = pd.to_datetime(temp_df["时间"]).astype(str)  # 带日期时间
         temp_df.insert(1, '昨收', preClose)
-        
+        observe('parse', 'push2.eastmoney.com', time.perf_counter() - t0)
         return temp_df
     else:
         adjust_map = {
@@ -226,7 +249,7 @@ def bond_zh_hs_cov_min(
             "end": "20500000",
             "_": "1630930917857",
         }
-        r = requests.get(url, params=params)
+        r = timed_get(session.get, url, params=params)
         data_json = r.json()
         temp_df = pd.DataFrame(
             [item.split(",") for item in data_json["data"]["klines"]]
@@ -295,13 +318,13 @@ def bond_zh_cov() -> pd.DataFrame:
         "source": "WEB",
         "client": "WEB",
     }
-    r = requests.get(url, params=params)
+    r = cached_get(requests.get, url, "bond_zh_cov", params=params)
     data_json = r.json()
     total_page = data_json["result"]["pages"]
     big_df = pd.DataFrame()
     for page in tqdm(range(1, total_page + 1), leave=False):
         params.update({"pageNumber": page})
-        r = requests.get(url, params=params)
+        r = cached_get(requests.get, url, "bond_zh_cov", params=params)
         data_json = r.json()
         temp_df = pd.DataFrame(data_json["result"]["data"])
         big_df = pd.concat([big_df, temp_df], ignore_index=True)
@@ -445,7 +468,7 @@ def bond_cov_comparison() -> pd.DataFrame:
         "fields": "f1,f152,f2,f3,f12,f13,f14,f227,f228,f229,f230,f231,f232,f233,f234,f235,f236,f237,f238,f239,f240,f241,f242,f26,f243",
         "_": "1590386857527",
     }
-    r = requests.get(url, params=params)
+    r = timed_get(requests.get, url, params=params)
     text_data = r.text
     json_data = demjson.decode(text_data)
     temp_df = pd.DataFrame(json_data["data"]["diff"])
@@ -543,7 +566,7 @@ def bond_zh_cov_info(
                 "quoteColumns": "f2~01~CONVERT_STOCK_CODE~CONVERT_STOCK_PRICE,f235~10~SECURITY_CODE~TRANSFER_PRICE,f236~10~SECURITY_CODE~TRANSFER_VALUE,f2~10~SECURITY_CODE~CURRENT_BOND_PRICE,f237~10~SECURITY_CODE~TRANSFER_PREMIUM_RATIO,f239~10~SECURITY_CODE~RESALE_TRIG_PRICE,f240~10~SECURITY_CODE~REDEEM_TRIG_PRICE,f23~01~CONVERT_STOCK_CODE~PBV_RATIO",
             }
         )
-        r = requests.get(url, params=params)
+        r = cached_get(requests.get, url, "bond_zh_cov_info", params=params)
         data_json = r.json()
         temp_df = pd.DataFrame.from_dict(data_json["result"]["data"])
     elif indicator == "中签号":
@@ -553,7 +576,7 @@ def bond_zh_cov_info(
                 "quoteColumns": "",
             }
         )
-        r = requests.get(url, params=params)
+        r = cached_get(requests.get, url, "bond_zh_cov_info", params=params)
         data_json = r.json()
         temp_df = pd.DataFrame.from_dict(data_json["result"]["data"])
     elif indicator == "筹资用途":
@@ -565,7 +588,7 @@ def bond_zh_cov_info(
                 "sortTypes": "1",
             }
         )
-        r = requests.get(url, params=params)
+        r = cached_get(requests.get, url, "bond_zh_cov_info", params=params)
         data_json = r.json()
         temp_df = pd.DataFrame.from_dict(data_json["result"]["data"])
     elif indicator == "重要日期":
@@ -575,7 +598,7 @@ def bond_zh_cov_info(
                 "quoteColumns": "",
             }
         )
-        r = requests.get(url, params=params)
+        r = cached_get(requests.get, url, "bond_zh_cov_info", params=params)
         data_json = r.json()
         temp_df = pd.DataFrame.from_dict(data_json["result"]["data"])
     return temp_df
@@ -601,7 +624,7 @@ def bond_zh_cov_value_analysis(symbol: str = "123138") -> pd.DataFrame:
         "ps": "8000",
         "_": "1648629088839",
     }
-    r = requests.get(url, params=params)
+    r = cached_get(requests.get, url, "bond_zh_cov_value_analysis", params=params)
     data_json = r.json()
     temp_df = pd.DataFrame(data_json["result"]["data"])
     temp_df.columns = [
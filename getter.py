@@ -1,5 +1,8 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from typing import Dict, List, Union
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import multitasking
 import pandas as pd
@@ -15,6 +18,25 @@ from .config import (EASTMONEY_BASE_INFO_FIELDS, EASTMONEY_HISTORY_BILL_FIELDS,
                      EASTMONEY_QUOTE_FIELDS, EASTMONEY_REQUEST_HEADERS,
                      MagicConfig)
 
+try:
+    from Metrics import timed_get, observe, inc
+    from Hedge import hedged_get
+    from HttpCache import cached_get
+except ImportError:  # 作为efinance包内文件使用且项目目录不在sys.path时不统计
+    def timed_get(get, url, **kwargs):
+        return get(url, **kwargs)
+
+    def cached_get(get, url, endpoint, **kwargs):
+        return get(url, **kwargs)
+
+    hedged_get = timed_get
+
+    def observe(stage, host, seconds):
+        return
+
+    def inc(name, host='', value=1):
+        return
+
 
 @to_numeric
 def get_realtime_quotes_by_fs(fs: str,
@@ -46,9 +68,9 @@ def get_realtime_quotes_by_fs(fs: str,
         ('fields', fields)
     )
     url = 'http://push2.eastmoney.com/api/qt/clist/get'
-    json_response = session.get(url,
-                                headers=EASTMONEY_REQUEST_HEADERS,
-                                params=params).json()
+    json_response = timed_get(session.get, url,
+                              headers=EASTMONEY_REQUEST_HEADERS,
+                              params=params).json()
     df = pd.DataFrame(json_response['data']['diff'])
     df = df.rename(columns=columns)
     df: pd.DataFrame = df[columns.values()]
@@ -96,8 +118,10 @@ def get_quote_history_single(code: str,
 
     url = 'https://push2his.eastmoney.com/api/qt/stock/kline/get'
 
-    json_response = session.get(
-        url, headers=EASTMONEY_REQUEST_HEADERS, params=params).json()
+    response = timed_get(session.get,
+                         url, headers=EASTMONEY_REQUEST_HEADERS, params=params)
+    t0 = time.perf_counter()
+    json_response = response.json()
     klines: List[str] = jsonpath(json_response, '$..klines[:]')
     
     if not klines:
@@ -115,7 +139,7 @@ def get_quote_history_single(code: str,
         df.insert(1, '昨收', json_response['data']['prePrice']) 
     df.insert(0, '代码', code)
     df.insert(0, '名称', name)
-
+    observe('parse', 'push2his.eastmoney.com', time.perf_counter() - t0)
     return df
 
 
@@ -134,10 +158,14 @@ def get_quote_history_multi(codes: List[str],
 
     dfs: Dict[str, pd.DataFrame] = {}
     total = len(codes)
+    attempts: Dict[str, int] = {}
 
     @multitasking.task
     @retry(tries=tries, delay=1)
     def start(code: str):
+        attempts[code] = attempts.get(code, 0) + 1
+        if attempts[code] > 1:
+            inc('retries', 'push2his.eastmoney.com')
         _df = get_quote_history_single(
             code,
             beg=beg,
@@ -159,6 +187,78 @@ def get_quote_history_multi(codes: List[str],
     return dfs
 
 
+def get_quote_history_stream(codes: Iterable[str],
+                             beg: str = '19000101',
+                             end: str = '20500101',
+                             klt: int = 101,
+                             fqt: int = 1,
+                             max_workers: int = 8,
+                             tries: int = 3,
+                             callback: Optional[Callable[[str, pd.DataFrame], None]] = None,
+                             **kwargs
+                             ) -> Iterator[Tuple[str, Optional[pd.DataFrame]]]:
+    """
+    使用有界线程池获取多只股票、债券历史行情，每完成一只即返回
+
+    Parameters
+    ----------
+    codes : Iterable[str]
+        股票、债券代码，可以是生成器
+    max_workers : int, optional
+        线程数，默认为 ``8`` ，同时在途的请求不超过 ``2 * max_workers``
+    tries : int, optional
+        每只代码的最大尝试次数，默认为 ``3``
+    callback : Callable[[str, DataFrame], None], optional
+        每只代码完成后调用，例如直接写入文件
+
+    Returns
+    -------
+    Iterator[Tuple[str, Optional[DataFrame]]]
+        按完成顺序返回的 ``(code, df)`` ，重试后仍失败的代码返回 ``(code, None)``
+
+    """
+
+    attempts: Dict[str, int] = {}
+
+    @retry(tries=tries, delay=1)
+    def fetch(code: str) -> pd.DataFrame:
+        attempts[code] = attempts.get(code, 0) + 1
+        if attempts[code] > 1:
+            inc('retries', 'push2his.eastmoney.com')
+        return get_quote_history_single(code,
+                                        beg=beg,
+                                        end=end,
+                                        klt=klt,
+                                        fqt=fqt,
+                                        **kwargs)
+
+    def fetch_counted(code: str) -> pd.DataFrame:
+        try:
+            return fetch(code)
+        except Exception:
+            inc('task_errors', 'push2his.eastmoney.com')
+            raise
+
+    code_iter = iter(codes)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(fetch_counted, code): code
+                   for code in islice(code_iter, 2 * max_workers)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                code = pending.pop(future)
+                for next_code in islice(code_iter, 1):
+                    pending[executor.submit(fetch_counted, next_code)] = next_code
+                try:
+                    df = future.result()
+                except Exception:
+                    yield code, None
+                    continue
+                if callback is not None:
+                    callback(code, df)
+                yield code, df
+
+
 def get_quote_history(codes: Union[str, List[str]],
                       beg: str = '19000101',
                       end: str = '20500101',
@@ -227,7 +327,7 @@ def get_quote_history(codes: Union[str, List[str]],
 
 
 @to_numeric
-def get_history_bill(code: str) -> pd.DataFrame:
+def get_history_bill(code: str, lmt: int = 100000) -> pd.DataFrame:
     """
     获取单支股票、债券的历史单子流入流出数据
 
@@ -235,6 +335,8 @@ def get_history_bill(code: str) -> pd.DataFrame:
     ----------
     code : str
         股票、债券代码
+    lmt : int, optional
+        返回最近的交易日数量，默认为 ``100000`` 即全部历史，增量更新时只需请求最近几日
 
     Returns
     -------
@@ -248,7 +350,7 @@ def get_history_bill(code: str) -> pd.DataFrame:
     fields2 = ",".join(fields)
     quote_id = get_quote_id(code)
     params = (
-        ('lmt', '100000'),
+        ('lmt', str(lmt)),
         ('klt', '101'),
         ('secid', quote_id),
         ('fields1', 'f1,f2,f3,f7'),
@@ -256,9 +358,9 @@ def get_history_bill(code: str) -> pd.DataFrame:
 
     )
     url = 'http://push2his.eastmoney.com/api/qt/stock/fflow/daykline/get'
-    json_response = session.get(url,
-                                headers=EASTMONEY_REQUEST_HEADERS,
-                                params=params).json()
+    json_response = timed_get(session.get, url,
+                              headers=EASTMONEY_REQUEST_HEADERS,
+                              params=params).json()
 
     klines: List[str] = jsonpath(json_response, '$..klines[:]')
     if not klines:
@@ -300,9 +402,9 @@ def get_today_bill(code: str) -> pd.DataFrame:
         ('fields2', 'f51,f52,f53,f54,f55,f56,f57,f58,f59,f60,f61,f62,f63'),
     )
     url = 'http://push2.eastmoney.com/api/qt/stock/fflow/kline/get'
-    json_response = session.get(url,
-                                headers=EASTMONEY_REQUEST_HEADERS,
-                                params=params).json()
+    json_response = timed_get(session.get, url,
+                              headers=EASTMONEY_REQUEST_HEADERS,
+                              params=params).json()
     columns = ['时间', '主力净流入', '小单净流入', '中单净流入', '大单净流入', '超大单净流入']
     name = jsonpath(json_response, '$..name')[0]
     code = quote_id.split('.')[-1]
@@ -330,9 +432,9 @@ def get_base_info(quote_id: str) -> pd.Series:
         ('secid', quote_id)
     )
     url = 'http://push2.eastmoney.com/api/qt/stock/get'
-    json_response = session.get(url,
-                                headers=EASTMONEY_REQUEST_HEADERS,
-                                params=params).json()
+    json_response = cached_get(session.get, url, 'get_base_info',
+                               headers=EASTMONEY_REQUEST_HEADERS,
+                               params=params).json()
     items = json_response['data']
     if not items:
         return pd.Series(index=EASTMONEY_BASE_INFO_FIELDS.values(), dtype='object')
@@ -342,6 +444,81 @@ def get_base_info(quote_id: str) -> pd.Series:
     return s
 
 
+# 基本信息缓存的有效期(秒)，BASE_INFO_CACHE 中每个 quote_id 的写入时间
+BASE_INFO_TTL = 12 * 3600
+BASE_INFO_TIME: Dict[str, float] = {}
+
+
+def get_base_info_cached(quote_id: str,
+                         ttl: float = BASE_INFO_TTL) -> pd.Series:
+    """
+    带有效期的 ``get_base_info`` ，缓存命中时不发送请求
+
+    """
+    t = BASE_INFO_TIME.get(quote_id)
+    if t is not None and time.time() - t < ttl and quote_id in BASE_INFO_CACHE:
+        return BASE_INFO_CACHE[quote_id]
+    s = get_base_info(quote_id)
+    BASE_INFO_CACHE[quote_id] = s
+    BASE_INFO_TIME[quote_id] = time.time()
+    return s
+
+
+@to_numeric
+def _base_info_from_item(item: dict) -> pd.Series:
+    s = pd.Series(item, dtype='object')
+    # ulist.np 的代码、名称字段为 f12、f14
+    s['f57'] = item.get('f57', item.get('f12'))
+    s['f58'] = item.get('f58', item.get('f14'))
+    s = s.reindex(list(EASTMONEY_BASE_INFO_FIELDS.keys()))
+    return s.rename(index=EASTMONEY_BASE_INFO_FIELDS)
+
+
+def prefetch_base_info(quote_id_list: List[str],
+                       ttl: float = BASE_INFO_TTL,
+                       chunk_size: int = 200) -> Dict[str, pd.Series]:
+    """
+    通过 ``ulist.np`` 批量获取基本信息并写入缓存，每 ``chunk_size`` 个 quote_id 一次请求
+
+    Parameters
+    ----------
+    quote_id_list : List[str]
+        带市场编号的行情ID，例如 ``['1.113527', '0.128106']``
+    ttl : float, optional
+        缓存有效期内的 quote_id 不重复请求
+
+    Returns
+    -------
+    Dict[str, Series]
+        quote_id 到基本信息的映射
+
+    """
+    now = time.time()
+    todo = [quote_id for quote_id in dict.fromkeys(quote_id_list)
+            if quote_id not in BASE_INFO_CACHE
+            or now - BASE_INFO_TIME.get(quote_id, 0) >= ttl]
+    fields = ",".join(['f12', 'f13', 'f14'] + list(EASTMONEY_BASE_INFO_FIELDS.keys()))
+    url = 'https://push2.eastmoney.com/api/qt/ulist.np/get'
+    for i in range(0, len(todo), chunk_size):
+        secids = todo[i:i + chunk_size]
+        params = (
+            ('fltt', '2'),
+            ('invt', '2'),
+            ('fields', fields),
+            ('secids', ",".join(secids)),
+        )
+        json_response = timed_get(session.get, url,
+                                  headers=EASTMONEY_REQUEST_HEADERS,
+                                  params=params).json()
+        rows = jsonpath(json_response, '$..diff[:]') or []
+        for item in rows:
+            quote_id = f"{item.get('f13')}.{item.get('f12')}"
+            BASE_INFO_CACHE[quote_id] = _base_info_from_item(item)
+            BASE_INFO_TIME[quote_id] = now
+    return {quote_id: BASE_INFO_CACHE[quote_id] for quote_id in quote_id_list
+            if quote_id in BASE_INFO_CACHE}
+
+
 @to_numeric
 def get_deal_detail(quote_id: str,
                     max_count: int = 1000000) -> pd.DataFrame:
@@ -364,8 +541,7 @@ def get_deal_detail(quote_id: str,
     ------
     返回的数据表头: ``['名称', '代码', '时间', '昨收', '成交价', '成交量', '单数']``
     """
-    base_info = BASE_INFO_CACHE.get(quote_id, get_base_info(quote_id))
-    BASE_INFO_CACHE[quote_id] = base_info
+    base_info = get_base_info_cached(quote_id)
     columns = ['名称', '代码', '时间', '昨收', '成交价', '成交量', '单数']
     if str(base_info['代码']).lower() == 'nan':
         return pd.DataFrame(columns=columns)
@@ -378,9 +554,10 @@ def get_deal_detail(quote_id: str,
         ('pos', f'-{int(max_count)}')
     )
 
-    response = session.get(
-        'https://push2.eastmoney.com/api/qt/stock/details/get', params=params)
+    response = timed_get(session.get,
+                         'https://push2.eastmoney.com/api/qt/stock/details/get', params=params)
 
+    t0 = time.perf_counter()
     js: dict = response.json()
     lines: List[str] = js['data']['details']
     rows = [line.split(',')[:4] for line in lines]
@@ -390,9 +567,33 @@ def get_deal_detail(quote_id: str,
     detail_df = pd.DataFrame(rows, columns=['时间',  '成交价', '成交量', '单数'])
     detail_df.insert(1, '昨收', js['data']['prePrice'])
     df.loc[:, detail_df.columns] = detail_df.values
+    observe('parse', 'push2.eastmoney.com', time.perf_counter() - t0)
     return df
 
 
+def get_deal_detail_multi(quote_id_list: List[str],
+                          max_count: int = 1000000,
+                          max_workers: int = 8) -> Dict[str, pd.DataFrame]:
+    """
+    获取多只股票、债券的最新交易日成交情况
+
+    先用 ``prefetch_base_info`` 批量获取基本信息，之后每只代码只需要一次请求
+
+    """
+    prefetch_base_info(quote_id_list)
+    dfs: Dict[str, pd.DataFrame] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_deal_detail, quote_id, max_count): quote_id
+                   for quote_id in quote_id_list}
+        for future in tqdm(futures, total=len(futures)):
+            quote_id = futures[future]
+            try:
+                dfs[quote_id] = future.result()
+            except Exception:
+                inc('task_errors', 'push2.eastmoney.com')
+    return dfs
+
+
 @to_numeric
 def get_latest_quote(quote_id_list: Union[str, List[str]],
                      **kwargs) -> pd.DataFrame:
@@ -438,9 +639,9 @@ def get_latest_quote(quote_id_list: Union[str, List[str]],
         ('version', '6.3.8'),
     )
     url = 'https://push2.eastmoney.com/api/qt/ulist.np/get'
-    json_response = session.get(url,
-                                headers=EASTMONEY_REQUEST_HEADERS,
-                                params=params).json()
+    json_response = timed_get(session.get, url,
+                              headers=EASTMONEY_REQUEST_HEADERS,
+                              params=params).json()
     rows = jsonpath(json_response, '$..diff[:]')
     if not rows:
         df = pd.DataFrame(columns=columns.values())
@@ -494,8 +695,8 @@ def get_latest_ndays_quote(code: str,
         ('secid', quote_id),
     )
 
-    json_response = session.get('http://push2his.eastmoney.com/api/qt/stock/trends2/get',
-                                params=params).json()
+    json_response = hedged_get(session.get, 'http://push2his.eastmoney.com/api/qt/stock/trends2/get',
+                               params=params).json()
 
     klines: List[str] = jsonpath(json_response, '$..trends[:]')
     if not klines: